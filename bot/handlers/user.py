@@ -1741,6 +1741,11 @@ async def generate_key_handler(callback: CallbackQuery) -> None:
             result = await api.generate_vpn_key(callback.from_user.id, regenerate=False)
             vpn_key = result.get("key")
             server_name = result.get("server_name", "Сервер")
+            # Клиент в панели создается фоново (outbox), обычно за несколько секунд
+            pending_note = (
+                "⏳ Ключ активируется на сервере в течение нескольких секунд.\n\n"
+                if result.get("panel_status") == "pending" else ""
+            )
             
             if not vpn_key:
                 await callback.answer("❌ Не удалось сгенерировать ключ", show_alert=True)
@@ -1816,6 +1821,7 @@ async def generate_key_handler(callback: CallbackQuery) -> None:
             f"🔑 <b>Ваш VPN ключ</b>\n\n"
             f"Сервер: <b>{server_name}</b>\n\n"
             f"<code>{vpn_key}</code>\n\n"
+            f"{pending_note}"
             f"Используйте этот ключ для подключения к VPN.\n\n"
             f"📖 <a href=\"{guide_url}\">Инструкция по использованию</a>",
             parse_mode="HTML",
@@ -1851,6 +1857,11 @@ async def regenerate_key_handler(callback: CallbackQuery) -> None:
             result = await api.generate_vpn_key(callback.from_user.id, regenerate=True)
             vpn_key = result.get("key")
             server_name = result.get("server_name", "Сервер")
+            # Клиент в панели создается фоново (outbox), обычно за несколько секунд
+            pending_note = (
+                "⏳ Ключ активируется на сервере в течение нескольких секунд.\n\n"
+                if result.get("panel_status") == "pending" else ""
+            )
             
             if not vpn_key:
                 await callback.answer("❌ Не удалось сгенерировать ключ", show_alert=True)
@@ -1920,6 +1931,7 @@ async def regenerate_key_handler(callback: CallbackQuery) -> None:
             f"🔑 <b>Ваш VPN ключ</b>\n\n"
             f"Сервер: <b>{server_name}</b>\n\n"
             f"<code>{vpn_key}</code>\n\n"
+            f"{pending_note}"
             f"Используйте этот ключ для подключения к VPN.\n\n"
             f"📖 <a href=\"{guide_url}\">Инструкция по использованию</a>",
             parse_mode="HTML",
@@ -0,0 +1,299 @@
+"""
+Массовые рассылки пользователям бота
+
+Рассылка — строка broadcasts (текст, сегмент, статус, счетчики) и строки
+broadcast_recipients по одной на получателя. Получатели не выбираются целиком:
+сегмент читается пачками по users.id (keyset), курсор last_user_id сохраняется
+вместе с добавленными получателями в одной транзакции. Сообщения уходят через
+telegram_dispatcher (общие лимиты бота), статус каждого получателя и счетчики
+рассылки записываются после отправки пачки.
+
+Поэтому после перезапуска рассылка продолжается с места остановки: сначала
+досылаются получатели пачки, прерванной на середине (им сообщение может прийти
+повторно — не больше одной пачки), затем выборка идет дальше от курсора.
+При доле воркера в лимите бота 20 сообщений в секунду (TELEGRAM_RATE_LIMIT)
+300 тысяч получателей — около 4 часов.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy import exists, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.db.models import Broadcast, BroadcastRecipient, Subscription, SubscriptionStatus, User, VpnCredential
+from core.telegram_dispatcher import TelegramSendError, telegram_dispatcher
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_ALL = "all"
+SEGMENT_ACTIVE = "active"
+SEGMENT_EXPIRED_7D = "expired_7d"
+SEGMENT_SERVER = "server"
+SEGMENTS = (SEGMENT_ALL, SEGMENT_ACTIVE, SEGMENT_EXPIRED_7D, SEGMENT_SERVER)
+
+BROADCAST_RUNNING = "running"
+BROADCAST_PAUSED = "paused"
+BROADCAST_COMPLETED = "completed"
+BROADCAST_CANCELLED = "cancelled"
+
+RECIPIENT_PENDING = "pending"
+RECIPIENT_SENT = "sent"
+RECIPIENT_FAILED = "failed"
+
+# Режимы разметки текста рассылки (None — обычный текст, символы < и & отправляются как есть)
+BROADCAST_PARSE_MODES = (None, "HTML")
+
+BROADCAST_BATCH_SIZE = 500
+# Сообщений в полете одновременно; частоту ограничивает telegram_dispatcher
+BROADCAST_CONCURRENCY = 50
+EXPIRED_SEGMENT_WINDOW = timedelta(days=7)
+
+
+def segment_filter(segment: str, server_id: int | None = None, now: datetime | None = None) -> Any:
+    """
+    Условие на users для сегмента рассылки
+
+    Raises:
+        ValueError: неизвестный сегмент или сегмент server без server_id
+    """
+    now = now or datetime.now(timezone.utc)
+    if segment == SEGMENT_ALL:
+        return User.is_active == True
+    if segment == SEGMENT_ACTIVE:
+        return User.has_active_subscription == True
+    if segment == SEGMENT_EXPIRED_7D:
+        recently_ended = exists().where(
+            Subscription.user_id == User.id,
+            Subscription.status.in_([SubscriptionStatus.expired, SubscriptionStatus.active]),
+            Subscription.ends_at >= now - EXPIRED_SEGMENT_WINDOW,
+            Subscription.ends_at <= now,
+        )
+        return (User.has_active_subscription == False) & recently_ended
+    if segment == SEGMENT_SERVER:
+        if not server_id:
+            raise ValueError("Для сегмента server нужен server_id")
+        on_server = exists().where(
+            VpnCredential.user_id == User.id,
+            VpnCredential.server_id == server_id,
+            VpnCredential.active == True,
+        )
+        return or_(User.selected_server_id == server_id, on_server)
+    raise ValueError(f"Неизвестный сегмент рассылки: {segment}")
+
+
+async def create_broadcast(
+    session: AsyncSession,
+    text: str,
+    segment: str,
+    server_id: int | None = None,
+    created_by_tg_id: int | None = None,
+    parse_mode: str | None = None,
+) -> Broadcast:
+    """
+    Создать рассылку (commit делает вызывающий код); отправку выполняет фоновая задача
+
+    Raises:
+        ValueError: пустой текст, некорректный сегмент или режим разметки
+    """
+    if not text.strip():
+        raise ValueError("Текст рассылки пустой")
+    if parse_mode not in BROADCAST_PARSE_MODES:
+        raise ValueError(f"Неизвестный режим разметки: {parse_mode}")
+    condition = segment_filter(segment, server_id)
+    now = datetime.now(timezone.utc)
+    total = await session.scalar(select(func.count()).select_from(User).where(condition))
+    broadcast = Broadcast(
+        text=text,
+        parse_mode=parse_mode,
+        segment=segment,
+        server_id=server_id if segment == SEGMENT_SERVER else None,
+        status=BROADCAST_RUNNING,
+        total_count=int(total or 0),
+        created_by_tg_id=created_by_tg_id,
+        created_at=now,
+        updated_at=now,
+    )
+    session.add(broadcast)
+    await session.flush()
+    return broadcast
+
+
+async def _materialize_recipients(session: AsyncSession, broadcast: Broadcast, limit: int) -> int:
+    """Добавить следующую пачку получателей сегмента после курсора и сдвинуть курсор"""
+    rows = (
+        await session.execute(
+            select(User.id, User.tg_id)
+            .where(User.id > broadcast.last_user_id)
+            .where(segment_filter(broadcast.segment, broadcast.server_id))
+            .order_by(User.id)
+            .limit(limit)
+        )
+    ).all()
+    if not rows:
+        return 0
+
+    insert = pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+    await session.execute(
+        insert(BroadcastRecipient)
+        .values([
+            {"broadcast_id": broadcast.id, "user_id": row.id, "tg_id": row.tg_id, "status": RECIPIENT_PENDING}
+            for row in rows
+        ])
+        .on_conflict_do_nothing(index_elements=["broadcast_id", "user_id"])
+    )
+    broadcast.last_user_id = rows[-1].id
+    broadcast.updated_at = datetime.now(timezone.utc)
+    return len(rows)
+
+
+async def _pending_recipients(session: AsyncSession, broadcast_id: int, limit: int) -> list[BroadcastRecipient]:
+    recipients = await session.scalars(
+        select(BroadcastRecipient)
+        .where(BroadcastRecipient.broadcast_id == broadcast_id)
+        .where(BroadcastRecipient.status == RECIPIENT_PENDING)
+        .order_by(BroadcastRecipient.id)
+        .limit(limit)
+    )
+    return list(recipients.all())
+
+
+async def _send_batch(
+    text: str, parse_mode: str | None, recipients: list[BroadcastRecipient]
+) -> list[dict[str, Any]]:
+    """Отправить пачку; возвращает изменения строк получателей для bulk UPDATE"""
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send(recipient: BroadcastRecipient) -> dict[str, Any]:
+        async with semaphore:
+            try:
+                await telegram_dispatcher.send_message(recipient.tg_id, text, parse_mode=parse_mode)
+            except TelegramSendError as e:
+                return {"id": recipient.id, "status": RECIPIENT_FAILED, "error": str(e)[:500], "sent_at": None}
+            except Exception as e:
+                logger.warning(f"Рассылка: ошибка отправки пользователю {recipient.tg_id}: {e}")
+                return {"id": recipient.id, "status": RECIPIENT_FAILED, "error": str(e)[:500], "sent_at": None}
+            return {"id": recipient.id, "status": RECIPIENT_SENT, "error": None, "sent_at": datetime.now(timezone.utc)}
+
+    return list(await asyncio.gather(*(send(recipient) for recipient in recipients)))
+
+
+async def run_broadcast_batch(batch_size: int = BROADCAST_BATCH_SIZE) -> bool:
+    """
+    Отправить одну пачку самой старой активной рассылки
+
+    Returns:
+        True, если работа еще есть (следующую пачку можно запускать сразу)
+    """
+    from core.db.session import SessionLocal
+
+    async with SessionLocal() as session:
+        broadcast = await session.scalar(
+            select(Broadcast).where(Broadcast.status == BROADCAST_RUNNING).order_by(Broadcast.id).limit(1)
+        )
+        if broadcast is None:
+            return False
+
+        # Сначала получатели пачки, прерванной перезапуском
+        recipients = await _pending_recipients(session, broadcast.id, batch_size)
+        if not recipients:
+            if await _materialize_recipients(session, broadcast, batch_size):
+                await session.commit()
+                recipients = await _pending_recipients(session, broadcast.id, batch_size)
+            else:
+                now = datetime.now(timezone.utc)
+                await session.execute(
+                    update(Broadcast)
+                    .where(Broadcast.id == broadcast.id)
+                    .where(Broadcast.status == BROADCAST_RUNNING)
+                    .values(status=BROADCAST_COMPLETED, finished_at=now, updated_at=now)
+                )
+                await session.commit()
+                logger.info(
+                    f"Рассылка #{broadcast.id} завершена: отправлено {broadcast.sent_count}, "
+                    f"ошибок {broadcast.failed_count}"
+                )
+                return True
+        broadcast_id, text, parse_mode = broadcast.id, broadcast.text, broadcast.parse_mode
+
+    results = await _send_batch(text, parse_mode, recipients)
+    sent = sum(1 for result in results if result["status"] == RECIPIENT_SENT)
+
+    async with SessionLocal() as session:
+        await session.execute(update(BroadcastRecipient), results)
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(
+                sent_count=Broadcast.sent_count + sent,
+                failed_count=Broadcast.failed_count + (len(results) - sent),
+                updated_at=datetime.now(timezone.utc),
+            )
+        )
+        await session.commit()
+    return True
+
+
+async def set_broadcast_status(session: AsyncSession, broadcast_id: int, status: str) -> bool:
+    """
+    Приостановить, продолжить или отменить рассылку (commit делает вызывающий код)
+
+    Returns:
+        False, если рассылки нет или переход из ее статуса невозможен
+    """
+    allowed_from = {
+        BROADCAST_PAUSED: (BROADCAST_RUNNING,),
+        BROADCAST_RUNNING: (BROADCAST_PAUSED,),
+        BROADCAST_CANCELLED: (BROADCAST_RUNNING, BROADCAST_PAUSED),
+    }
+    if status not in allowed_from:
+        return False
+    now = datetime.now(timezone.utc)
+    values: dict[str, Any] = {"status": status, "updated_at": now}
+    if status == BROADCAST_CANCELLED:
+        values["finished_at"] = now
+    updated = await session.scalar(
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id)
+        .where(Broadcast.status.in_(allowed_from[status]))
+        .values(**values)
+        .returning(Broadcast.id)
+    )
+    return updated is not None
+
+
+def _aware(value: datetime | None) -> datetime | None:
+    # SQLite возвращает время без часового пояса
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def broadcast_snapshot(broadcast: Broadcast, now: datetime | None = None) -> dict[str, Any]:
+    """Прогресс рассылки для админки (средняя скорость — с момента создания)"""
+    now = now or datetime.now(timezone.utc)
+    created_at = _aware(broadcast.created_at)
+    # Приостановленная или завершенная рассылка — скорость до последнего изменения
+    until = now if broadcast.status == BROADCAST_RUNNING else _aware(broadcast.finished_at or broadcast.updated_at)
+    elapsed = (until - created_at).total_seconds() if created_at and until else 0
+    processed = broadcast.sent_count + broadcast.failed_count
+    return {
+        "id": broadcast.id,
+        "segment": broadcast.segment,
+        "server_id": broadcast.server_id,
+        "status": broadcast.status,
+        "text": broadcast.text,
+        "parse_mode": broadcast.parse_mode,
+        "total": max(broadcast.total_count, processed),
+        "sent": broadcast.sent_count,
+        "failed": broadcast.failed_count,
+        "processed": processed,
+        "avg_per_second": round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+        "created_at": created_at.isoformat() if created_at else None,
+        "finished_at": _aware(broadcast.finished_at).isoformat() if broadcast.finished_at else None,
+    }
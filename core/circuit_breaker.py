@@ -0,0 +1,120 @@
+"""
+Circuit breaker для внешних узлов (панели 3x-UI)
+
+Пока узел недоступен, вызовы к нему не ждут сетевой таймаут, а сразу завершаются ошибкой.
+После паузы пропускается один пробный вызов (half-open): успех закрывает цепь,
+неудача снова открывает ее с удвоенной паузой (до max_cooldown).
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Состояние доступности одного узла"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        base_cooldown: float = 10.0,
+        max_cooldown: float = 300.0,
+    ):
+        """
+        Args:
+            name: Имя узла для логов
+            failure_threshold: Сколько ошибок подряд открывают цепь
+            base_cooldown: Пауза после первого открытия (секунды)
+            max_cooldown: Максимальная пауза при повторных открытиях (секунды)
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        # Сколько раз подряд цепь открывалась без успешного вызова (для экспоненциальной паузы)
+        self.open_streak = 0
+        self.opened_at: float | None = None
+        self.retry_at = 0.0
+        self.last_error: str | None = None
+        self._probe_in_flight = False
+
+    @property
+    def cooldown(self) -> float:
+        if self.open_streak <= 0:
+            return 0.0
+        return min(self.base_cooldown * (2 ** (self.open_streak - 1)), self.max_cooldown)
+
+    def allow(self) -> tuple[bool, bool]:
+        """
+        Можно ли выполнить вызов сейчас
+
+        Returns:
+            (разрешено, это пробный вызов half-open)
+        """
+        if self.state == self.CLOSED:
+            return True, False
+        if self._probe_in_flight or time.monotonic() < self.retry_at:
+            return False, False
+        # Пауза истекла: пропускаем один пробный вызов
+        self.state = self.HALF_OPEN
+        self._probe_in_flight = True
+        logger.info(f"Circuit {self.name}: пробный вызов (half-open)")
+        return True, True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit {self.name}: узел снова доступен, цепь закрыта")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.open_streak = 0
+        self.opened_at = None
+        self.retry_at = 0.0
+        self._probe_in_flight = False
+
+    def record_failure(self, error: BaseException | str | None = None) -> None:
+        if error is not None:
+            self.last_error = (str(error) or type(error).__name__)[:200] if not isinstance(error, str) else error[:200]
+        self.consecutive_failures += 1
+        was_probe = self._probe_in_flight
+        self._probe_in_flight = False
+
+        if was_probe or (self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.open_streak += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.retry_at = self.opened_at + self.cooldown
+            logger.warning(
+                f"Circuit {self.name}: цепь открыта на {self.cooldown:.0f}с "
+                f"(ошибок подряд: {self.consecutive_failures}, последняя: {self.last_error})"
+            )
+
+    def release_probe(self) -> None:
+        """Освободить пробный вызов, если он завершился без результата (например, был отменен)"""
+        if self._probe_in_flight:
+            self._probe_in_flight = False
+            self.state = self.OPEN
+
+    def retry_in(self) -> float:
+        """Сколько секунд до следующего пробного вызова"""
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def snapshot(self) -> dict[str, Any]:
+        """Состояние для админки"""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "cooldown_seconds": round(self.cooldown, 1),
+            "retry_in_seconds": round(self.retry_in(), 1) if self.state != self.CLOSED else 0.0,
+            "last_error": self.last_error,
+        }
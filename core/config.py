@@ -13,6 +13,11 @@ class Settings(BaseSettings):
     ticket_bot_link: str = Field(default="", env="TICKET_BOT_LINK")
     support_bot_token: str = Field(default="", env="SUPPORT_BOT_TOKEN")
     cryptobot_token: str = Field(default="", env="CRYPTOBOT_TOKEN")
+    # false — процесс API не запускает фоновые задачи (их выполняет python -m core.worker)
+    background_jobs_enabled: bool = Field(default=True, env="BACKGROUND_JOBS_ENABLED")
+    # Доля процесса в лимите Telegram на бота (сообщений в секунду, core.telegram_dispatcher);
+    # сумма по всем процессам core не больше 25
+    telegram_rate_limit: float = Field(default=25.0, env="TELEGRAM_RATE_LIMIT")
 
 
 def get_settings() -> Settings:
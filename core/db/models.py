@@ -13,6 +13,8 @@ from sqlalchemy import (
     Enum,
     Text,
     Numeric,
+    UniqueConstraint,
+    Index,
 )
 from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column
 
@@ -161,6 +163,7 @@ class VpnCredential(Base):
     config_text: Mapped[str | None] = mapped_column(Text())
     active: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
     expires_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+    panel_status: Mapped[str | None] = mapped_column(String(16), nullable=True)  # pending, synced, failed (None — без 3x-UI)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
 
     user: Mapped["User"] = relationship("User", back_populates="credentials")
@@ -298,6 +301,10 @@ class PromoCodeUsage(Base):
 class ServerStatus(Base):
     """Статус и метрики серверов"""
     __tablename__ = "server_status"
+    __table_args__ = (
+        # Последняя проверка сервера и история за период (core.status_history)
+        Index("ix_server_status_server_checked", "server_id", "checked_at"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     server_id: Mapped[int] = mapped_column(ForeignKey("servers.id", ondelete="CASCADE"), nullable=False, index=True)
@@ -309,11 +316,41 @@ class ServerStatus(Base):
     memory_usage_percent: Mapped[float | None] = mapped_column(String(10))  # Использование памяти в процентах
     disk_usage_percent: Mapped[float | None] = mapped_column(String(10))  # Использование диска в процентах
     error_message: Mapped[str | None] = mapped_column(Text)  # Сообщение об ошибке, если есть
+    # Статистика серии проб (core.health): задержка по ответившим пробам, потери по всем
+    probe_method: Mapped[str | None] = mapped_column(String(8))  # icmp, tcp, none
+    probe_samples: Mapped[int | None] = mapped_column(Integer)  # Сколько проб отправлено
+    latency_min_ms: Mapped[float | None] = mapped_column(Numeric(10, 2))
+    latency_avg_ms: Mapped[float | None] = mapped_column(Numeric(10, 2))
+    latency_p95_ms: Mapped[float | None] = mapped_column(Numeric(10, 2))
+    jitter_ms: Mapped[float | None] = mapped_column(Numeric(10, 2))  # Среднее отклонение соседних задержек
+    packet_loss_percent: Mapped[float | None] = mapped_column(Numeric(5, 2))
+    panel_reachable: Mapped[bool | None] = mapped_column(Boolean)  # Отвечает ли API 3x-UI (None — панель не настроена)
+    panel_response_ms: Mapped[int | None] = mapped_column(Integer)
     checked_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False, index=True)
     
     server: Mapped["Server"] = relationship("Server")
 
 
+class ServerStatusRollup(Base):
+    """Агрегаты server_status за час или сутки (core.status_history)"""
+    __tablename__ = "server_status_rollups"
+    __table_args__ = (
+        UniqueConstraint("server_id", "resolution", "bucket_start", name="uq_server_status_rollup_bucket"),
+    )
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    server_id: Mapped[int] = mapped_column(ForeignKey("servers.id", ondelete="CASCADE"), nullable=False)
+    resolution: Mapped[str] = mapped_column(String(8), nullable=False)  # hour, day
+    bucket_start: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+    samples: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # Сколько проверок попало в интервал
+    online_samples: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # Из них успешных
+    latency_min_ms: Mapped[float | None] = mapped_column(Numeric(10, 2))
+    latency_avg_ms: Mapped[float | None] = mapped_column(Numeric(10, 2))  # Среднее по успешным проверкам
+    latency_max_ms: Mapped[float | None] = mapped_column(Numeric(10, 2))  # Максимум p95 серий
+    
+    server: Mapped["Server"] = relationship("Server")
+
+
 class Backup(Base):
     """Записи о резервных копиях"""
     __tablename__ = "backups"
@@ -343,6 +380,10 @@ class SystemSetting(Base):
 class IpLog(Base):
     """Лог IP адресов клиентов VPN"""
     __tablename__ = "ip_logs"
+    __table_args__ = (
+        # Ключ upsert наблюдений при обходе серверов (INSERT ... ON CONFLICT)
+        UniqueConstraint("user_id", "server_id", "ip_address", name="uq_ip_logs_user_server_ip"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
@@ -379,6 +420,10 @@ class UserBan(Base):
 class SubscriptionNotification(Base):
     """Отслеживание отправленных уведомлений о подписке"""
     __tablename__ = "subscription_notifications"
+    __table_args__ = (
+        # Anti-join «уведомление уже отправлено» в core.expiry
+        Index("ix_subscription_notifications_user_type_sent", "user_id", "notification_type", "sent_at"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
@@ -388,3 +433,79 @@ class SubscriptionNotification(Base):
     
     user: Mapped["User"] = relationship("User")
 
+
+class PanelOutbox(Base):
+    """Отложенные изменения клиентов в 3x-UI (transactional outbox)"""
+    __tablename__ = "panel_outbox"
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    server_id: Mapped[int] = mapped_column(ForeignKey("servers.id", ondelete="CASCADE"), nullable=False, index=True)
+    operation: Mapped[str] = mapped_column(String(32), nullable=False)  # ensure_client, remove_client
+    client_email: Mapped[str] = mapped_column(String(128), nullable=False, index=True)
+    client_uuid: Mapped[str | None] = mapped_column(String(36), nullable=True)
+    payload: Mapped[str | None] = mapped_column(Text)  # JSON: expire_ms, limit_ip, total_gb, flow, enable
+    credential_id: Mapped[int | None] = mapped_column(ForeignKey("vpn_credentials.id", ondelete="SET NULL"), nullable=True, index=True)
+    status: Mapped[str] = mapped_column(String(16), default="pending", nullable=False, index=True)  # pending, processing, done, failed, superseded
+    attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False, index=True)
+    locked_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+    last_error: Mapped[str | None] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    processed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+
+
+class DelayedJob(Base):
+    """Отложенные действия (core.delayed_jobs): строка в БД вместо таймера в памяти процесса"""
+    __tablename__ = "delayed_jobs"
+    __table_args__ = (
+        # Выборка готовых к выполнению задач
+        Index("ix_delayed_jobs_status_run_at", "status", "run_at"),
+    )
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(64), nullable=False, index=True)  # ticket_autoclose, database_backup
+    payload: Mapped[str | None] = mapped_column(Text)  # JSON с параметрами обработчика
+    run_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    status: Mapped[str] = mapped_column(String(16), default="pending", nullable=False)  # pending, processing, failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    locked_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+    last_error: Mapped[str | None] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+
+
+class Broadcast(Base):
+    """Массовая рассылка (core.broadcast): текст, сегмент и сохраненный прогресс"""
+    __tablename__ = "broadcasts"
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    parse_mode: Mapped[str | None] = mapped_column(String(16))  # HTML или None (обычный текст)
+    segment: Mapped[str] = mapped_column(String(32), nullable=False)  # all, active, expired_7d, server
+    server_id: Mapped[int | None] = mapped_column(ForeignKey("servers.id", ondelete="SET NULL"), nullable=True)  # Для сегмента server
+    status: Mapped[str] = mapped_column(String(16), default="running", nullable=False, index=True)  # running, paused, completed, cancelled
+    last_user_id: Mapped[int] = mapped_column(Integer, default=0, nullable=False)  # Курсор keyset-выборки получателей (users.id)
+    total_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)  # Оценка размера сегмента при создании
+    sent_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    failed_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    created_by_tg_id: Mapped[int | None] = mapped_column(BigInteger)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+
+
+class BroadcastRecipient(Base):
+    """Получатель рассылки и статус доставки ему"""
+    __tablename__ = "broadcast_recipients"
+    __table_args__ = (
+        UniqueConstraint("broadcast_id", "user_id", name="uq_broadcast_recipients_broadcast_user"),
+        # Выборка неотправленных получателей рассылки
+        Index("ix_broadcast_recipients_broadcast_status", "broadcast_id", "status"),
+    )
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    broadcast_id: Mapped[int] = mapped_column(ForeignKey("broadcasts.id", ondelete="CASCADE"), nullable=False)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    tg_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    status: Mapped[str] = mapped_column(String(16), default="pending", nullable=False)  # pending, sent, failed
+    error: Mapped[str | None] = mapped_column(Text)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
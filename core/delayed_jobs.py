@@ -0,0 +1,229 @@
+"""
+Очередь отложенных действий в БД
+
+Вместо asyncio.create_task с asyncio.sleep (таймер живет в памяти процесса,
+теряется при деплое и дублируется в каждой реплике) действие записывается
+строкой delayed_jobs (kind, payload, run_at) — обычно в той же транзакции, что и
+изменение, к которому оно относится. Тысячи ожидающих действий стоят строк, а
+не корутин.
+
+Фоновая задача планировщика забирает готовые строки пачкой через
+FOR UPDATE SKIP LOCKED (несколько обработчиков не берут одну строку) и вызывает
+обработчик, зарегистрированный под kind (register_delayed_job). Успешно
+выполненные строки удаляются, ошибки повторяются с экспоненциальной паузой,
+после DELAYED_JOB_MAX_ATTEMPTS строка остается со статусом failed. Обработчик
+сообщает об ошибке исключением.
+
+Пока пачка выполняется, обработчик продлевает locked_at ее невыполненных строк
+каждые DELAYED_JOB_HEARTBEAT секунд, поэтому долгое действие (бэкап большой БД)
+не считается зависшим. Строки, зависшие в processing (процесс упал и продлевать
+перестал), через DELAYED_JOB_STALE_AFTER снова берутся в работу, поэтому
+обработчики должны быть идемпотентны.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.db.models import DelayedJob
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = "pending"
+JOB_PROCESSING = "processing"
+JOB_FAILED = "failed"
+
+DELAYED_JOB_MAX_ATTEMPTS = 5
+DELAYED_JOB_BASE_DELAY = 10.0
+DELAYED_JOB_MAX_DELAY = 3600.0
+DELAYED_JOB_STALE_AFTER = timedelta(minutes=15)
+# Как часто продлевать locked_at строк выполняемой пачки (намного меньше DELAYED_JOB_STALE_AFTER)
+DELAYED_JOB_HEARTBEAT = 60.0
+DELAYED_JOB_BATCH_SIZE = 100
+
+DelayedJobHandler = Callable[[dict[str, Any]], Awaitable[Any]]
+
+# Обработчики по kind
+DELAYED_JOB_HANDLERS: dict[str, DelayedJobHandler] = {}
+
+
+def register_delayed_job(kind: str) -> Callable[[DelayedJobHandler], DelayedJobHandler]:
+    """Зарегистрировать обработчик отложенных действий вида kind"""
+    def decorator(func: DelayedJobHandler) -> DelayedJobHandler:
+        DELAYED_JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def enqueue_delayed_job(
+    session: AsyncSession,
+    kind: str,
+    payload: dict[str, Any] | None = None,
+    delay: timedelta | None = None,
+    run_at: datetime | None = None,
+) -> DelayedJob:
+    """
+    Добавить отложенное действие в текущую транзакцию (commit делает вызывающий код)
+
+    Args:
+        session: Сессия БД
+        kind: Вид действия (ключ register_delayed_job)
+        payload: Параметры обработчика (JSON)
+        delay: Выполнить через delay
+        run_at: Выполнить не раньше run_at (если не задан delay; по умолчанию — сразу)
+    """
+    now = _utcnow()
+    job = DelayedJob(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        run_at=now + delay if delay is not None else (run_at or now),
+        status=JOB_PENDING,
+        created_at=now,
+    )
+    session.add(job)
+    return job
+
+
+def _retry_delay(attempts: int) -> float:
+    delay = min(DELAYED_JOB_BASE_DELAY * (2 ** max(attempts - 1, 0)), DELAYED_JOB_MAX_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def _claim_jobs(session: AsyncSession, batch_size: int) -> list[DelayedJob]:
+    """Забрать пачку готовых строк (на Postgres — FOR UPDATE SKIP LOCKED)"""
+    now = _utcnow()
+    stmt = (
+        select(DelayedJob)
+        .where(or_(
+            and_(DelayedJob.status == JOB_PENDING, DelayedJob.run_at <= now),
+            and_(DelayedJob.status == JOB_PROCESSING, DelayedJob.locked_at < now - DELAYED_JOB_STALE_AFTER),
+        ))
+        .order_by(DelayedJob.run_at)
+        .limit(batch_size)
+    )
+    if session.bind.dialect.name == "postgresql":
+        stmt = stmt.with_for_update(skip_locked=True)
+
+    jobs = list((await session.scalars(stmt)).all())
+    for job in jobs:
+        job.status = JOB_PROCESSING
+        job.locked_at = now
+    await session.commit()
+    return jobs
+
+
+async def _run_job(job: DelayedJob) -> str | None:
+    """Выполнить строку; None — успех, иначе текст ошибки"""
+    handler = DELAYED_JOB_HANDLERS.get(job.kind)
+    if handler is None:
+        return f"Нет обработчика для {job.kind}"
+    try:
+        await handler(json.loads(job.payload or "{}"))
+    except Exception as e:
+        logger.warning(f"Отложенное действие #{job.id} ({job.kind}) завершилось ошибкой: {e}", exc_info=True)
+        return str(e) or type(e).__name__
+    return None
+
+
+class _BatchLease:
+    """
+    Владение пачкой строк: продление locked_at, пока строки выполняются
+
+    Строки пачки помечены одним значением locked_at; продление и запись результата
+    идут под одной блокировкой, чтобы результат не сравнивался с устаревшим locked_at.
+    """
+
+    def __init__(self, jobs: list[DelayedJob]):
+        self.locked_at = jobs[0].locked_at
+        self.remaining = {job.id for job in jobs}
+        self.lock = asyncio.Lock()
+
+    def claimed(self, job_id: int) -> tuple[Any, ...]:
+        # Меняем только строки, которые все еще числятся в работе у нас
+        return (DelayedJob.id == job_id, DelayedJob.status == JOB_PROCESSING, DelayedJob.locked_at == self.locked_at)
+
+    async def heartbeat(self) -> None:
+        from core.db.session import SessionLocal
+
+        while True:
+            await asyncio.sleep(DELAYED_JOB_HEARTBEAT)
+            async with self.lock:
+                if not self.remaining:
+                    return
+                now = _utcnow()
+                try:
+                    async with SessionLocal() as session:
+                        await session.execute(
+                            update(DelayedJob)
+                            .where(DelayedJob.id.in_(self.remaining))
+                            .where(DelayedJob.status == JOB_PROCESSING)
+                            .where(DelayedJob.locked_at == self.locked_at)
+                            .values(locked_at=now)
+                        )
+                        await session.commit()
+                    self.locked_at = now
+                except Exception as e:
+                    logger.warning(f"Не удалось продлить блокировку отложенных действий: {e}")
+
+
+async def process_delayed_jobs(batch_size: int = DELAYED_JOB_BATCH_SIZE) -> int:
+    """
+    Выполнить одну пачку готовых отложенных действий
+
+    Returns:
+        Сколько строк было взято в работу
+    """
+    from core.db.session import SessionLocal
+
+    async with SessionLocal() as session:
+        jobs = await _claim_jobs(session, batch_size)
+    if not jobs:
+        return 0
+
+    lease = _BatchLease(jobs)
+    heartbeat = asyncio.create_task(lease.heartbeat())
+    try:
+        failed = await _run_jobs(jobs, lease)
+    finally:
+        heartbeat.cancel()
+
+    logger.info(f"Отложенные действия: выполнено {len(jobs) - failed}, с ошибкой {failed}")
+    return len(jobs)
+
+
+async def _run_jobs(jobs: list[DelayedJob], lease: _BatchLease) -> int:
+    """Выполнить строки пачки по очереди и записать результаты; возвращает число ошибок"""
+    from core.db.session import SessionLocal
+
+    failed = 0
+    for job in jobs:
+        error = await _run_job(job)
+        now = _utcnow()
+        async with lease.lock, SessionLocal() as session:
+            lease.remaining.discard(job.id)
+            claimed = lease.claimed(job.id)
+            if error is None:
+                await session.execute(delete(DelayedJob).where(*claimed))
+            else:
+                failed += 1
+                attempts = job.attempts + 1
+                values: dict[str, Any] = {"attempts": attempts, "last_error": error[:1000], "locked_at": None}
+                if attempts >= DELAYED_JOB_MAX_ATTEMPTS:
+                    values["status"] = JOB_FAILED
+                    logger.error(f"Отложенное действие #{job.id} ({job.kind}) не выполнено: {error}")
+                else:
+                    values.update(status=JOB_PENDING, run_at=now + timedelta(seconds=_retry_delay(attempts)))
+                await session.execute(update(DelayedJob).where(*claimed).values(**values))
+            await session.commit()
+    return failed
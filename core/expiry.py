@@ -0,0 +1,393 @@
+"""
+Истечение подписок: выборки и изменения пачками
+
+Уведомления «3 дня», «1 день» и «истекла» выбираются по окнам
+users.subscription_ends_at (диапазон по индексу), а уже отправленные
+отсекаются anti-join с subscription_notifications: уведомление вида kind
+считается отправленным для текущего срока, если оно записано не раньше
+subscription_ends_at - верхняя граница окна. Поэтому после продления (срок
+сдвигается) уведомления за новый срок придут снова.
+
+Выборки постраничные (keyset по users.id), записи уведомлений вставляются одним
+INSERT на пачку, доступ истекших пользователей закрывается несколькими UPDATE
+на пачку, а удаление клиентов из 3x-UI ставится в outbox (core.panel_outbox).
+
+ExpiryScheduler дает точность до секунд без частого сканирования: он держит в
+памяти min-heap ближайших дедлайнов (subscription_ends_at минус 3 дня, 1 день и
+0), подгружая их по индексу на EXPIRY_HORIZON вперед, и просыпается ровно к
+следующему. Новые сроки (покупка, продление) приходят через Postgres NOTIFY
+(notify_subscription_deadline в транзакции изменения), поэтому работают и когда
+планировщик запущен в отдельном процессе core.worker. Ежечасная полная проверка
+остается страховкой.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Sequence
+
+from sqlalchemy import exists, func, insert, select, text, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from core.db import session as db_session
+from core.db.models import (
+    Server,
+    Subscription,
+    SubscriptionNotification,
+    SubscriptionStatus,
+    User,
+    VpnCredential,
+)
+from core.panel_outbox import OP_REMOVE_CLIENT, client_email_for, enqueue_panel_op
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_3_DAYS = "3_days"
+NOTIFY_1_DAY = "1_day"
+NOTIFY_EXPIRED = "expired"
+
+# Вид уведомления -> окно (нижняя граница, верхняя граница] времени до истечения
+NOTIFICATION_WINDOWS: dict[str, tuple[timedelta | None, timedelta]] = {
+    NOTIFY_3_DAYS: (timedelta(days=1), timedelta(days=3)),
+    NOTIFY_1_DAY: (timedelta(0), timedelta(days=1)),
+    NOTIFY_EXPIRED: (None, timedelta(0)),
+}
+
+EXPIRY_BATCH_SIZE = 1000
+
+# На сколько вперед дедлайны держатся в памяти и как часто (не реже) планировщик просыпается
+EXPIRY_HORIZON = timedelta(hours=6)
+EXPIRY_MAX_SLEEP = 300.0
+# Запас к пробуждению: проверки окон должны увидеть дедлайн уже наступившим
+EXPIRY_WAKE_SLACK = 0.5
+DEADLINE_CHANNEL = "subscription_deadlines"
+
+
+def _shift(session: AsyncSession, column: Any, delta: timedelta) -> Any:
+    """column - delta в SQL"""
+    if session.bind.dialect.name == "postgresql":
+        return column - delta
+    # SQLite (локальные тесты): время хранится строкой в UTC
+    return func.datetime(column, f"-{int(delta.total_seconds())} seconds")
+
+
+def _active_subscription_id() -> Any:
+    """ID активной подписки пользователя (коррелированный подзапрос для выборок по users)"""
+    return (
+        select(func.max(Subscription.id))
+        .where(Subscription.user_id == User.id)
+        .where(Subscription.status == SubscriptionStatus.active)
+        .scalar_subquery()
+    )
+
+
+async def find_notification_batch(
+    session: AsyncSession,
+    kind: str,
+    now: datetime,
+    after_user_id: int = 0,
+    limit: int = EXPIRY_BATCH_SIZE,
+    user_ids: Sequence[int] | None = None,
+) -> Sequence[Any]:
+    """
+    Пользователи, которым нужно уведомление kind и которые его еще не получали
+
+    Args:
+        session: Сессия БД
+        kind: NOTIFY_3_DAYS, NOTIFY_1_DAY или NOTIFY_EXPIRED
+        now: Текущее время (UTC)
+        after_user_id: Последний users.id предыдущей пачки
+        limit: Размер пачки
+        user_ids: Проверить только этих пользователей (None — всех)
+
+    Returns:
+        Строки (id, tg_id, subscription_ends_at, subscription_id), по возрастанию id
+    """
+    lower, upper = NOTIFICATION_WINDOWS[kind]
+    already_sent = exists().where(
+        SubscriptionNotification.user_id == User.id,
+        SubscriptionNotification.notification_type == kind,
+        SubscriptionNotification.sent_at >= _shift(session, User.subscription_ends_at, upper),
+    )
+    stmt = (
+        select(User.id, User.tg_id, User.subscription_ends_at, _active_subscription_id().label("subscription_id"))
+        .where(User.has_active_subscription == True)
+        .where(User.subscription_ends_at <= now + upper)
+        .where(User.id > after_user_id)
+        .where(~already_sent)
+        .order_by(User.id)
+        .limit(limit)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(User.id.in_(user_ids))
+    if lower is not None:
+        stmt = stmt.where(User.subscription_ends_at > now + lower)
+    else:
+        # Об истечении с автопродлением сообщает само автопродление (успех или нехватка средств)
+        stmt = stmt.where(User.auto_renew_subscription == False)
+    return (await session.execute(stmt)).all()
+
+
+async def record_notifications(session: AsyncSession, kind: str, rows: Sequence[Any], now: datetime) -> None:
+    """Записать отправку уведомления kind пачке пользователей одним INSERT"""
+    if not rows:
+        return
+    await session.execute(
+        insert(SubscriptionNotification),
+        [
+            {
+                "user_id": row.id,
+                "subscription_id": row.subscription_id,
+                "notification_type": kind,
+                "sent_at": now,
+            }
+            for row in rows
+        ],
+    )
+
+
+async def find_expired_batch(
+    session: AsyncSession,
+    now: datetime,
+    after_user_id: int = 0,
+    limit: int = EXPIRY_BATCH_SIZE,
+    user_ids: Sequence[int] | None = None,
+    auto_renew: bool | None = None,
+) -> list[User]:
+    """
+    Пользователи с отмеченной активной подпиской, срок которой уже прошел (по возрастанию id)
+
+    Args:
+        auto_renew: Только с включенным (True) или выключенным (False) автопродлением; None — все
+    """
+    stmt = (
+        select(User)
+        .where(User.has_active_subscription == True)
+        .where(User.subscription_ends_at <= now)
+        .where(User.id > after_user_id)
+        .order_by(User.id)
+        .limit(limit)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(User.id.in_(user_ids))
+    if auto_renew is not None:
+        stmt = stmt.where(User.auto_renew_subscription == auto_renew)
+    users = await session.scalars(stmt)
+    return list(users.all())
+
+
+async def expire_users(session: AsyncSession, user_ids: Sequence[int], now: datetime) -> int:
+    """
+    Закрыть доступ пользователям с истекшей подпиской (commit делает вызывающий код)
+
+    Подписки со сроком в прошлом получают статус expired, активные credentials
+    выключаются, клиенты 3x-UI ставятся на удаление в outbox, а у пользователей
+    сбрасываются has_active_subscription, subscription_ends_at и выбранный сервер.
+
+    Returns:
+        Сколько клиентов 3x-UI поставлено на удаление
+    """
+    if not user_ids:
+        return 0
+
+    await session.execute(
+        update(Subscription)
+        .where(Subscription.user_id.in_(user_ids))
+        .where(Subscription.status == SubscriptionStatus.active)
+        .where(Subscription.ends_at <= now)
+        .values(status=SubscriptionStatus.expired)
+        # Подписки в сессии не синхронизируем: после закрытия доступа они не используются
+        .execution_options(synchronize_session=False)
+    )
+
+    panel_clients = await session.execute(
+        select(VpnCredential.server_id, User.tg_id)
+        .join(User, User.id == VpnCredential.user_id)
+        .join(Server, Server.id == VpnCredential.server_id)
+        .where(VpnCredential.user_id.in_(user_ids))
+        .where(VpnCredential.active == True)
+        .where(Server.x3ui_api_url.isnot(None))
+        .where(Server.x3ui_username.isnot(None))
+        .where(Server.x3ui_password.isnot(None))
+        .distinct()
+    )
+    removed = 0
+    for server_id, tg_id in panel_clients.all():
+        await enqueue_panel_op(
+            session,
+            server_id=server_id,
+            operation=OP_REMOVE_CLIENT,
+            client_email=client_email_for(tg_id, server_id),
+        )
+        removed += 1
+
+    await session.execute(
+        update(VpnCredential)
+        .where(VpnCredential.user_id.in_(user_ids))
+        .where(VpnCredential.active == True)
+        .values(active=False)
+    )
+    await session.execute(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(has_active_subscription=False, subscription_ends_at=None, selected_server_id=None)
+    )
+    return removed
+
+
+def _aware(value: datetime) -> datetime:
+    # SQLite (локальные тесты) возвращает время без зоны
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _deadlines(ends_at: datetime) -> list[datetime]:
+    """Моменты, когда у подписки со сроком ends_at меняется окно уведомлений"""
+    return [ends_at - upper for upper in {upper for _, upper in NOTIFICATION_WINDOWS.values()}]
+
+
+async def notify_subscription_deadline(session: AsyncSession, user_id: int, ends_at: datetime | None) -> None:
+    """
+    Сообщить планировщику сроков о новом сроке подписки
+
+    На Postgres — NOTIFY в транзакции сессии (доставляется после commit, в том числе
+    в процесс core.worker), иначе — напрямую планировщику этого процесса.
+    """
+    if ends_at is None:
+        return
+    if session.bind.dialect.name == "postgresql":
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": DEADLINE_CHANNEL, "payload": f"{user_id}:{_aware(ends_at).timestamp()}"},
+        )
+    else:
+        expiry_scheduler.schedule(user_id, ends_at)
+
+
+ExpiryHandler = Callable[[list[int]], Awaitable[Any]]
+
+
+class ExpiryScheduler:
+    """Ближайшие дедлайны подписок в min-heap и пробуждение ровно к следующему"""
+
+    def __init__(
+        self,
+        horizon: timedelta = EXPIRY_HORIZON,
+        batch_size: int = EXPIRY_BATCH_SIZE,
+        max_sleep: float = EXPIRY_MAX_SLEEP,
+    ):
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        self._heap: list[tuple[datetime, int]] = []
+        self._queued: set[tuple[datetime, int]] = set()
+        # Дедлайны до этого момента уже в куче (None — еще не загружались)
+        self._loaded_until: datetime | None = None
+        self._wakeup = asyncio.Event()
+        self._listener: AsyncConnection | None = None
+
+    def schedule(self, user_id: int, ends_at: datetime) -> None:
+        """Добавить дедлайны нового срока подписки, попадающие в загруженный горизонт"""
+        if self._loaded_until is None:
+            return
+        head = self._heap[0][0] if self._heap else None
+        for deadline in _deadlines(_aware(ends_at)):
+            if deadline <= self._loaded_until:
+                self._push(deadline, user_id)
+        if self._heap and (head is None or self._heap[0][0] < head):
+            self._wakeup.set()
+
+    def _push(self, deadline: datetime, user_id: int) -> None:
+        entry = (deadline, user_id)
+        if entry not in self._queued:
+            self._queued.add(entry)
+            heapq.heappush(self._heap, entry)
+
+    async def _load(self, since: datetime, until: datetime) -> None:
+        """Загрузить по индексу subscription_ends_at дедлайны из (since, until]"""
+        async with db_session.SessionLocal() as session:
+            for _, upper in NOTIFICATION_WINDOWS.values():
+                rows = await session.execute(
+                    select(User.id, User.subscription_ends_at)
+                    .where(User.has_active_subscription == True)
+                    .where(User.subscription_ends_at > since + upper)
+                    .where(User.subscription_ends_at <= until + upper)
+                )
+                for user_id, ends_at in rows.all():
+                    self._push(_aware(ends_at) - upper, user_id)
+        self._loaded_until = until
+
+    def _on_notify(self, connection: Any, pid: int, channel: str, payload: str) -> None:
+        try:
+            user_id, timestamp = payload.split(":", 1)
+            self.schedule(int(user_id), datetime.fromtimestamp(float(timestamp), tz=timezone.utc))
+        except ValueError:
+            logger.warning(f"Некорректное уведомление о сроке подписки: {payload!r}")
+
+    async def _ensure_listener(self) -> bool:
+        """LISTEN на канале сроков; False — соединение (пере)создано и горизонт надо загрузить заново"""
+        if db_session.engine.dialect.name != "postgresql":
+            return True
+        if self._listener is not None and not self._listener.closed:
+            raw = await self._listener.get_raw_connection()
+            if not raw.driver_connection.is_closed():
+                return True
+        await self.close()
+        conn = await db_session.engine.connect()
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.add_listener(DEADLINE_CHANNEL, self._on_notify)
+        self._listener = conn
+        return False
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            # Соединение с LISTEN не возвращаем в пул
+            try:
+                await self._listener.invalidate()
+            except Exception:
+                pass
+            self._listener = None
+
+    async def run_once(self, handler: ExpiryHandler) -> bool:
+        """
+        Обработать наступившие дедлайны и дождаться следующего
+
+        Args:
+            handler: Обработка пачки пользователей (уведомления, продление, закрытие доступа)
+
+        Returns:
+            True — планировщик задач сразу запускает следующий цикл
+        """
+        now = datetime.now(timezone.utc)
+        if not await self._ensure_listener():
+            # Пока слушателя не было, уведомления терялись: перечитываем горизонт
+            self._loaded_until = None
+        if self._loaded_until is None or self._loaded_until - now < self.horizon / 2:
+            await self._load(self._loaded_until or now, now + self.horizon)
+
+        due: list[int] = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            self._queued.discard(entry)
+            due.append(entry[1])
+        due = list(dict.fromkeys(due))
+        for start in range(0, len(due), self.batch_size):
+            await handler(due[start:start + self.batch_size])
+        if due:
+            logger.info(f"Сроки подписок: обработано пользователей {len(due)}")
+
+        now = datetime.now(timezone.utc)
+        wake_at = self._loaded_until - self.horizon / 2
+        if self._heap:
+            wake_at = min(wake_at, self._heap[0][0])
+        delay = min(max((wake_at - now).total_seconds(), 0.0) + EXPIRY_WAKE_SLACK, self.max_sleep)
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        return True
+
+
+expiry_scheduler = ExpiryScheduler()
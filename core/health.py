@@ -0,0 +1,398 @@
+"""
+Проверка доступности серверов сериями проб
+
+Каждый сервер за раунд получает несколько проб (ICMP ping через асинхронный
+subprocess или TCP connect), по ним считаются min/avg/p95 задержки, jitter и потери.
+Типы проб подключаются через register_probe: пробы доступности (icmp, tcp) идут
+цепочкой до первой ответившей, дополнительные (panel — API 3x-UI) — параллельно.
+Серверы проверяются параллельно с ограничением PROBE_CONCURRENCY, поэтому раунд
+длится примерно как проверка одного самого медленного сервера, а не их сумма.
+Результаты раунда сохраняются в server_status одним INSERT (run_health_round).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import re
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Sequence
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.db.models import Server, ServerStatus, VpnCredential
+from core.panel_executor import panel_executor
+from core.x3ui_registry import x3ui_registry
+
+logger = logging.getLogger(__name__)
+
+PROBE_SAMPLES = 5
+# Таймаут одной пробы (секунды)
+PROBE_TIMEOUT = 2.0
+# Пауза между пробами серии (0.2 — минимум для ping без root)
+PROBE_INTERVAL = 0.2
+PROBE_CONCURRENCY = 32
+# Порт TCP-проб, если в host сервера порт не указан
+DEFAULT_TCP_PORT = 443
+
+METHOD_ICMP = "icmp"
+METHOD_TCP = "tcp"
+METHOD_PANEL = "panel"
+
+# Пробы доступности: выполняются по порядку до первой, получившей ответ
+AVAILABILITY_PROBES = (METHOD_ICMP, METHOD_TCP)
+# Дополнительные пробы: выполняются для каждого сервера параллельно с доступностью
+EXTRA_PROBES = (METHOD_PANEL,)
+PANEL_PROBE_TIMEOUT = 10.0
+
+_PING_TIME_RE = re.compile(r"time[=<]\s*([\d.]+)\s*ms")
+
+
+class ProbeResult:
+    """Итог серии проб одного сервера"""
+
+    def __init__(self, server_id: int, method: str, sent: int, rtts: list[float], error: str | None = None):
+        self.server_id = server_id
+        self.method = method
+        self.sent = sent
+        self.rtts = rtts
+        self.error = error
+        self.checked_at = datetime.now(timezone.utc)
+
+    @property
+    def is_online(self) -> bool:
+        return bool(self.rtts)
+
+    @property
+    def loss_percent(self) -> float:
+        if self.sent <= 0:
+            return 100.0
+        return round(100.0 * (self.sent - len(self.rtts)) / self.sent, 2)
+
+    @property
+    def min_ms(self) -> float | None:
+        return round(min(self.rtts), 2) if self.rtts else None
+
+    @property
+    def avg_ms(self) -> float | None:
+        return round(sum(self.rtts) / len(self.rtts), 2) if self.rtts else None
+
+    @property
+    def p95_ms(self) -> float | None:
+        if not self.rtts:
+            return None
+        # Nearest-rank: при 5 пробах это максимум, при 20 — 19-я по величине
+        ordered = sorted(self.rtts)
+        return round(ordered[max(math.ceil(0.95 * len(ordered)) - 1, 0)], 2)
+
+    @property
+    def jitter_ms(self) -> float | None:
+        # Среднее абсолютное отклонение соседних задержек (в порядке отправки)
+        if len(self.rtts) < 2:
+            return None
+        deltas = [abs(b - a) for a, b in zip(self.rtts, self.rtts[1:])]
+        return round(sum(deltas) / len(deltas), 2)
+
+    def error_message(self) -> str | None:
+        if self.is_online:
+            return None
+        return self.error or f"{self.method} probe: no replies ({self.sent} sent)"
+
+    def to_dict(self) -> dict[str, Any]:
+        avg = self.avg_ms
+        return {
+            "is_online": self.is_online,
+            "response_time_ms": int(round(avg)) if avg is not None else None,
+            "error_message": self.error_message(),
+            "probe_method": self.method,
+            "probe_samples": self.sent,
+            "latency_min_ms": self.min_ms,
+            "latency_avg_ms": avg,
+            "latency_p95_ms": self.p95_ms,
+            "jitter_ms": self.jitter_ms,
+            "packet_loss_percent": self.loss_percent,
+        }
+
+    def to_status_row(self, **extra: Any) -> dict[str, Any]:
+        """Строка для INSERT в server_status"""
+        return {"server_id": self.server_id, **self.to_dict(), "checked_at": self.checked_at, **extra}
+
+
+def server_probe_target(server: Server) -> tuple[str, int | None]:
+    """Хост и порт (если указан) из Server.host вида host[:port][/path]"""
+    host = server.host.strip().split("/")[0]
+    if ":" in host:
+        host, _, port = host.partition(":")
+        if port.isdigit():
+            return host, int(port)
+    return host, None
+
+
+async def icmp_probe(host: str, samples: int, timeout: float = PROBE_TIMEOUT) -> list[float]:
+    """
+    Серия ICMP ping одним процессом ping
+
+    Returns:
+        Задержки ответивших проб в мс (в порядке отправки)
+
+    Raises:
+        FileNotFoundError / PermissionError: если ping недоступен в системе
+    """
+    process = await asyncio.create_subprocess_exec(
+        "ping", "-n", "-c", str(samples), "-i", str(PROBE_INTERVAL), "-W", str(max(int(math.ceil(timeout)), 1)), host,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(
+            process.communicate(), timeout=samples * PROBE_INTERVAL + timeout + 2
+        )
+    except asyncio.TimeoutError:
+        process.kill()
+        stdout, _ = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+    return [float(value) for value in _PING_TIME_RE.findall(stdout.decode(errors="replace"))][:samples]
+
+
+async def tcp_probe(host: str, port: int, samples: int, timeout: float = PROBE_TIMEOUT) -> list[float]:
+    """
+    Серия TCP connect к host:port
+
+    Returns:
+        Время установки соединения успешных проб в мс
+    """
+    rtts: list[float] = []
+    for attempt in range(samples):
+        if attempt:
+            await asyncio.sleep(PROBE_INTERVAL)
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+        except (OSError, asyncio.TimeoutError):
+            continue
+        rtts.append((time.perf_counter() - start) * 1000)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+    return rtts
+
+
+ProbeFn = Callable[[Server, int, float], Awaitable["ProbeResult | None"]]
+
+# Зарегистрированные типы проб: имя -> функция (server, samples, timeout).
+# Функция возвращает None, если проба к серверу неприменима.
+PROBES: dict[str, ProbeFn] = {}
+
+
+def register_probe(name: str) -> Callable[[ProbeFn], ProbeFn]:
+    """Зарегистрировать тип пробы под именем name"""
+    def decorator(func: ProbeFn) -> ProbeFn:
+        PROBES[name] = func
+        return func
+    return decorator
+
+
+@register_probe(METHOD_ICMP)
+async def icmp_server_probe(server: Server, samples: int, timeout: float) -> ProbeResult:
+    host, _ = server_probe_target(server)
+    return ProbeResult(server.id, METHOD_ICMP, samples, await icmp_probe(host, samples, timeout))
+
+
+@register_probe(METHOD_TCP)
+async def tcp_server_probe(server: Server, samples: int, timeout: float) -> ProbeResult:
+    # Порт из host, иначе порт Xray: ICMP часто фильтруется, а VPN-порт открыт всегда
+    host, port = server_probe_target(server)
+    port = port or server.xray_port or DEFAULT_TCP_PORT
+    return ProbeResult(server.id, METHOD_TCP, samples, await tcp_probe(host, port, samples, timeout))
+
+
+@register_probe(METHOD_PANEL)
+async def panel_server_probe(server: Server, samples: int, timeout: float) -> ProbeResult | None:
+    # Один запрос к API панели через общий клиент и circuit breaker сервера
+    if not server.x3ui_api_url or not server.x3ui_username or not server.x3ui_password:
+        return None
+    start = time.perf_counter()
+    try:
+        x3ui = await x3ui_registry.get(server)
+        ok = await panel_executor.run(server.id, x3ui.ping, timeout=PANEL_PROBE_TIMEOUT)
+    except Exception as e:
+        return ProbeResult(server.id, METHOD_PANEL, 1, [], error=(str(e) or type(e).__name__)[:200])
+    rtt = (time.perf_counter() - start) * 1000
+    return ProbeResult(server.id, METHOD_PANEL, 1, [rtt] if ok else [], error=None if ok else "panel_api_error")
+
+
+class ServerHealth:
+    """Результаты всех проб одного сервера за раунд"""
+
+    def __init__(self, server_id: int, availability: ProbeResult, extras: dict[str, ProbeResult]):
+        self.server_id = server_id
+        self.availability = availability
+        self.extras = extras
+
+    @property
+    def panel(self) -> ProbeResult | None:
+        return self.extras.get(METHOD_PANEL)
+
+    def to_dict(self) -> dict[str, Any]:
+        panel = self.panel
+        return {
+            **self.availability.to_dict(),
+            "panel_reachable": panel.is_online if panel else None,
+            "panel_response_ms": int(round(panel.avg_ms)) if panel and panel.avg_ms is not None else None,
+        }
+
+    def to_status_row(self, **extra: Any) -> dict[str, Any]:
+        """Строка для INSERT в server_status"""
+        return {
+            "server_id": self.server_id,
+            **self.to_dict(),
+            "checked_at": self.availability.checked_at,
+            **extra,
+        }
+
+
+async def _run_probe(name: str, server: Server, samples: int, timeout: float) -> ProbeResult | None:
+    try:
+        return await PROBES[name](server, samples, timeout)
+    except (FileNotFoundError, PermissionError):
+        # Утилита пробы недоступна в системе (например, нет ping в контейнере)
+        logger.debug(f"Проба {name} недоступна, пропускаем для {server.name}")
+        return None
+    except Exception as e:
+        return ProbeResult(server.id, name, samples, [], error=(str(e) or type(e).__name__)[:200])
+
+
+async def probe_server(
+    server: Server,
+    samples: int = PROBE_SAMPLES,
+    timeout: float = PROBE_TIMEOUT,
+    availability_probes: Sequence[str] = AVAILABILITY_PROBES,
+    extra_probes: Sequence[str] = EXTRA_PROBES,
+) -> ServerHealth:
+    """
+    Все пробы одного сервера
+
+    Пробы доступности выполняются по порядку до первой, получившей ответ
+    (по умолчанию ICMP, затем TCP connect). Дополнительные пробы (API панели)
+    идут параллельно с ними.
+    """
+    async def availability() -> ProbeResult:
+        result = None
+        for name in availability_probes:
+            result = await _run_probe(name, server, samples, timeout) or result
+            if result is not None and result.is_online:
+                break
+        return result or ProbeResult(server.id, "none", 0, [], error="no_probe_available")
+
+    extra_names = list(extra_probes)
+    results = await asyncio.gather(
+        availability(), *(_run_probe(name, server, samples, timeout) for name in extra_names)
+    )
+    extras = {name: result for name, result in zip(extra_names, results[1:]) if result is not None}
+    return ServerHealth(server.id, results[0], extras)
+
+
+async def probe_servers(
+    servers: list[Server],
+    samples: int = PROBE_SAMPLES,
+    timeout: float = PROBE_TIMEOUT,
+    concurrency: int = PROBE_CONCURRENCY,
+) -> dict[int, ServerHealth]:
+    """
+    Проверить серверы параллельно (не более concurrency одновременно)
+
+    Returns:
+        {server_id: ServerHealth}; сбой проверки сервера превращается в результат с error
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    # Все пробы доступности по таймауту плюс запас
+    round_timeout = len(AVAILABILITY_PROBES) * samples * (timeout + PROBE_INTERVAL) + 5
+
+    def failed(server: Server, error: str) -> ServerHealth:
+        return ServerHealth(server.id, ProbeResult(server.id, "none", samples, [], error=error), {})
+
+    async def run(server: Server) -> ServerHealth:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(probe_server(server, samples, timeout), timeout=round_timeout)
+            except asyncio.TimeoutError:
+                return failed(server, "probe_timeout")
+            except Exception as e:
+                logger.error(f"Ошибка проверки сервера {server.name}: {e}")
+                return failed(server, (str(e) or type(e).__name__)[:200])
+
+    results = await asyncio.gather(*(run(server) for server in servers))
+    return {result.server_id: result for result in results}
+
+
+async def save_probe_results(
+    session: AsyncSession,
+    results: list[ServerHealth],
+    extra: dict[int, dict[str, Any]] | None = None,
+) -> int:
+    """
+    Записать результаты раунда в server_status одним INSERT (commit делает вызывающий код)
+
+    Args:
+        session: Сессия БД
+        results: Результаты проб
+        extra: Дополнительные поля по server_id (например, active_connections)
+    """
+    rows = [result.to_status_row(**(extra or {}).get(result.server_id, {})) for result in results]
+    if rows:
+        await session.execute(insert(ServerStatus), rows)
+    return len(rows)
+
+
+async def run_health_round() -> int:
+    """
+    Один раунд проверки всех включенных серверов
+
+    Единственный путь записи server_status: пробы, затем один INSERT
+    (агрегаты и хранение — core.status_history).
+    Соединение с БД не удерживается, пока идут пробы.
+
+    Returns:
+        Сколько серверов проверено
+    """
+    from core.db.session import SessionLocal
+
+    async with SessionLocal() as session:
+        servers = list((await session.scalars(select(Server).where(Server.is_enabled == True))).all())
+        connection_rows = await session.execute(
+            select(VpnCredential.server_id, func.count())
+            .where(VpnCredential.active == True)
+            .group_by(VpnCredential.server_id)
+        )
+        active_connections = dict(connection_rows.all())
+
+    if not servers:
+        return 0
+
+    results = await probe_servers(servers)
+    for server in servers:
+        health = results[server.id]
+        probe = health.availability
+        panel = health.panel
+        logger.info(
+            f"Проверка {server.name}: online={probe.is_online} ({probe.method}), avg={probe.avg_ms}ms, "
+            f"p95={probe.p95_ms}ms, jitter={probe.jitter_ms}ms, loss={probe.loss_percent}%"
+            + (f", панель={'ok' if panel.is_online else panel.error_message()}" if panel else "")
+        )
+
+    async with SessionLocal() as session:
+        checked = await save_probe_results(
+            session,
+            list(results.values()),
+            extra={server.id: {"active_connections": active_connections.get(server.id, 0)} for server in servers},
+        )
+        await session.commit()
+    return checked
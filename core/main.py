@@ -6,7 +6,7 @@ import io
 import secrets
 import string
 from typing import Sequence
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import asyncio
 import logging
 from openpyxl import Workbook
@@ -32,7 +32,7 @@ import hashlib
 import hmac
 import time
 from datetime import datetime, timezone
-from sqlalchemy import select, func, text, or_
+from sqlalchemy import select, func, text, or_, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
@@ -63,12 +63,61 @@ from core.db.models import (
     Server,
     ServerStatus,
     Backup,
+    Broadcast,
     VpnCredential,
     IpLog,
     UserBan,
-    SubscriptionNotification,
 )
 from core.xray import generate_vless_config, generate_uuid
+from core.x3ui_registry import x3ui_registry
+from core.panel_executor import panel_executor
+from core.reconcile import reconcile_server, reconcile_servers
+from core.health import probe_server, run_health_round
+from core.broadcast import (
+    BROADCAST_CANCELLED,
+    BROADCAST_PARSE_MODES,
+    BROADCAST_PAUSED,
+    BROADCAST_RUNNING,
+    SEGMENT_SERVER,
+    SEGMENTS,
+    broadcast_snapshot,
+    create_broadcast,
+    run_broadcast_batch,
+    set_broadcast_status,
+)
+from core.delayed_jobs import enqueue_delayed_job, process_delayed_jobs, register_delayed_job
+from core.expiry import (
+    NOTIFICATION_WINDOWS,
+    NOTIFY_1_DAY,
+    NOTIFY_EXPIRED,
+    expire_users,
+    expiry_scheduler,
+    find_expired_batch,
+    find_notification_batch,
+    notify_subscription_deadline,
+    record_notifications,
+)
+from core.renewal import (
+    NO_FUNDS,
+    NO_SUBSCRIPTION,
+    RENEWED,
+    SKIPPED,
+    RenewalOutcome,
+    load_active_plans,
+    renew_chunk,
+    count_outcomes,
+)
+from core.telegram_dispatcher import TelegramSendError, telegram_dispatcher
+from core.status_history import latest_statuses, load_server_history, maintain_status_history
+from core.scheduler import JobScheduler, job_scheduler
+from core.panel_outbox import (
+    OP_ENSURE_CLIENT,
+    OP_REMOVE_CLIENT,
+    PANEL_STATUS_PENDING,
+    client_email_for,
+    enqueue_panel_op,
+    process_panel_outbox,
+)
 from core.schemas import (
     PaymentCreateIn,
     PaymentWebhookIn,
@@ -86,6 +135,8 @@ from core.schemas import (
     ServerCreateIn,
     ServerUpdateIn,
     ServerOut,
+    ServerProvisionIn,
+    ServerReconcileIn,
 )
 
 settings = get_settings()
@@ -256,182 +307,285 @@ async def _test_connection_speed(server: Server) -> float | None:
         return None
 
 
-async def _check_server_status(server: Server) -> dict:
-    """
-    Максимально простая проверка: ping IP адреса
+async def _close_old_pending_payments():
     """
-    import subprocess
-    import time
-    
-    # Берем только IP адрес из host (убираем порт если есть)
-    host = server.host.split(':')[0].split('/')[0].strip()
+    Закрывает платежи со статусом pending, которые созданы больше часа назад
     
-    logger.info(f"Проверка сервера {server.name}: ping {host}")
-    
-    try:
-        start_time = time.time()
-        
-        # Простой ping: ping -c 1 -W 5 IP
-        ping_cmd = ['ping', '-c', '1', '-W', '5', host]
-        
-        # Выполняем ping
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: subprocess.run(ping_cmd, capture_output=True, text=True, timeout=10)
-        )
-        
-        response_time_ms = int((time.time() - start_time) * 1000)
-        
-        # Детальное логирование для отладки
-        logger.info(f"Ping результат для {server.name} ({host}): returncode={result.returncode}, stdout={result.stdout[:200]}, stderr={result.stderr[:200]}")
-        
-        # Проверяем результат: returncode == 0 означает успех
-        is_online = result.returncode == 0
-        
-        # Дополнительная проверка: если returncode != 0, но в stdout есть "1 received" или "time=", считаем онлайн
-        if not is_online and result.stdout:
-            stdout_lower = result.stdout.lower()
-            if "1 received" in stdout_lower or "time=" in stdout_lower or "ttl=" in stdout_lower:
-                logger.warning(f"Ping вернул returncode={result.returncode}, но похоже что ответ получен. Считаем онлайн.")
-                is_online = True
-        
-        if is_online:
-            logger.info(f"✅ Сервер {server.name} ({host}): онлайн, время={response_time_ms}ms")
-        else:
-            logger.warning(f"❌ Сервер {server.name} ({host}): оффлайн, время={response_time_ms}ms, returncode={result.returncode}")
-        
-        return {
-            "is_online": is_online,
-            "response_time_ms": response_time_ms,
-            "connection_speed_mbps": None,
-            "error_message": None if is_online else f"Ping {host} failed (returncode={result.returncode})",
-        }
-    except Exception as e:
-        logger.error(f"Ошибка при ping {host}: {e}", exc_info=True)
-        return {
-            "is_online": False,
-            "response_time_ms": None,
-            "connection_speed_mbps": None,
-            "error_message": str(e),
-        }
-
-
-async def _close_old_pending_payments():
-    """Закрывает платежи со статусом pending, которые созданы больше часа назад"""
+    Одно UPDATE ... RETURNING (с tg_id пользователя) закрывает все такие платежи сразу, затем один
+    INSERT пишет по записи AuditLog на платеж — число запросов не зависит от числа платежей.
+    """
     from core.db.session import SessionLocal
     from datetime import timedelta, timezone
+    from sqlalchemy import insert
     import logging
     
     async with SessionLocal() as session:
         try:
-            # Находим все pending платежи старше 1 часа
             now_utc = datetime.now(timezone.utc)
             one_hour_ago = now_utc - timedelta(hours=1)
             logging.info(f"Checking for pending payments older than {one_hour_ago} (UTC)")
             
-            old_pending = await session.scalars(
-                select(Payment)
-                .where(
-                    Payment.status == PaymentStatus.pending,
-                    Payment.created_at < one_hour_ago
-                )
-            )
-            
-            payments_list = old_pending.all()
-            logging.info(f"Found {len(payments_list)} old pending payments to close")
-            
-            closed_count = 0
-            for payment in payments_list:
-                old_status = payment.status
-                payment.status = PaymentStatus.failed
-                
-                # Логируем закрытие
-                user = await session.scalar(select(User).where(User.id == payment.user_id))
-                amount_rub = payment.amount_cents / 100
-                age_hours = (now_utc - payment.created_at).total_seconds() / 3600
-                logging.info(f"Closing payment #{payment.id}: created_at={payment.created_at}, age={age_hours:.2f} hours")
-                
-                session.add(
-                    AuditLog(
-                        action=AuditLogAction.payment_status_changed,
-                        user_tg_id=user.tg_id if user else None,
-                        admin_tg_id=None,
-                        details=f"Платеж #{payment.id} автоматически закрыт (pending > 1 часа). Статус: {old_status.value} -> failed. Провайдер: {payment.provider}, сумма: {amount_rub:.2f} RUB ({payment.currency})",
-                    )
+            # tg_id — коррелированным подзапросом: SQLite не отдает в RETURNING колонки таблиц из FROM
+            user_tg_id = select(User.tg_id).where(User.id == Payment.user_id).scalar_subquery()
+            closed = (await session.execute(
+                update(Payment)
+                .where(Payment.status == PaymentStatus.pending)
+                .where(Payment.created_at < one_hour_ago)
+                .values(status=PaymentStatus.failed)
+                .returning(
+                    Payment.id,
+                    Payment.provider,
+                    Payment.amount_cents,
+                    Payment.currency,
+                    Payment.created_at,
+                    user_tg_id.label("tg_id"),
                 )
-                closed_count += 1
+                .execution_options(synchronize_session=False)
+            )).all()
             
-            if closed_count > 0:
-                await session.commit()
-                logging.info(f"✅ Successfully closed {closed_count} old pending payments")
-            else:
+            if not closed:
                 logging.info("No old pending payments to close")
+                return
+            
+            await session.execute(insert(AuditLog), [
+                {
+                    "action": AuditLogAction.payment_status_changed,
+                    "user_tg_id": payment.tg_id,
+                    "admin_tg_id": None,
+                    "details": (
+                        f"Платеж #{payment.id} автоматически закрыт (pending > 1 часа). "
+                        f"Статус: {PaymentStatus.pending.value} -> failed. Провайдер: {payment.provider}, "
+                        f"сумма: {payment.amount_cents / 100:.2f} RUB ({payment.currency})"
+                    ),
+                    "created_at": now_utc,
+                }
+                for payment in closed
+            ])
+            await session.commit()
+            logging.info(f"✅ Successfully closed {len(closed)} old pending payments")
         except Exception as e:
             logging.error(f"Error in _close_old_pending_payments: {e}", exc_info=True)
             await session.rollback()
 
 
-async def _check_servers_health():
-    """Проверка состояния серверов"""
+# Сколько наблюдений IP записывается одним INSERT (лимит параметров запроса в Postgres)
+IP_LOG_UPSERT_CHUNK = 1000
+
+
+async def _upsert_ip_logs(session: AsyncSession, observations: list[dict]) -> None:
+    """
+    Записывает наблюдения IP пачками INSERT ... ON CONFLICT DO UPDATE
+    
+    Новый IP добавляется, у известного обновляются last_seen и connection_count + 1.
+    
+    Args:
+        session: Сессия БД (commit делает вызывающий код)
+        observations: Строки ip_logs (user_id, server_id, ip_address, first_seen, last_seen, connection_count),
+            без повторов (user_id, server_id, ip_address)
+    """
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+    
+    insert_for_dialect = pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+    for start in range(0, len(observations), IP_LOG_UPSERT_CHUNK):
+        stmt = insert_for_dialect(IpLog).values(observations[start:start + IP_LOG_UPSERT_CHUNK])
+        await session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["user_id", "server_id", "ip_address"],
+                set_={"last_seen": stmt.excluded.last_seen, "connection_count": IpLog.connection_count + 1},
+            )
+        )
+
+
+def _expiry_notification_text(kind: str, ends_at: datetime) -> str:
+    """Текст уведомления об истечении подписки (kind — вид из core.expiry)"""
+    from zoneinfo import ZoneInfo
+    
+    ends_str = ends_at.astimezone(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M")
+    if kind == NOTIFY_EXPIRED:
+        return (
+            f"⏰ <b>Подписка истекла</b>\n\n"
+            f"Ваша подписка закончилась {ends_str} МСК.\n\n"
+            f"Для продолжения использования VPN приобретите новую подписку в разделе '📦 Тарифы'."
+        )
+    if kind == NOTIFY_1_DAY:
+        return (
+            f"⏰ <b>Подписка скоро истечет</b>\n\n"
+            f"Ваша подписка закончится через <b>1 день</b> ({ends_str} МСК).\n\n"
+            f"Не забудьте продлить подписку, чтобы не потерять доступ к VPN."
+        )
+    return (
+        f"⏰ <b>Напоминание о подписке</b>\n\n"
+        f"Ваша подписка закончится через <b>3 дня</b> ({ends_str} МСК).\n\n"
+        f"Рекомендуем продлить подписку заранее."
+    )
+
+
+async def _send_user_notifications(messages: list[tuple[int, str]]) -> None:
+    """Ставит пачку уведомлений (tg_id, текст) в очередь отправки; при заполненной очереди ждет"""
+    for tg_id, text_message in messages:
+        await _send_user_notification(tg_id, text_message)
+
+
+def _auto_renew_notification_text(outcome: RenewalOutcome, plans: list[SubscriptionPlan]) -> str:
+    """Текст уведомления о результате автопродления (core.renewal)"""
+    from zoneinfo import ZoneInfo
+    
+    if outcome.status == RENEWED:
+        ends_str = outcome.new_ends_at.astimezone(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M")
+        notification_text = (
+            f"✅ <b>Подписка автоматически продлена</b>\n\n"
+            f"📦 Тариф: <b>{outcome.plan.name}</b>\n"
+            f"💰 Стоимость: {outcome.plan.price_cents / 100:.2f} RUB\n"
+        )
+        if outcome.plan_changed:
+            notification_text += (
+                f"⚠️ <b>Внимание:</b> Тариф изменен с '{outcome.original_plan.name}' на '{outcome.plan.name}' "
+                f"из-за недостатка средств на предыдущий тариф.\n\n"
+            )
+        notification_text += (
+            f"📅 Действует до: {ends_str} МСК\n"
+            f"💵 Остаток баланса: {outcome.balance / 100:.2f} RUB"
+        )
+        return notification_text
+    
+    if outcome.status == NO_SUBSCRIPTION:
+        return _expiry_notification_text(NOTIFY_EXPIRED, outcome.subscription_ends_at)
+    
+    ends_at = outcome.subscription_ends_at
+    ends_str = ends_at.astimezone(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M") if ends_at else "—"
+    notification_text = (
+        f"❌ <b>Автопродление не удалось</b>\n\n"
+        f"Ваша подписка истекла {ends_str} МСК.\n\n"
+        f"💵 Текущий баланс: <b>{outcome.balance / 100:.2f} RUB</b>\n"
+    )
+    if plans:
+        cheapest_plan = plans[0]
+        notification_text += (
+            f"💰 Минимальный тариф: <b>{cheapest_plan.name}</b> — {cheapest_plan.price_cents / 100:.2f} RUB\n\n"
+        )
+    notification_text += (
+        "Для продолжения использования VPN пополните баланс и приобретите подписку в разделе '📦 Тарифы'."
+    )
+    return notification_text
+
+
+async def _process_auto_renewals(user_ids: list[int] | None = None) -> None:
+    """
+    Продлевает истекшие подписки с автопродлением (core.renewal)
+    
+    Тарифы загружаются один раз за запуск, пользователи — пачками по EXPIRY_BATCH_SIZE,
+    одна транзакция на пачку; уведомления уходят после commit пачки.
+    
+    Args:
+        user_ids: Проверить только этих пользователей (дедлайны ExpiryScheduler); None — всех
+    """
     from core.db.session import SessionLocal
     
+    now = datetime.now(timezone.utc)
     async with SessionLocal() as session:
-        servers = await session.scalars(select(Server).where(Server.is_enabled == True))
+        plans = await load_active_plans(session)
+    
+    outcomes: list[RenewalOutcome] = []
+    after_user_id = 0
+    while True:
+        async with SessionLocal() as session:
+            users = await find_expired_batch(
+                session, now, after_user_id=after_user_id, user_ids=user_ids, auto_renew=True
+            )
+            if not users:
+                break
+            after_user_id = users[-1].id
+            chunk = await renew_chunk(session, users, plans, now)
+            await session.commit()
         
-        for server in servers.all():
-            try:
-                import httpx
-                import time
-                
-                start_time = time.time()
-                is_online = False
-                response_time_ms = None
-                error_message = None
-                
-                # Простая проверка доступности
-                try:
-                    # Пытаемся подключиться к серверу
-                    host_parts = server.host.split(":")
-                    host = host_parts[0]
-                    port = int(host_parts[1]) if len(host_parts) > 1 else 80
-                    
-                    # Проверка через socket
-                    import socket
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(5)
-                    result = sock.connect_ex((host, port))
-                    sock.close()
-                    is_online = result == 0
-                    
-                    elapsed = (time.time() - start_time) * 1000
-                    response_time_ms = int(elapsed)
-                except Exception as e:
-                    error_message = str(e)[:200]
-                    is_online = False
-                
-                # Получаем количество активных подключений
-                active_connections = await session.scalar(
-                    select(func.count())
-                    .select_from(VpnCredential)
-                    .where(VpnCredential.server_id == server.id, VpnCredential.active == True)
-                ) or 0
-                
-                # Создаем запись о статусе
-                status = ServerStatus(
-                    server_id=server.id,
-                    is_online=is_online,
-                    response_time_ms=response_time_ms,
-                    active_connections=active_connections,
-                    error_message=error_message,
-                )
-                session.add(status)
+        await _send_user_notifications([
+            (outcome.tg_id, _auto_renew_notification_text(outcome, plans))
+            for outcome in chunk
+            if outcome.status != SKIPPED
+        ])
+        outcomes.extend(chunk)
+    
+    if outcomes:
+        counts = count_outcomes(outcomes)
+        logging.info(
+            f"Auto-renew: renewed {counts[RENEWED]}, no funds {counts[NO_FUNDS]}, "
+            f"no subscription {counts[NO_SUBSCRIPTION]}, skipped {counts[SKIPPED]}"
+        )
+
+
+async def _check_expired_subscriptions(user_ids: list[int] | None = None) -> None:
+    """
+    Уведомляет об истечении подписок и закрывает доступ истекшим без автопродления
+    
+    Выбираются только пользователи в окнах «3 дня», «1 день» и «истекла»
+    (core.expiry): пачками по EXPIRY_BATCH_SIZE, одна транзакция на пачку.
+    Истекшие подписки с автопродлением обрабатывает _process_auto_renewals.
+    
+    Args:
+        user_ids: Проверить только этих пользователей (дедлайны ExpiryScheduler); None — всех
+    """
+    from core.db.session import SessionLocal
+    
+    now = datetime.now(timezone.utc)
+    notifications_sent = 0
+    expired_count = 0
+    clients_deleted = 0
+    
+    for kind in NOTIFICATION_WINDOWS:
+        after_user_id = 0
+        while True:
+            async with SessionLocal() as session:
+                rows = await find_notification_batch(session, kind, now, after_user_id=after_user_id, user_ids=user_ids)
+                if not rows:
+                    break
+                # Запись до отправки: при сбое уведомление не уйдет дважды
+                await record_notifications(session, kind, rows, now)
                 await session.commit()
-                
-            except Exception as e:
-                import logging
-                logging.error(f"Error checking server {server.id}: {e}")
-                continue
+            
+            await _send_user_notifications(
+                [(row.tg_id, _expiry_notification_text(kind, row.subscription_ends_at)) for row in rows]
+            )
+            notifications_sent += len(rows)
+            after_user_id = rows[-1].id
+    
+    after_user_id = 0
+    while True:
+        async with SessionLocal() as session:
+            users = await find_expired_batch(
+                session, now, after_user_id=after_user_id, user_ids=user_ids, auto_renew=False
+            )
+            if not users:
+                break
+            after_user_id = users[-1].id
+            
+            expired_ids = [user.id for user in users]
+            clients_deleted += await expire_users(session, expired_ids, now)
+            expired_count += len(expired_ids)
+            await session.commit()
+    
+    if notifications_sent or expired_count:
+        logging.info(
+            f"Subscription check: sent {notifications_sent} notifications, "
+            f"expired {expired_count} users, queued {clients_deleted} 3x-UI clients for removal"
+        )
+
+
+async def _process_subscription_deadlines(user_ids: list[int]) -> None:
+    """Обработка наступивших дедлайнов ExpiryScheduler: уведомления, истечение и автопродление"""
+    await _check_expired_subscriptions(user_ids)
+    await _process_auto_renewals(user_ids)
+
+
+JOB_DATABASE_BACKUP = "database_backup"
+
+
+@register_delayed_job(JOB_DATABASE_BACKUP)
+async def _run_database_backup_job(payload: dict) -> None:
+    """Ручной бэкап из админки (core.delayed_jobs); ошибка бэкапа повторяется очередью"""
+    backup = await _create_database_backup(created_by_tg_id=payload.get("created_by_tg_id"))
+    if backup is None:
+        raise RuntimeError("Бэкап базы данных не создан (подробности в backups.error_message)")
 
 
 async def _create_database_backup(created_by_tg_id: int | None = None) -> Backup | None:
@@ -479,7 +633,10 @@ async def _create_database_backup(created_by_tg_id: int | None = None) -> Backup
                     "-f", str(backup_path),
                 ]
                 
-                result = subprocess.run(
+                # В отдельном потоке: pg_dump большой БД не должен блокировать event loop
+                # (в том числе продление блокировки отложенного действия, core.delayed_jobs)
+                result = await asyncio.to_thread(
+                    subprocess.run,
                     cmd,
                     env=env,
                     capture_output=True,
@@ -615,8 +772,8 @@ async def _create_database_backup(created_by_tg_id: int | None = None) -> Backup
         return None
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+async def prepare_database() -> None:
+    """Создает таблицы и применяет миграции схемы (идемпотентно; вызывается API и core.worker)"""
     # Авто-создание таблиц в dev. Для продакшена — миграции alembic.
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -774,6 +931,82 @@ async def lifespan(app: FastAPI):
             import logging
             logging.warning(f"Could not add connection_speed_mbps column (may already exist): {e}")
         
+        # Добавляем колонки статистики проб в server_status, если их нет
+        server_status_columns = [
+            ("probe_method", "VARCHAR(8)"),
+            ("probe_samples", "INTEGER"),
+            ("latency_min_ms", "NUMERIC(10, 2)"),
+            ("latency_avg_ms", "NUMERIC(10, 2)"),
+            ("latency_p95_ms", "NUMERIC(10, 2)"),
+            ("jitter_ms", "NUMERIC(10, 2)"),
+            ("packet_loss_percent", "NUMERIC(5, 2)"),
+            ("panel_reachable", "BOOLEAN"),
+            ("panel_response_ms", "INTEGER"),
+        ]
+        for column_name, column_type in server_status_columns:
+            try:
+                result = await conn.execute(
+                    text(f"SELECT column_name FROM information_schema.columns WHERE table_name='server_status' AND column_name='{column_name}'")
+                )
+                exists = result.scalar()
+                if not exists:
+                    await conn.execute(text(f"ALTER TABLE server_status ADD COLUMN {column_name} {column_type}"))
+                    import logging
+                    logging.info(f"Added {column_name} column to server_status table")
+            except Exception as e:
+                import logging
+                logging.warning(f"Could not add {column_name} column (may already exist): {e}")
+        
+        # Составной индекс для последней проверки сервера (DISTINCT ON) и истории за период
+        try:
+            await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_server_status_server_checked ON server_status(server_id, checked_at)"))
+        except Exception as e:
+            import logging
+            logging.warning(f"Could not create ix_server_status_server_checked index: {e}")
+        
+        # Уникальный ключ ip_logs (user_id, server_id, ip_address): сначала сливаем дубликаты
+        try:
+            result = await conn.execute(
+                text("SELECT indexname FROM pg_indexes WHERE tablename='ip_logs' AND indexname='uq_ip_logs_user_server_ip'")
+            )
+            if not result.scalar():
+                await conn.execute(text("""
+                    UPDATE ip_logs AS l
+                    SET first_seen = d.first_seen, last_seen = d.last_seen, connection_count = d.connection_count
+                    FROM (
+                        SELECT MIN(id) AS keep_id, MIN(first_seen) AS first_seen, MAX(last_seen) AS last_seen,
+                               SUM(connection_count) AS connection_count
+                        FROM ip_logs
+                        GROUP BY user_id, server_id, ip_address
+                        HAVING COUNT(*) > 1
+                    ) AS d
+                    WHERE l.id = d.keep_id
+                """))
+                await conn.execute(text("""
+                    DELETE FROM ip_logs AS l
+                    USING ip_logs AS k
+                    WHERE l.user_id = k.user_id AND l.server_id = k.server_id
+                      AND l.ip_address = k.ip_address AND l.id > k.id
+                """))
+                await conn.execute(text(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS uq_ip_logs_user_server_ip ON ip_logs(user_id, server_id, ip_address)"
+                ))
+                import logging
+                logging.info("Added uq_ip_logs_user_server_ip unique index to ip_logs table")
+        except Exception as e:
+            import logging
+            logging.warning(f"Could not add uq_ip_logs_user_server_ip index: {e}")
+        
+        # Составной индекс для проверки уже отправленных уведомлений о подписке (core.expiry)
+        try:
+            await conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_subscription_notifications_user_type_sent "
+                "ON subscription_notifications(user_id, notification_type, sent_at)"
+            ))
+        except Exception as e:
+            import logging
+            logging.warning(f"Could not create ix_subscription_notifications_user_type_sent index: {e}")
+        
         # Добавляем колонку user_uuid в vpn_credentials, если её нет
         try:
             result = await conn.execute(
@@ -789,746 +1022,405 @@ async def lifespan(app: FastAPI):
             import logging
             logging.warning(f"Could not add user_uuid column (may already exist): {e}")
         
-    # Таблицы ip_logs и user_bans создаются автоматически через Base.metadata.create_all
-    
-    # Запускаем фоновую задачу для мониторинга серверов
-    async def monitor_servers():
-        while True:
-            try:
-                await asyncio.sleep(60)  # Проверка каждую минуту
-                await _check_servers_health()
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                import logging
-                logging.error(f"Error in server monitoring: {e}")
-    
-    monitor_task = asyncio.create_task(monitor_servers())
-    
-    # Запускаем фоновую задачу для автоматических бэкапов
-    async def auto_backup():
-        # Делаем первый бекап сразу при старте
+        # Добавляем колонку parse_mode в broadcasts, если её нет
         try:
-            await _create_database_backup(created_by_tg_id=None)
-            import logging
-            logging.info("Initial backup created on startup")
+            result = await conn.execute(
+                text("SELECT column_name FROM information_schema.columns WHERE table_name='broadcasts' AND column_name='parse_mode'")
+            )
+            exists = result.scalar()
+            if not exists:
+                await conn.execute(text("ALTER TABLE broadcasts ADD COLUMN parse_mode VARCHAR(16)"))
+                import logging
+                logging.info("Added parse_mode column to broadcasts table")
         except Exception as e:
             import logging
-            logging.error(f"Error creating initial backup: {e}")
+            logging.warning(f"Could not add parse_mode column (may already exist): {e}")
         
-        # Затем делаем бекапы раз в сутки
-        while True:
-            try:
-                await asyncio.sleep(86400)  # Раз в сутки (24 часа)
-                await _create_database_backup(created_by_tg_id=None)
-                import logging
-                logging.info("Scheduled daily backup created")
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
+        # Добавляем колонку panel_status в vpn_credentials, если её нет
+        try:
+            result = await conn.execute(
+                text("SELECT column_name FROM information_schema.columns WHERE table_name='vpn_credentials' AND column_name='panel_status'")
+            )
+            exists = result.scalar()
+            if not exists:
+                await conn.execute(text("ALTER TABLE vpn_credentials ADD COLUMN panel_status VARCHAR(16)"))
                 import logging
-                logging.error(f"Error in auto backup: {e}")
+                logging.info("Added panel_status column to vpn_credentials table")
+        except Exception as e:
+            import logging
+            logging.warning(f"Could not add panel_status column (may already exist): {e}")
+        
+    # Таблицы ip_logs и user_bans создаются автоматически через Base.metadata.create_all
+
+
+def register_background_jobs(scheduler: JobScheduler) -> None:
+    """
+    Регистрирует фоновые задачи в планировщике
     
-    backup_task = asyncio.create_task(auto_backup())
+    Задачи выполняются через планировщик (core.scheduler): при нескольких воркерах
+    или репликах каждая задача работает только на одном узле. Обычно их выполняет
+    отдельный процесс core.worker, а API запускается с BACKGROUND_JOBS_ENABLED=false.
     
-    # Запускаем фоновую задачу для закрытия старых pending платежей
-    async def close_old_pending_payments():
+    Args:
+        scheduler: Планировщик, в котором регистрируются задачи (запускает вызывающий)
+    """
+    # Автоматический бэкап: первый сразу при старте, затем раз в сутки
+    async def auto_backup():
         import logging
-        # Запускаем сразу при старте
-        logging.info("Starting payment cleanup task - checking for old pending payments...")
-        await _close_old_pending_payments()
         
-        while True:
-            try:
-                await asyncio.sleep(3600)  # Проверка каждый час
-                logging.info("Running scheduled payment cleanup...")
-                await _close_old_pending_payments()
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                logging.error(f"Error closing old pending payments: {e}", exc_info=True)
+        await _create_database_backup(created_by_tg_id=None)
+        logging.info("Scheduled backup created")
     
-    payments_cleanup_task = asyncio.create_task(close_old_pending_payments())
+    # Закрытие старых pending платежей
+    async def close_old_pending_payments():
+        import logging
+        
+        logging.info("Running scheduled payment cleanup...")
+        await _close_old_pending_payments()
     
     # Фоновая задача для проверки истечения подписок и отправки уведомлений
     async def check_expired_subscriptions():
-        """Проверяет истечение подписок, отправляет уведомления и удаляет клиентов из 3x-UI"""
-        from core.db.session import SessionLocal
         import logging
-        from zoneinfo import ZoneInfo
         
-        while True:
-            try:
-                await asyncio.sleep(3600)  # Проверка каждый час
-                logging.info("Running scheduled subscription status check...")
-                
-                async with SessionLocal() as session:
-                    try:
-                        now = datetime.now(timezone.utc)
-                        three_days = timedelta(days=3)
-                        one_day = timedelta(days=1)
-                        
-                        # Получаем всех пользователей с активными подписками
-                        users_with_subs = await session.scalars(
-                            select(User)
-                            .where(User.has_active_subscription == True)
-                            .where(User.subscription_ends_at.isnot(None))
-                            .options(selectinload(User.credentials).selectinload(VpnCredential.server))
-                        )
-                        
-                        updated_count = 0
-                        notifications_sent = 0
-                        clients_deleted = 0
-                        
-                        for user in users_with_subs.all():
-                            if not user.subscription_ends_at:
-                                continue
-                            
-                            time_until_expiry = user.subscription_ends_at - now
-                            
-                            # Проверяем, нужно ли отправить уведомление
-                            notification_to_send = None
-                            if time_until_expiry <= timedelta(0):
-                                # Подписка истекла
-                                notification_to_send = "expired"
-                            elif timedelta(0) < time_until_expiry <= one_day:
-                                # Менее 1 дня до истечения
-                                notification_to_send = "1_day"
-                            elif one_day < time_until_expiry <= three_days:
-                                # От 1 до 3 дней до истечения
-                                notification_to_send = "3_days"
-                            
-                            # Проверяем, не отправляли ли уже такое уведомление
-                            if notification_to_send:
-                                active_sub = await session.scalar(
-                                    select(Subscription)
-                                    .where(Subscription.user_id == user.id)
-                                    .where(Subscription.status == SubscriptionStatus.active)
-                                    .order_by(Subscription.ends_at.desc().nullslast())
-                                    .limit(1)
-                                )
-                                
-                                # Проверяем, не отправляли ли уже это уведомление для этой подписки
-                                existing_notification = await session.scalar(
-                                    select(SubscriptionNotification)
-                                    .where(SubscriptionNotification.user_id == user.id)
-                                    .where(SubscriptionNotification.notification_type == notification_to_send)
-                                    .where(
-                                        (SubscriptionNotification.subscription_id == active_sub.id) 
-                                        if active_sub else True
-                                    )
-                                    .order_by(SubscriptionNotification.sent_at.desc())
-                                    .limit(1)
-                                )
-                                
-                                # Отправляем уведомление только если не отправляли недавно (для expired - всегда)
-                                if not existing_notification or notification_to_send == "expired":
-                                    # Формируем текст уведомления
-                                    ends_at_moscow = user.subscription_ends_at.astimezone(ZoneInfo("Europe/Moscow"))
-                                    ends_str = ends_at_moscow.strftime("%d.%m.%Y %H:%M")
-                                    
-                                    if notification_to_send == "expired":
-                                        notification_text = (
-                                            f"⏰ <b>Подписка истекла</b>\n\n"
-                                            f"Ваша подписка закончилась {ends_str} МСК.\n\n"
-                                            f"Для продолжения использования VPN приобретите новую подписку в разделе '📦 Тарифы'."
-                                        )
-                                    elif notification_to_send == "1_day":
-                                        notification_text = (
-                                            f"⏰ <b>Подписка скоро истечет</b>\n\n"
-                                            f"Ваша подписка закончится через <b>1 день</b> ({ends_str} МСК).\n\n"
-                                            f"Не забудьте продлить подписку, чтобы не потерять доступ к VPN."
-                                        )
-                                    elif notification_to_send == "3_days":
-                                        notification_text = (
-                                            f"⏰ <b>Напоминание о подписке</b>\n\n"
-                                            f"Ваша подписка закончится через <b>3 дня</b> ({ends_str} МСК).\n\n"
-                                            f"Рекомендуем продлить подписку заранее."
-                                        )
-                                    
-                                    # Отправляем уведомление
-                                    try:
-                                        asyncio.create_task(_send_user_notification(user.tg_id, notification_text))
-                                        
-                                        # Сохраняем факт отправки уведомления
-                                        notification_record = SubscriptionNotification(
-                                            user_id=user.id,
-                                            subscription_id=active_sub.id if active_sub else None,
-                                            notification_type=notification_to_send,
-                                        )
-                                        session.add(notification_record)
-                                        notifications_sent += 1
-                                    except Exception as e:
-                                        logging.error(f"Error sending notification to user {user.tg_id}: {e}")
-                            
-                            # Если подписка истекла, проверяем автопродление
-                            if time_until_expiry <= timedelta(0):
-                                # Проверяем, включено ли автопродление
-                                if user.auto_renew_subscription:
-                                    # Пытаемся автоматически продлить подписку
-                                    active_sub = await session.scalar(
-                                        select(Subscription)
-                                        .where(Subscription.user_id == user.id)
-                                        .where(Subscription.status == SubscriptionStatus.active)
-                                        .order_by(Subscription.ends_at.desc().nullslast())
-                                        .limit(1)
-                                    )
-                                    
-                                    if active_sub:
-                                        # Ищем тариф для продления
-                                        # Сначала пытаемся найти тариф по названию (для обратной совместимости)
-                                        original_plan = None
-                                        if active_sub.plan_name:
-                                            # Пытаемся найти тариф по названию
-                                            plans_by_name = await session.scalars(
-                                                select(SubscriptionPlan)
-                                                .where(SubscriptionPlan.name == active_sub.plan_name)
-                                                .where(SubscriptionPlan.is_active == True)
-                                            )
-                                            original_plan = plans_by_name.first()
-                                        
-                                        # Если не нашли по названию, ищем самый похожий по цене
-                                        if not original_plan and active_sub.price_cents:
-                                            plans_by_price = await session.scalars(
-                                                select(SubscriptionPlan)
-                                                .where(SubscriptionPlan.price_cents == active_sub.price_cents)
-                                                .where(SubscriptionPlan.is_active == True)
-                                            )
-                                            original_plan = plans_by_price.first()
-                                        
-                                        # Если не хватает средств на текущий тариф, ищем более дешевый
-                                        plan = None
-                                        if original_plan and user.balance >= original_plan.price_cents:
-                                            # Хватает на текущий тариф
-                                            plan = original_plan
-                                        else:
-                                            # Ищем самый дешевый тариф, на который хватает средств
-                                            all_plans = await session.scalars(
-                                                select(SubscriptionPlan)
-                                                .where(SubscriptionPlan.is_active == True)
-                                                .order_by(SubscriptionPlan.price_cents.asc())
-                                            )
-                                            
-                                            for candidate_plan in all_plans.all():
-                                                if user.balance >= candidate_plan.price_cents:
-                                                    plan = candidate_plan
-                                                    break
-                                        
-                                        if plan:
-                                            # Продлеваем подписку на найденный тариф
-                                            new_ends_at = now + timedelta(days=plan.days)
-                                            active_sub.ends_at = new_ends_at
-                                            active_sub.price_cents = plan.price_cents
-                                            active_sub.plan_name = plan.name  # Обновляем название тарифа
-                                            
-                                            # Списываем баланс
-                                            user.balance -= plan.price_cents
-                                            
-                                            # Логируем
-                                            session.add(
-                                                BalanceTransaction(
-                                                    user_id=user.id,
-                                                    amount_cents=-plan.price_cents,
-                                                    type=BalanceTransactionType.subscription_purchase,
-                                                    details=f"Автопродление подписки '{plan.name}' на {plan.days} дней. Баланс: {user.balance / 100:.2f} RUB",
-                                                )
-                                            )
-                                            
-                                            # Формируем сообщение для лога
-                                            log_message = f"Автопродление подписки '{plan.name}' на {plan.days} дней"
-                                            if original_plan and plan.id != original_plan.id:
-                                                log_message += f" (переключено с '{original_plan.name}' из-за недостатка средств)"
-                                            
-                                            session.add(
-                                                AuditLog(
-                                                    action=AuditLogAction.subscription_extended,
-                                                    user_tg_id=user.tg_id,
-                                                    details=f"{log_message}. Действует до: {new_ends_at.strftime('%d.%m.%Y %H:%M')} (UTC). Баланс: {user.balance / 100:.2f} RUB",
-                                                )
-                                            )
-                                            
-                                            # Отправляем уведомление
-                                            try:
-                                                from zoneinfo import ZoneInfo
-                                                ends_at_moscow = new_ends_at.astimezone(ZoneInfo("Europe/Moscow"))
-                                                ends_str = ends_at_moscow.strftime("%d.%m.%Y %H:%M")
-                                                
-                                                notification_text = (
-                                                    f"✅ <b>Подписка автоматически продлена</b>\n\n"
-                                                    f"📦 Тариф: <b>{plan.name}</b>\n"
-                                                    f"💰 Стоимость: {plan.price_cents / 100:.2f} RUB\n"
-                                                )
-                                                
-                                                # Если тариф изменился, добавляем информацию об этом
-                                                if original_plan and plan.id != original_plan.id:
-                                                    notification_text += (
-                                                        f"⚠️ <b>Внимание:</b> Тариф изменен с '{original_plan.name}' на '{plan.name}' "
-                                                        f"из-за недостатка средств на предыдущий тариф.\n\n"
-                                                    )
-                                                
-                                                notification_text += (
-                                                    f"📅 Действует до: {ends_str} МСК\n"
-                                                    f"💵 Остаток баланса: {user.balance / 100:.2f} RUB"
-                                                )
-                                                
-                                                asyncio.create_task(_send_user_notification(user.tg_id, notification_text))
-                                            except Exception as e:
-                                                logging.error(f"Error sending auto-renewal notification to user {user.tg_id}: {e}")
-                                            
-                                            logging.info(f"Автопродление подписки для пользователя {user.tg_id}: продлено на {plan.days} дней (тариф: {plan.name})")
-                                            updated_count += 1
-                                        else:
-                                            # Недостаточно средств ни на один тариф - удаляем клиента
-                                            logging.info(f"Автопродление невозможно для пользователя {user.tg_id}: недостаточно средств ни на один тариф (баланс: {user.balance / 100:.2f} RUB)")
-                                            
-                                            # Отправляем уведомление о недостатке средств
-                                            try:
-                                                from zoneinfo import ZoneInfo
-                                                ends_at_moscow = user.subscription_ends_at.astimezone(ZoneInfo("Europe/Moscow")) if user.subscription_ends_at else None
-                                                ends_str = ends_at_moscow.strftime("%d.%m.%Y %H:%M") if ends_at_moscow else "—"
-                                                
-                                                # Получаем самый дешевый тариф для информации
-                                                cheapest_plan = await session.scalar(
-                                                    select(SubscriptionPlan)
-                                                    .where(SubscriptionPlan.is_active == True)
-                                                    .order_by(SubscriptionPlan.price_cents.asc())
-                                                    .limit(1)
-                                                )
-                                                
-                                                notification_text = (
-                                                    f"❌ <b>Автопродление не удалось</b>\n\n"
-                                                    f"Ваша подписка истекла {ends_str} МСК.\n\n"
-                                                    f"💵 Текущий баланс: <b>{user.balance / 100:.2f} RUB</b>\n"
-                                                )
-                                                
-                                                if cheapest_plan:
-                                                    notification_text += (
-                                                        f"💰 Минимальный тариф: <b>{cheapest_plan.name}</b> — {cheapest_plan.price_cents / 100:.2f} RUB\n\n"
-                                                    )
-                                                
-                                                notification_text += (
-                                                    "Для продолжения использования VPN пополните баланс и приобретите подписку в разделе '📦 Тарифы'."
-                                                )
-                                                
-                                                asyncio.create_task(_send_user_notification(user.tg_id, notification_text))
-                                            except Exception as e:
-                                                logging.error(f"Error sending auto-renewal failure notification to user {user.tg_id}: {e}")
-                                            
-                                            await _handle_subscription_expiry(user, session)
-                                            updated_count += 1
-                                    else:
-                                        # Нет активной подписки - удаляем клиента
-                                        await _handle_subscription_expiry(user, session)
-                                        updated_count += 1
-                                else:
-                                    # Автопродление отключено - удаляем клиента
-                                    await _handle_subscription_expiry(user, session)
-                                    updated_count += 1
-                        
-                        # Обновляем статус всех пользователей
-                        all_users = await session.scalars(select(User))
-                        for user in all_users.all():
-                            old_status = user.has_active_subscription
-                            await _update_user_subscription_status(user.id, session)
-                            await session.flush()
-                            if old_status != user.has_active_subscription and old_status:
-                                updated_count += 1
-                        
-                        if updated_count > 0 or notifications_sent > 0 or clients_deleted > 0:
-                            await session.commit()
-                            logging.info(f"Updated subscription status for {updated_count} users, sent {notifications_sent} notifications, deleted {clients_deleted} clients from 3x-UI")
-                    except Exception as e:
-                        logging.error(f"Error checking expired subscriptions: {e}", exc_info=True)
-                        await session.rollback()
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                logging.error(f"Error in subscription status check task: {e}", exc_info=True)
-    
-    subscription_check_task = asyncio.create_task(check_expired_subscriptions())
+        logging.info("Running scheduled subscription status check...")
+        await _check_expired_subscriptions()
     
     # Фоновая задача для проверки состояния серверов
     async def check_servers_status():
-        """Проверяет состояние серверов через ping строго каждые 60 секунд"""
-        from core.db.session import SessionLocal
+        """Проверяет состояние серверов (ICMP/TCP и API панели, core.health), раз в минуту от начала проверки"""
         import logging
-        import time
-        
-        # Первая проверка сразу при старте
-        await asyncio.sleep(5)
         
-        # Интервал проверки: ровно 60 секунд
-        CHECK_INTERVAL = 60.0
-        
-        while True:
-            # Запоминаем время начала проверки
-            check_start_time = time.time()
-            
-            try:
-                logging.info("=== НАЧАЛО ПРОВЕРКИ СЕРВЕРОВ ===")
-                
-                async with SessionLocal() as session:
-                    try:
-                        # Получаем все активные серверы
-                        servers = await session.scalars(
-                            select(Server)
-                            .where(Server.is_enabled == True)
-                        )
-                        servers_list = servers.all()
-                        
-                        logging.info(f"Найдено {len(servers_list)} активных серверов для проверки")
-                        
-                        checked_count = 0
-                        for server in servers_list:
-                            try:
-                                logging.info(f"Проверяем сервер {server.name} (host: {server.host})")
-                                
-                                # Проверяем доступность через ping
-                                status_result = await _check_server_status(server)
-                                is_online = status_result["is_online"]
-                                response_time_ms = status_result["response_time_ms"]
-                                error_message = status_result["error_message"]
-                                
-                                logging.info(f"Результат проверки {server.name}: online={is_online}, time={response_time_ms}ms, error={error_message}")
-                                
-                                # Сохраняем статус
-                                status = ServerStatus(
-                                    server_id=server.id,
-                                    is_online=is_online,
-                                    response_time_ms=response_time_ms,
-                                    connection_speed_mbps=status_result.get("connection_speed_mbps"),
-                                    error_message=error_message,
-                                )
-                                session.add(status)
-                                checked_count += 1
-                                
-                                # Задержка между проверками серверов
-                                await asyncio.sleep(1.0)
-                                
-                            except Exception as e:
-                                logging.error(f"Ошибка при проверке сервера {server.id} ({server.name}): {e}", exc_info=True)
-                                # Сохраняем статус с ошибкой
-                                status = ServerStatus(
-                                    server_id=server.id,
-                                    is_online=False,
-                                    error_message=f"Check error: {str(e)}",
-                                )
-                                session.add(status)
-                        
-                        if checked_count > 0:
-                            await session.commit()
-                            logging.info(f"✅ Проверено {checked_count} серверов, статусы сохранены")
-                            
-                            # Удаляем старые записи (оставляем только последние 100 на сервер)
-                            for server in servers_list:
-                                old_statuses = await session.scalars(
-                                    select(ServerStatus)
-                                    .where(ServerStatus.server_id == server.id)
-                                    .order_by(ServerStatus.checked_at.desc())
-                                    .offset(100)
-                                )
-                                for old_status in old_statuses.all():
-                                    await session.delete(old_status)
-                            await session.commit()
-                        else:
-                            logging.info("Нет серверов для проверки")
-                            
-                    except Exception as e:
-                        logging.error(f"Ошибка при проверке статусов серверов: {e}", exc_info=True)
-                        await session.rollback()
-                
-                # Вычисляем, сколько времени заняла проверка
-                check_duration = time.time() - check_start_time
-                
-                # Ждем оставшееся время до следующей проверки (ровно 60 секунд от начала предыдущей)
-                sleep_time = max(0.0, CHECK_INTERVAL - check_duration)
-                
-                if sleep_time > 0:
-                    logging.info(f"Проверка заняла {check_duration:.2f}с, ждем {sleep_time:.2f}с до следующей проверки")
-                    await asyncio.sleep(sleep_time)
-                else:
-                    logging.warning(f"Проверка заняла {check_duration:.2f}с (больше {CHECK_INTERVAL}с), начинаем следующую сразу")
-                
-            except asyncio.CancelledError:
-                logging.info("Задача проверки серверов отменена")
-                break
-            except Exception as e:
-                logging.error(f"Ошибка в задаче проверки серверов: {e}", exc_info=True)
-                # При ошибке ждем полный интервал
-                await asyncio.sleep(CHECK_INTERVAL)
-    
-    server_check_task = asyncio.create_task(check_servers_status())
+        # Единственный путь записи server_status: пробы всех серверов параллельно и один INSERT
+        checked_count = await run_health_round()
+        if checked_count > 0:
+            logging.info(f"✅ Проверено {checked_count} серверов, статусы сохранены")
+        else:
+            logging.info("Нет серверов для проверки")
     
     # Фоновая задача для мониторинга IP и автобана
     async def monitor_client_ips():
         """Мониторит IP адреса клиентов и банит при превышении лимита"""
         from core.db.session import SessionLocal
-        from core.db.models import Server, VpnCredential, User, IpLog, UserBan, SystemSetting
-        from core.x3ui_api import X3UIAPI
+        from core.db.models import Server, VpnCredential, User, UserBan, SystemSetting
         import logging
+        import re
         
-        # Ждем 2 минуты перед первым запуском
-        await asyncio.sleep(120)
+        # Максимальное время обхода одного сервера (меньше интервала задачи)
+        IP_SWEEP_SERVER_TIMEOUT = 240.0
+        client_email_re = re.compile(r"^tg_(\d+)_server_(\d+)@fiorevpn$")
         
-        while True:
+        async with SessionLocal() as session:
             try:
-                async with SessionLocal() as session:
+                # Получаем настройки
+                ip_limit_setting = await session.scalar(
+                    select(SystemSetting).where(SystemSetting.key == "vpn_limit_ip")
+                )
+                autoban_enabled_setting = await session.scalar(
+                    select(SystemSetting).where(SystemSetting.key == "autoban_enabled")
+                )
+                autoban_duration_setting = await session.scalar(
+                    select(SystemSetting).where(SystemSetting.key == "autoban_duration_hours")
+                )
+                
+                ip_limit = 1
+                if ip_limit_setting:
                     try:
-                        # Получаем настройки
-                        ip_limit_setting = await session.scalar(
-                            select(SystemSetting).where(SystemSetting.key == "vpn_limit_ip")
-                        )
-                        autoban_enabled_setting = await session.scalar(
-                            select(SystemSetting).where(SystemSetting.key == "autoban_enabled")
-                        )
-                        autoban_duration_setting = await session.scalar(
-                            select(SystemSetting).where(SystemSetting.key == "autoban_duration_hours")
-                        )
-                        
+                        ip_limit = int(ip_limit_setting.value)
+                    except (ValueError, TypeError):
                         ip_limit = 1
-                        if ip_limit_setting:
-                            try:
-                                ip_limit = int(ip_limit_setting.value)
-                            except (ValueError, TypeError):
-                                ip_limit = 1
+                
+                autoban_enabled = True
+                if autoban_enabled_setting:
+                    autoban_enabled = autoban_enabled_setting.value.lower() in ("true", "1", "yes")
+                
+                autoban_duration_hours = 24
+                if autoban_duration_setting:
+                    try:
+                        autoban_duration_hours = int(autoban_duration_setting.value)
+                    except (ValueError, TypeError):
+                        autoban_duration_hours = 24
+                
+                # Получаем все активные серверы с 3x-UI API
+                servers = await session.scalars(
+                    select(Server).where(
+                        Server.is_enabled == True,
+                        Server.x3ui_api_url.isnot(None),
+                        Server.x3ui_username.isnot(None),
+                        Server.x3ui_password.isnot(None)
+                    )
+                )
+                servers_list = servers.all()
+                sweep_all_started = time.monotonic()
+                
+                async def sweep_server(server: Server) -> None:
+                    """Обход одного сервера в собственной сессии БД (серверы обрабатываются параллельно)"""
+                    x3ui = await x3ui_registry.get(server)
+                    
+                    # Клиенты забаненных: отключаются через outbox в транзакции бана
+                    to_disable: list[tuple[VpnCredential, int, Server]] = []
+                    # Уведомления о бане отправляются после commit: не держим транзакцию на очереди отправки
+                    ban_notifications: list[tuple[int, str]] = []
+                    
+                    sweep_started = time.monotonic()
+                    
+                    # Сначала один запрос onlines: IP запрашиваем только у клиентов онлайн
+                    online_emails = set(await panel_executor.run(server.id, x3ui.get_online_clients))
+                    online_tg_ids = set()
+                    for online_email in online_emails:
+                        match = client_email_re.match(str(online_email))
+                        if match and int(match.group(2)) == server.id:
+                            online_tg_ids.add(int(match.group(1)))
+                    
+                    async with SessionLocal() as server_session:
+                        # Активные credentials этого сервера только для онлайн пользователей
+                        credentials = []
+                        if online_tg_ids:
+                            credentials_result = await server_session.scalars(
+                                select(VpnCredential)
+                                .join(User, User.id == VpnCredential.user_id)
+                                .where(VpnCredential.server_id == server.id)
+                                .where(VpnCredential.active == True)
+                                .where(User.tg_id.in_(online_tg_ids))
+                                .options(selectinload(VpnCredential.user))
+                            )
+                            credentials = credentials_result.all()
                         
-                        autoban_enabled = True
-                        if autoban_enabled_setting:
-                            autoban_enabled = autoban_enabled_setting.value.lower() in ("true", "1", "yes")
+                        # IP адреса клиентов запрашиваем параллельно в пределах лимита панели
+                        async def fetch_client_ips(cred: VpnCredential) -> tuple[VpnCredential, list[str]]:
+                            client_email = f"tg_{cred.user.tg_id}_server_{server.id}@fiorevpn"
+                            return cred, await x3ui.get_client_ips(client_email)
                         
-                        autoban_duration_hours = 24
-                        if autoban_duration_setting:
-                            try:
-                                autoban_duration_hours = int(autoban_duration_setting.value)
-                            except (ValueError, TypeError):
-                                autoban_duration_hours = 24
+                        ip_results = await panel_executor.gather(server.id, fetch_client_ips, credentials)
                         
-                        # Получаем все активные серверы с 3x-UI API
-                        servers = await session.scalars(
-                            select(Server).where(
-                                Server.is_enabled == True,
-                                Server.x3ui_api_url.isnot(None),
-                                Server.x3ui_username.isnot(None),
-                                Server.x3ui_password.isnot(None)
-                            )
-                        )
+                        now = datetime.utcnow()
+                        # Наблюдения сервера: (user_id, ip) -> строка ip_logs, записываются одним upsert
+                        observations: dict[tuple[int, str], dict] = {}
+                        over_limit: list[tuple[VpnCredential, list[str]]] = []
                         
-                        for server in servers.all():
-                            try:
-                                x3ui = X3UIAPI(
-                                    api_url=server.x3ui_api_url,
-                                    username=server.x3ui_username,
-                                    password=server.x3ui_password,
-                                )
-                                
-                                try:
-                                    # Получаем все активные credentials для этого сервера
-                                    credentials = await session.scalars(
-                                        select(VpnCredential)
-                                        .where(VpnCredential.server_id == server.id)
-                                        .where(VpnCredential.active == True)
-                                        .options(selectinload(VpnCredential.user))
-                                    )
-                                    
-                                    for cred in credentials.all():
-                                        if not cred.user:
-                                            continue
-                                        
-                                        # Формируем email клиента с tg_id
-                                        client_email = f"tg_{cred.user.tg_id}_server_{server.id}@fiorevpn"
-                                        
-                                        # Получаем IP адреса клиента
-                                        ips = await x3ui.get_client_ips(client_email)
-                                        
-                                        if not ips:
-                                            continue
-                                        
-                                        now = datetime.utcnow()
-                                        
-                                        # Логируем IP адреса
-                                        for ip in ips:
-                                            if not ip or ip == "No IP Record":
-                                                continue
-                                            
-                                            # Ищем существующую запись
-                                            existing_log = await session.scalar(
-                                                select(IpLog).where(
-                                                    IpLog.user_id == cred.user_id,
-                                                    IpLog.server_id == server.id,
-                                                    IpLog.ip_address == ip
-                                                )
-                                            )
-                                            
-                                            if existing_log:
-                                                existing_log.last_seen = now
-                                                existing_log.connection_count += 1
-                                            else:
-                                                session.add(IpLog(
-                                                    user_id=cred.user_id,
-                                                    server_id=server.id,
-                                                    ip_address=ip,
-                                                    first_seen=now,
-                                                    last_seen=now,
-                                                    connection_count=1
-                                                ))
-                                        
-                                        # Проверяем превышение лимита IP
-                                        if autoban_enabled and len(ips) > ip_limit:
-                                            # Проверяем, не забанен ли уже
-                                            existing_ban = await session.scalar(
-                                                select(UserBan).where(
-                                                    UserBan.user_id == cred.user_id,
-                                                    UserBan.is_active == True
-                                                )
-                                            )
-                                            
-                                            if not existing_ban:
-                                                # Создаем бан
-                                                ban = UserBan(
-                                                    user_id=cred.user_id,
-                                                    reason="ip_limit_exceeded",
-                                                    details=f"Обнаружено {len(ips)} IP адресов (лимит: {ip_limit}). IP: {', '.join(ips)}",
-                                                    is_active=True,
-                                                    auto_ban=True,
-                                                    banned_until=now + timedelta(hours=autoban_duration_hours)
-                                                )
-                                                session.add(ban)
-                                                
-                                                # Отключаем клиента в 3x-UI
-                                                if cred.user_uuid and server.x3ui_inbound_id:
-                                                    await x3ui.disable_client(server.x3ui_inbound_id, cred.user_uuid)
-                                                
-                                                # Уведомляем пользователя
-                                                notification_text = (
-                                                    "⚠️ <b>Ваш аккаунт временно заблокирован</b>\n\n"
-                                                    f"Причина: превышен лимит одновременных подключений ({len(ips)} из {ip_limit})\n"
-                                                    f"Блокировка снимется автоматически через {autoban_duration_hours} ч.\n\n"
-                                                    "Если вы считаете это ошибкой, обратитесь в поддержку."
-                                                )
-                                                asyncio.create_task(_send_user_notification(cred.user.tg_id, notification_text))
-                                                
-                                                logging.warning(
-                                                    f"Автобан пользователя {cred.user.tg_id}: "
-                                                    f"превышен лимит IP ({len(ips)} > {ip_limit})"
-                                                )
-                                        
-                                        await session.commit()
-                                        
-                                finally:
-                                    await x3ui.close()
-                                    
-                            except Exception as e:
-                                logging.error(f"Error monitoring IPs for server {server.name}: {e}")
+                        for ip_result in ip_results:
+                            if isinstance(ip_result, BaseException):
+                                logging.warning(f"Не удалось получить IP клиента на сервере {server.name}: {ip_result}")
                                 continue
-                                
-                    except Exception as e:
-                        logging.error(f"Error in IP monitoring task: {e}", exc_info=True)
-                        await session.rollback()
+                            cred, ips = ip_result
+                            if not ips:
+                                continue
+                            
+                            for ip in ips:
+                                if not ip or ip == "No IP Record":
+                                    continue
+                                observations[(cred.user_id, ip)] = {
+                                    "user_id": cred.user_id,
+                                    "server_id": server.id,
+                                    "ip_address": ip,
+                                    "first_seen": now,
+                                    "last_seen": now,
+                                    "connection_count": 1,
+                                }
+                            
+                            if autoban_enabled and len(ips) > ip_limit:
+                                over_limit.append((cred, ips))
+                        
+                        await _upsert_ip_logs(server_session, list(observations.values()))
+                        
+                        # Превышение лимита IP: активные баны проверяем одним запросом
+                        banned_user_ids = set()
+                        if over_limit:
+                            banned_user_ids = set((await server_session.scalars(
+                                select(UserBan.user_id)
+                                .where(UserBan.user_id.in_({cred.user_id for cred, _ in over_limit}))
+                                .where(UserBan.is_active == True)
+                            )).all())
+                        
+                        for cred, ips in over_limit:
+                            if cred.user_id in banned_user_ids:
+                                continue
+                            banned_user_ids.add(cred.user_id)
+                            
+                            server_session.add(UserBan(
+                                user_id=cred.user_id,
+                                reason="ip_limit_exceeded",
+                                details=f"Обнаружено {len(ips)} IP адресов (лимит: {ip_limit}). IP: {', '.join(ips)}",
+                                is_active=True,
+                                auto_ban=True,
+                                banned_until=now + timedelta(hours=autoban_duration_hours)
+                            ))
+                            
+                            if cred.user_uuid:
+                                to_disable.append((cred, cred.user.tg_id, server))
+                            
+                            # Уведомляем пользователя
+                            notification_text = (
+                                "⚠️ <b>Ваш аккаунт временно заблокирован</b>\n\n"
+                                f"Причина: превышен лимит одновременных подключений ({len(ips)} из {ip_limit})\n"
+                                f"Блокировка снимется автоматически через {autoban_duration_hours} ч.\n\n"
+                                "Если вы считаете это ошибкой, обратитесь в поддержку."
+                            )
+                            ban_notifications.append((cred.user.tg_id, notification_text))
+                            
+                            logging.warning(
+                                f"Автобан пользователя {cred.user.tg_id}: "
+                                f"превышен лимит IP ({len(ips)} > {ip_limit})"
+                            )
+                        
+                        # Бан и отключение клиента в 3x-UI (строки outbox) — одна транзакция на сервер
+                        await _enqueue_clients_enabled(server_session, to_disable, False)
+                        await server_session.commit()
+                    
+                    await _send_user_notifications(ban_notifications)
+                    
+                    sweep_duration = time.monotonic() - sweep_started
+                    logging.info(
+                        f"IP sweep {server.name}: онлайн {len(online_emails)}, проверено {len(credentials)}, "
+                        f"IP {len(observations)}, отключено {len(to_disable)}, заняло {sweep_duration:.2f}с"
+                    )
+                
+                # Серверы независимы: обходим параллельно, время обхода = самый медленный сервер
+                await panel_executor.for_each_server(servers_list, sweep_server, timeout=IP_SWEEP_SERVER_TIMEOUT)
+                
+                logging.info(f"IP sweep: {len(servers_list)} серверов за {time.monotonic() - sweep_all_started:.2f}с")
                         
-            except asyncio.CancelledError:
-                break
             except Exception as e:
                 logging.error(f"Error in IP monitoring task: {e}", exc_info=True)
-            
-            # Проверяем каждые 5 минут
-            await asyncio.sleep(300)
-    
-    ip_monitor_task = asyncio.create_task(monitor_client_ips())
+                await session.rollback()
     
     # Фоновая задача для снятия истекших банов
     async def unban_expired_users():
-        """Снимает баны с истекшим сроком"""
+        """
+        Снимает баны с истекшим сроком
+        
+        Баны закрываются одним UPDATE ... RETURNING, активные credentials разбаненных
+        выбираются одним запросом, а включение их клиентов в 3x-UI ставится в outbox
+        в той же транзакции: при ошибке панели outbox повторяет включение.
+        """
         from core.db.session import SessionLocal
-        from core.db.models import UserBan, VpnCredential, Server
-        from core.x3ui_api import X3UIAPI
+        from core.db.models import UserBan, VpnCredential, Server, User
         import logging
         
-        # Ждем 3 минуты перед первым запуском
-        await asyncio.sleep(180)
+        now = datetime.utcnow()
+        async with SessionLocal() as session:
+            unbanned_user_ids = set((await session.scalars(
+                update(UserBan)
+                .where(UserBan.is_active == True)
+                .where(UserBan.banned_until.isnot(None))
+                .where(UserBan.banned_until < now)
+                .values(is_active=False, unbanned_at=now)
+                .returning(UserBan.user_id)
+                .execution_options(synchronize_session=False)
+            )).all())
+            if not unbanned_user_ids:
+                return
+            
+            # Клиенты для включения: активные credentials разбаненных без других активных банов
+            still_banned = (
+                select(UserBan.id)
+                .where(UserBan.user_id == VpnCredential.user_id)
+                .where(UserBan.is_active == True)
+                .exists()
+            )
+            rows = (await session.execute(
+                select(VpnCredential, User.tg_id, Server)
+                .join(User, User.id == VpnCredential.user_id)
+                .join(Server, Server.id == VpnCredential.server_id)
+                .where(VpnCredential.user_id.in_(unbanned_user_ids))
+                .where(VpnCredential.active == True)
+                .where(VpnCredential.user_uuid.isnot(None))
+                .where(Server.x3ui_api_url.isnot(None))
+                .where(Server.x3ui_username.isnot(None))
+                .where(Server.x3ui_password.isnot(None))
+                .where(~still_banned)
+            )).all()
+            
+            await _enqueue_clients_enabled(session, [tuple(row) for row in rows], True)
+            await session.commit()
         
-        while True:
-            try:
-                async with SessionLocal() as session:
-                    try:
-                        now = datetime.utcnow()
-                        
-                        # Находим истекшие баны
-                        expired_bans = await session.scalars(
-                            select(UserBan).where(
-                                UserBan.is_active == True,
-                                UserBan.banned_until.isnot(None),
-                                UserBan.banned_until < now
-                            )
-                        )
-                        
-                        for ban in expired_bans.all():
-                            ban.is_active = False
-                            ban.unbanned_at = now
-                            
-                            # Включаем клиента обратно в 3x-UI
-                            credentials = await session.scalars(
-                                select(VpnCredential)
-                                .where(VpnCredential.user_id == ban.user_id)
-                                .where(VpnCredential.active == True)
-                                .options(selectinload(VpnCredential.server))
-                            )
-                            
-                            for cred in credentials.all():
-                                if not cred.server or not cred.user_uuid:
-                                    continue
-                                    
-                                server = cred.server
-                                if server.x3ui_api_url and server.x3ui_username and server.x3ui_password and server.x3ui_inbound_id:
-                                    try:
-                                        x3ui = X3UIAPI(
-                                            api_url=server.x3ui_api_url,
-                                            username=server.x3ui_username,
-                                            password=server.x3ui_password,
-                                        )
-                                        try:
-                                            await x3ui.enable_client(server.x3ui_inbound_id, cred.user_uuid)
-                                        finally:
-                                            await x3ui.close()
-                                    except Exception as e:
-                                        logging.error(f"Error enabling client after unban: {e}")
-                            
-                            logging.info(f"Автоматически снят бан с пользователя {ban.user_id}")
-                        
-                        await session.commit()
-                        
-                    except Exception as e:
-                        logging.error(f"Error in unban task: {e}", exc_info=True)
-                        await session.rollback()
-                        
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                logging.error(f"Error in unban task: {e}", exc_info=True)
+        logging.info(
+            f"Автоматически сняты баны с {len(unbanned_user_ids)} пользователей, "
+            f"включение {len(rows)} клиентов 3x-UI поставлено в outbox"
+        )
+    
+    # Фоновая сверка клиентов 3x-UI с БД
+    async def reconcile_panels():
+        """
+        Раз в час сверяет Inbounds 3x-UI с VPN credentials
+        
+        Расхождения применяются только при panel_reconcile_auto_apply=true,
+        иначе отчет пишется в лог (dry-run).
+        """
+        from core.db.session import SessionLocal
+        
+        async with SessionLocal() as session:
+            auto_apply_setting = await session.scalar(
+                select(SystemSetting).where(SystemSetting.key == "panel_reconcile_auto_apply")
+            )
+            auto_apply = bool(auto_apply_setting and auto_apply_setting.value.lower() in ("true", "1", "yes"))
             
-            # Проверяем каждые 10 минут
-            await asyncio.sleep(600)
+            servers = (await session.scalars(
+                select(Server)
+                .where(Server.is_enabled == True)
+                .where(Server.x3ui_api_url.isnot(None))
+                .where(Server.x3ui_inbound_id.isnot(None))
+            )).all()
+            limit_ip, total_gb = await _get_vpn_client_limits(session)
+        
+        await reconcile_servers(servers, limit_ip, total_gb, dry_run=not auto_apply)
+    
+    # Фоновая задача применения outbox изменений 3x-UI
+    async def apply_panel_outbox() -> bool:
+        """Применяет отложенные изменения клиентов 3x-UI; True, если пачка была не пустой (сразу следующая)"""
+        return await process_panel_outbox() > 0
+    
+    # Отложенные действия (core.delayed_jobs); True, если пачка была не пустой (сразу следующая)
+    async def run_delayed_jobs() -> bool:
+        return await process_delayed_jobs() > 0
+    
+    # Массовые рассылки (core.broadcast): пачка за запуск, пока есть активная рассылка
+    async def run_broadcasts() -> bool:
+        return await run_broadcast_batch()
+    
+    # Точные сроки подписок: обработка ровно к ближайшему дедлайну (ежечасная проверка — страховка)
+    async def process_subscription_deadlines() -> bool:
+        return await expiry_scheduler.run_once(_process_subscription_deadlines)
+    
+    # Автопродление истекших подписок с баланса (core.renewal)
+    async def process_auto_renewals():
+        await _process_auto_renewals()
+    
+    scheduler.add_job("auto_backup", auto_backup, interval=86400)
+    scheduler.add_job("payments_cleanup", close_old_pending_payments, interval=3600)
+    scheduler.add_job("subscription_check", check_expired_subscriptions, interval=3600, initial_delay=3600)
+    scheduler.add_job("auto_renew", process_auto_renewals, interval=600, initial_delay=60)
+    scheduler.add_job("subscription_deadlines", process_subscription_deadlines, interval=60, initial_delay=10)
+    scheduler.add_job("server_health", check_servers_status, interval=60, initial_delay=5, fixed_rate=True)
+    scheduler.add_job("server_history", maintain_status_history, interval=600, initial_delay=120)
+    scheduler.add_job("ip_monitor", monitor_client_ips, interval=300, initial_delay=120)
+    scheduler.add_job("unban", unban_expired_users, interval=600, initial_delay=180)
+    scheduler.add_job("panel_reconcile", reconcile_panels, interval=3600, initial_delay=600)
+    scheduler.add_job("panel_outbox", apply_panel_outbox, interval=2, initial_delay=5)
+    scheduler.add_job("delayed_jobs", run_delayed_jobs, interval=5, initial_delay=5)
+    scheduler.add_job("broadcasts", run_broadcasts, interval=10, initial_delay=15)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await prepare_database()
     
-    unban_task = asyncio.create_task(unban_expired_users())
+    # Без фоновых задач API масштабируется независимо: их выполняет python -m core.worker
+    run_background_jobs = settings.background_jobs_enabled
+    if run_background_jobs:
+        register_background_jobs(job_scheduler)
+        job_scheduler.start()
+    else:
+        logger.info("Фоновые задачи в процессе API отключены (BACKGROUND_JOBS_ENABLED=false)")
     
     yield
     
-    monitor_task.cancel()
-    backup_task.cancel()
-    payments_cleanup_task.cancel()
-    subscription_check_task.cancel()
-    server_check_task.cancel()
-    ip_monitor_task.cancel()
-    unban_task.cancel()
-    try:
-        await monitor_task
-        await backup_task
-        await payments_cleanup_task
-        await subscription_check_task
-        await server_check_task
-        await ip_monitor_task
-        await unban_task
-    except asyncio.CancelledError:
-        pass
+    if run_background_jobs:
+        await job_scheduler.stop()
+        await expiry_scheduler.close()
+    
+    # Досылаем очередь уведомлений и закрываем постоянные сессии 3x-UI
+    await telegram_dispatcher.close()
+    await x3ui_registry.close_all()
 
 
 app = FastAPI(title="fioreVPN Core API", version="0.1.0", lifespan=lifespan)
@@ -1775,6 +1667,44 @@ async def _fetch_avatar_url(tg_id: int, bot_token: str) -> str | None:
         return None
 
 
+JOB_TICKET_AUTOCLOSE = "ticket_autoclose"
+TICKET_AUTOCLOSE_DELAY = timedelta(minutes=5)
+
+
+@register_delayed_job(JOB_TICKET_AUTOCLOSE)
+async def _autoclose_ticket(payload: dict) -> None:
+    """Закрывает новый тикет, если пользователь так и не написал в поддержку (core.delayed_jobs)"""
+    ticket_id = int(payload["ticket_id"])
+    async with SessionLocal() as s:
+        t = await s.scalar(select(Ticket).where(Ticket.id == ticket_id))
+        # Тикеты создаются со статусом new (open — legacy значение старой БД)
+        if not t or t.status not in (TicketStatus.new, TicketStatus.open):
+            return
+        # есть ли входящие сообщения (пользователь) позже создания
+        has_incoming = await s.scalar(
+            select(func.count())
+            .select_from(TicketMessage)
+            .where(
+                TicketMessage.ticket_id == ticket_id,
+                TicketMessage.direction == MessageDirection.incoming,
+                TicketMessage.created_at > t.created_at,
+            )
+        )
+        if has_incoming and has_incoming > 0:
+            return
+        t.status = TicketStatus.closed
+        t.closed_at = datetime.utcnow()
+        t.updated_at = t.closed_at
+        s.add(
+            AuditLog(
+                action=AuditLogAction.admin_action,
+                user_tg_id=t.user_tg_id,
+                details=f"Ticket #{t.id} auto-closed (no user response in 5 minutes)",
+            )
+        )
+        await s.commit()
+
+
 @app.post("/tickets/create")
 async def create_ticket(payload: dict, session: AsyncSession = Depends(get_session)):
     tg_id = int(payload.get("tg_id") or 0)
@@ -1809,40 +1739,9 @@ async def create_ticket(payload: dict, session: AsyncSession = Depends(get_sessi
             details=f"Ticket #{ticket.id} created. Topic: {topic}",
         )
     )
+    # Автозакрытие, если пользователь не напишет в поддержку в течение 5 минут (строка в той же транзакции)
+    enqueue_delayed_job(session, JOB_TICKET_AUTOCLOSE, {"ticket_id": ticket.id}, delay=TICKET_AUTOCLOSE_DELAY)
     await session.commit()
-
-    # Планируем автозакрытие, если пользователь не напишет в поддержку в течение 5 минут
-    async def autoclose(ticket_id: int):
-        await asyncio.sleep(300)
-        async with SessionLocal() as s:
-            t = await s.scalar(select(Ticket).where(Ticket.id == ticket_id))
-            if not t or t.status != TicketStatus.open:
-                return
-            # есть ли входящие сообщения (пользователь) позже создания
-            has_incoming = await s.scalar(
-                select(func.count())
-                .select_from(TicketMessage)
-                .where(
-                    TicketMessage.ticket_id == ticket_id,
-                    TicketMessage.direction == MessageDirection.incoming,
-                    TicketMessage.created_at > t.created_at,
-                )
-            )
-            if has_incoming and has_incoming > 0:
-                return
-            t.status = TicketStatus.closed
-            t.closed_at = datetime.utcnow()
-            t.updated_at = t.closed_at
-            s.add(
-                AuditLog(
-                    action=AuditLogAction.admin_action,
-                    user_tg_id=t.user_tg_id,
-                    details=f"Ticket #{t.id} auto-closed (no user response in 5 minutes)",
-                )
-            )
-            await s.commit()
-
-    asyncio.create_task(autoclose(ticket.id))
     return {"ticket_id": ticket.id}
 
 
@@ -2047,6 +1946,8 @@ async def _update_user_subscription_status(user_id: int, session: AsyncSession)
     if active_sub:
         user.has_active_subscription = True
         user.subscription_ends_at = active_sub.ends_at
+        # Новый срок — в планировщик точных дедлайнов (уведомления и истечение)
+        await notify_subscription_deadline(session, user.id, active_sub.ends_at)
     else:
         user.has_active_subscription = False
         user.subscription_ends_at = None
@@ -2373,7 +2274,7 @@ async def upsert_user(payload: UserUpsertIn, session: AsyncSession = Depends(get
                         f"Вы получили <b>{referrer_reward_cents / 100:.2f} RUB</b> за приглашение нового пользователя.\n"
                         f"Ваш баланс: <b>{user.referred_by.balance / 100:.2f} RUB</b>"
                     )
-                    asyncio.create_task(_send_user_notification(user.referred_by.tg_id, notification_text))
+                    await _send_user_notification(user.referred_by.tg_id, notification_text)
             
             # Награда для приглашенного
             if referred_reward_cents > 0:
@@ -2408,7 +2309,7 @@ async def upsert_user(payload: UserUpsertIn, session: AsyncSession = Depends(get
                         f"Вы получили <b>{referred_reward_cents / 100:.2f} RUB</b> за регистрацию по реферальной ссылке.\n"
                         f"Ваш баланс: <b>{user.balance / 100:.2f} RUB</b>"
                     )
-                    asyncio.create_task(_send_user_notification(payload.tg_id, notification_text))
+                    await _send_user_notification(payload.tg_id, notification_text)
     # Обновляем данные пользователя (username может измениться)
     if payload.username is not None:
         user.username = payload.username
@@ -3227,13 +3128,12 @@ async def cryptobot_webhook(
                                     # Используем BOT_TOKEN из окружения
                                     bot_token = os.getenv("BOT_TOKEN")
                                     if bot_token:
-                                        import asyncio
-                                        asyncio.create_task(_send_user_notification(
+                                        await _send_user_notification(
                                             user.tg_id,
                                             notification_text,
                                             bot_token
-                                        ))
-                                        logging.info(f"Notification task created for user {user.tg_id}")
+                                        )
+                                        logging.info(f"Notification queued for user {user.tg_id}")
                                     else:
                                         logging.warning(f"BOT_TOKEN not found, cannot send notification to user {user.tg_id}")
                                 except Exception as e:
@@ -3320,12 +3220,11 @@ async def cryptobot_webhook(
                                     )
                                     bot_token = os.getenv("BOT_TOKEN")
                                     if bot_token:
-                                        import asyncio
-                                        asyncio.create_task(_send_user_notification(
+                                        await _send_user_notification(
                                             user.tg_id,
                                             notification_text,
                                             bot_token
-                                        ))
+                                        )
                                 except Exception as e:
                                     logging.error(f"Failed to send notification: {e}")
                     else:
@@ -3640,7 +3539,7 @@ async def purchase_subscription(
                 f"📅 Действует до: {ends_str} МСК\n"
                 f"💵 Остаток баланса: {user.balance / 100:.2f} RUB"
             )
-            asyncio.create_task(_send_user_notification(user.tg_id, notification_text))
+            await _send_user_notification(user.tg_id, notification_text)
         except Exception:
             pass  # Игнорируем ошибки отправки уведомлений
     
@@ -3729,7 +3628,7 @@ async def activate_trial(
                 f"📅 Действует до: {ends_str} МСК\n\n"
                 f"После окончания пробного периода вы сможете приобрести подписку."
             )
-            asyncio.create_task(_send_user_notification(user.tg_id, notification_text))
+            await _send_user_notification(user.tg_id, notification_text)
         except Exception:
             pass  # Игнорируем ошибки отправки уведомлений
     
@@ -3782,18 +3681,8 @@ async def _send_user_notification_with_menu_update(tg_id: int, text: str, bot_to
     """Отправляет уведомление пользователю и обновляет его меню"""
     try:
         from bot.keyboards import user_menu
-        from aiogram import Bot
-        from aiogram.types import ReplyKeyboardMarkup
         
         settings = get_settings()
-        if not bot_token:
-            bot_token = os.getenv("BOT_TOKEN", "") or settings.bot_token
-        
-        if not bot_token:
-            logger.warning(f"Не удалось отправить уведомление пользователю {tg_id}: bot_token не настроен")
-            return
-        
-        bot = Bot(token=bot_token)
         
         # Проверяем статус подписки для обновления меню
         has_subscription = False
@@ -3809,34 +3698,25 @@ async def _send_user_notification_with_menu_update(tg_id: int, text: str, bot_to
         is_admin = tg_id in set(settings.admin_ids)
         
         # Отправляем сообщение с обновленным меню
-        await bot.send_message(
-            chat_id=tg_id,
-            text=text,
-            parse_mode="HTML",
-            reply_markup=user_menu(is_admin=is_admin, has_subscription=has_subscription)
+        reply_markup = user_menu(is_admin=is_admin, has_subscription=has_subscription)
+        await telegram_dispatcher.enqueue(
+            tg_id,
+            text,
+            bot_token=bot_token,
+            reply_markup=reply_markup.model_dump(mode="json", exclude_none=True),
         )
-        
-        await bot.session.close()
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления с обновлением меню пользователю {tg_id}: {e}", exc_info=True)
 
 
 async def _send_user_notification(tg_id: int, text: str, bot_token: str | None = None) -> None:
-    """Отправляет уведомление пользователю в боте"""
-    if not bot_token:
-        bot_token = os.getenv("BOT_TOKEN")
-    if not bot_token:
-        return
+    """
+    Ставит уведомление пользователю в очередь отправки (core.telegram_dispatcher)
     
-    try:
-        import httpx
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            await client.post(
-                f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                json={"chat_id": tg_id, "text": text, "parse_mode": "HTML"},
-            )
-    except Exception:
-        pass  # Игнорируем ошибки отправки уведомлений
+    Повторы при 429/5xx и ограничение частоты выполняет диспетчер; при заполненной
+    очереди вызов ждет свободного места.
+    """
+    await telegram_dispatcher.enqueue(tg_id, text, bot_token=bot_token)
 
 
 @app.post("/admin/users/credit")
@@ -3890,7 +3770,7 @@ async def admin_credit_user(
         if payload.reason:
             notification_text += f"\n\nПричина: {payload.reason}"
     
-    asyncio.create_task(_send_user_notification(payload.tg_id, notification_text))
+    await _send_user_notification(payload.tg_id, notification_text)
     
     return {"tg_id": user.tg_id, "balance": user.balance, "new_balance_cents": user.balance}
 
@@ -3945,7 +3825,7 @@ async def admin_block_user(
         f"❌ <b>Аккаунт заблокирован</b>\n\n"
         f"Ваш аккаунт был заблокирован администратором."
     )
-    asyncio.create_task(_send_user_notification(tg_id, notification_text))
+    await _send_user_notification(tg_id, notification_text)
     
     return {"tg_id": user.tg_id, "is_active": False}
 
@@ -3977,7 +3857,7 @@ async def admin_unblock_user(
         f"✅ <b>Аккаунт разблокирован</b>\n\n"
         f"Ваш аккаунт был разблокирован администратором."
     )
-    asyncio.create_task(_send_user_notification(tg_id, notification_text))
+    await _send_user_notification(tg_id, notification_text)
     
     return {"tg_id": user.tg_id, "is_active": True}
 
@@ -4727,15 +4607,11 @@ async def admin_web_dashboard(
     servers = await session.scalars(select(Server).where(Server.is_enabled == True))
     servers_list = servers.all()
     servers_status = []
+    # Последние статусы всех серверов одним запросом
+    latest_by_server = await latest_statuses(session, [server.id for server in servers_list])
     
     for server in servers_list:
-        # Получаем последний статус сервера
-        latest_status = await session.scalar(
-            select(ServerStatus)
-            .where(ServerStatus.server_id == server.id)
-            .order_by(ServerStatus.checked_at.desc())
-            .limit(1)
-        )
+        latest_status = latest_by_server.get(server.id)
         
         servers_status.append({
             "id": server.id,
@@ -5766,7 +5642,7 @@ async def admin_web_block_user(
     )
     if reason:
         notification_text += f"\n\nПричина: {reason}"
-    asyncio.create_task(_send_user_notification(tg_id, notification_text))
+    await _send_user_notification(tg_id, notification_text)
     
     back = request.headers.get("referer") or f"/admin/web/users/{tg_id}"
     return RedirectResponse(url=back, status_code=303)
@@ -5868,7 +5744,7 @@ async def admin_web_unblock_user(
         f"✅ <b>Аккаунт разблокирован</b>\n\n"
         f"Ваш аккаунт был разблокирован администратором."
     )
-    asyncio.create_task(_send_user_notification(tg_id, notification_text))
+    await _send_user_notification(tg_id, notification_text)
     
     back = request.headers.get("referer") or f"/admin/web/users/{tg_id}"
     return RedirectResponse(url=back, status_code=303)
@@ -5933,16 +5809,8 @@ async def admin_web_vpn_ban_user(
         server = cred.server
         if server.x3ui_api_url and server.x3ui_username and server.x3ui_password and server.x3ui_inbound_id:
             try:
-                from core.x3ui_api import X3UIAPI
-                x3ui = X3UIAPI(
-                    api_url=server.x3ui_api_url,
-                    username=server.x3ui_username,
-                    password=server.x3ui_password,
-                )
-                try:
-                    await x3ui.disable_client(server.x3ui_inbound_id, cred.user_uuid)
-                finally:
-                    await x3ui.close()
+                x3ui = await x3ui_registry.get(server)
+                await x3ui.disable_client(server.x3ui_inbound_id, cred.user_uuid)
             except Exception as e:
                 logger.error(f"Error disabling client for ban: {e}")
     
@@ -5964,7 +5832,7 @@ async def admin_web_vpn_ban_user(
         f"Срок: {duration_text}\n\n"
         "Если вы считаете это ошибкой, обратитесь в поддержку."
     )
-    asyncio.create_task(_send_user_notification(tg_id, notification_text))
+    await _send_user_notification(tg_id, notification_text)
     
     back = request.headers.get("referer") or f"/admin/web/users/{tg_id}"
     return RedirectResponse(url=back, status_code=303)
@@ -6014,16 +5882,8 @@ async def admin_web_vpn_unban_user(
         server = cred.server
         if server.x3ui_api_url and server.x3ui_username and server.x3ui_password and server.x3ui_inbound_id:
             try:
-                from core.x3ui_api import X3UIAPI
-                x3ui = X3UIAPI(
-                    api_url=server.x3ui_api_url,
-                    username=server.x3ui_username,
-                    password=server.x3ui_password,
-                )
-                try:
-                    await x3ui.enable_client(server.x3ui_inbound_id, cred.user_uuid)
-                finally:
-                    await x3ui.close()
+                x3ui = await x3ui_registry.get(server)
+                await x3ui.enable_client(server.x3ui_inbound_id, cred.user_uuid)
             except Exception as e:
                 logger.error(f"Error enabling client for unban: {e}")
     
@@ -6042,7 +5902,7 @@ async def admin_web_vpn_unban_user(
         f"✅ <b>Ваш VPN доступ восстановлен</b>\n\n"
         "Вы снова можете пользоваться VPN."
     )
-    asyncio.create_task(_send_user_notification(tg_id, notification_text))
+    await _send_user_notification(tg_id, notification_text)
     
     back = request.headers.get("referer") or f"/admin/web/users/{tg_id}"
     return RedirectResponse(url=back, status_code=303)
@@ -6131,7 +5991,7 @@ async def admin_web_credit_user(
         if reason:
             notification_text += f"\n\nПричина: {reason}"
     
-    asyncio.create_task(_send_user_notification(tg_id, notification_text))
+    await _send_user_notification(tg_id, notification_text)
     
     back = request.headers.get("referer") or f"/admin/web/users/{tg_id}"
     return RedirectResponse(url=back, status_code=303)
@@ -6198,24 +6058,16 @@ async def admin_web_manage_subscription(
                 server = cred.server
                 if server.x3ui_api_url and server.x3ui_username and server.x3ui_password:
                     try:
-                        from core.x3ui_api import X3UIAPI
-                        x3ui = X3UIAPI(
-                            api_url=server.x3ui_api_url,
-                            username=server.x3ui_username,
-                            password=server.x3ui_password,
-                        )
-                        try:
-                            client_email = f"tg_{user.tg_id}_server_{server.id}@fiorevpn"
-                            inbound_id = server.x3ui_inbound_id
-                            if inbound_id:
-                                deleted = await x3ui.delete_client(inbound_id, client_email)
-                                if deleted:
-                                    logger.info(f"Удален клиент {client_email} из 3x-UI при отмене подписки")
-                                    deleted_clients += 1
-                                # Помечаем credential как неактивный
-                                cred.active = False
-                        finally:
-                            await x3ui.close()
+                        x3ui = await x3ui_registry.get(server)
+                        client_email = f"tg_{user.tg_id}_server_{server.id}@fiorevpn"
+                        inbound_id = server.x3ui_inbound_id
+                        if inbound_id:
+                            deleted = await x3ui.delete_client(inbound_id, client_email)
+                            if deleted:
+                                logger.info(f"Удален клиент {client_email} из 3x-UI при отмене подписки")
+                                deleted_clients += 1
+                            # Помечаем credential как неактивный
+                            cred.active = False
                     except Exception as e:
                         logger.error(f"Error deleting client from 3x-UI when canceling subscription: {e}")
             
@@ -6243,7 +6095,7 @@ async def admin_web_manage_subscription(
                 f"Причина: {reason}"
             )
             # Отправляем уведомление и обновляем меню пользователя
-            asyncio.create_task(_send_user_notification_with_menu_update(tg_id, notification_text))
+            await _send_user_notification_with_menu_update(tg_id, notification_text)
             
             return JSONResponse({"success": True, "message": f"Отменено подписок: {canceled_count}, удалено клиентов из 3x-UI: {deleted_clients}"})
         
@@ -6293,7 +6145,7 @@ async def admin_web_manage_subscription(
                 f"📅 Подписка действует до: <b>{ends_str} МСК</b>\n\n"
                 f"Причина: {reason}"
             )
-            asyncio.create_task(_send_user_notification(tg_id, notification_text))
+            await _send_user_notification(tg_id, notification_text)
             
             return JSONResponse({"success": True, "message": f"Подписка выдана на {days} дней"})
         
@@ -6356,7 +6208,7 @@ async def admin_web_manage_subscription(
                 f"📅 Подписка теперь действует до: <b>{ends_str} МСК</b>\n\n"
                 f"Причина: {reason}"
             )
-            asyncio.create_task(_send_user_notification(tg_id, notification_text))
+            await _send_user_notification(tg_id, notification_text)
             
             return JSONResponse({"success": True, "message": f"Подписка продлена на {days} дней"})
         
@@ -6399,16 +6251,8 @@ async def admin_web_send_message(
 
     # Отправляем сообщение от имени бота
     try:
-        import httpx
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            r = await client.post(
-                f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                json={"chat_id": tg_id, "text": text},
-            )
-            if r.status_code != 200 or not r.json().get("ok"):
-                back = request.headers.get("referer") or f"/admin/web/users/{tg_id}"
-                return RedirectResponse(url=f"{back}?error=send_failed", status_code=303)
-    except Exception:
+        await telegram_dispatcher.send_message(tg_id, text, bot_token=bot_token, parse_mode=None)
+    except TelegramSendError:
         back = request.headers.get("referer") or f"/admin/web/users/{tg_id}"
         return RedirectResponse(url=f"{back}?error=send_failed", status_code=303)
 
@@ -6512,18 +6356,10 @@ async def admin_web_ticket_status(
     )
     await session.commit()
 
-    # Пытаемся уведомить пользователя через support-бот
-    try:
-        bot_token = os.getenv("SUPPORT_BOT_TOKEN", "") or get_settings().support_bot_token
-        if bot_token:
-            import httpx
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                await client.post(
-                    f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                    json={"chat_id": ticket.user_tg_id, "text": system_text},
-                )
-    except Exception:
-        pass
+    # Уведомляем пользователя через support-бот
+    bot_token = os.getenv("SUPPORT_BOT_TOKEN", "") or get_settings().support_bot_token
+    if bot_token:
+        await telegram_dispatcher.enqueue(ticket.user_tg_id, system_text, bot_token=bot_token, parse_mode=None)
 
     return RedirectResponse(url=f"/admin/web/tickets/{ticket_id}", status_code=303)
 
@@ -6559,28 +6395,6 @@ async def admin_api_ticket_messages(
         )
     return {"messages": items}
 
-@app.post("/tickets/create")
-async def create_ticket_endpoint(payload: dict, session: AsyncSession = Depends(get_session)):
-    """Создание тикета по запросу от основного бота."""
-    tg_id = int(payload.get("tg_id", 0))
-    topic = (payload.get("topic") or "").strip()
-    if not tg_id or not topic:
-        raise HTTPException(status_code=400, detail="tg_id_and_topic_required")
-
-    now = datetime.utcnow()
-    ticket = Ticket(
-        user_tg_id=tg_id,
-        topic=topic,
-        status=TicketStatus.new,
-        created_at=now,
-        updated_at=now,
-    )
-    session.add(ticket)
-    await session.commit()
-    await session.refresh(ticket)
-    return {"ticket_id": ticket.id}
-
-
 @app.get("/admin/web/tickets", response_class=HTMLResponse)
 async def admin_web_tickets(
     request: Request,
@@ -7668,29 +7482,132 @@ async def admin_api_promo_code_detail(
     }
 
 
-@app.post("/admin/web/promo-codes/{promo_id}/toggle")
-async def admin_web_toggle_promo_code(
-    promo_id: int,
+@app.post("/admin/web/promo-codes/{promo_id}/toggle")
+async def admin_web_toggle_promo_code(
+    promo_id: int,
+    request: Request,
+    session: AsyncSession = Depends(get_session),
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """Активация/деактивация промокода"""
+    await _require_csrf(request)
+    promo = await session.scalar(select(PromoCode).where(PromoCode.id == promo_id))
+    if not promo:
+        return RedirectResponse(url="/admin/web/promo-codes?error=not_found", status_code=303)
+    
+    promo.is_active = not promo.is_active
+    session.add(
+        AuditLog(
+            action=AuditLogAction.admin_action,
+            admin_tg_id=admin_user.get("tg_id"),
+            details=f"Промокод {promo.code} {'активирован' if promo.is_active else 'деактивирован'}",
+        )
+    )
+    await session.commit()
+    return RedirectResponse(url="/admin/web/promo-codes?success=toggled", status_code=303)
+
+
+BROADCAST_ACTIONS = {"pause": BROADCAST_PAUSED, "resume": BROADCAST_RUNNING, "cancel": BROADCAST_CANCELLED}
+
+
+@app.get("/admin/web/broadcasts", response_class=HTMLResponse)
+async def admin_web_broadcasts(
+    request: Request,
+    session: AsyncSession = Depends(get_session),
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """Страница массовых рассылок"""
+    if not templates:
+        return HTMLResponse(content="<h1>Шаблоны не настроены</h1>", status_code=500)
+    
+    servers = await session.scalars(select(Server).order_by(Server.name))
+    return templates.TemplateResponse("broadcasts.html", {
+        "request": request,
+        "admin_user": admin_user,
+        "servers": servers.all(),
+        "csrf_token": _get_csrf_token(request),
+    })
+
+
+@app.get("/admin/web/api/broadcasts")
+async def admin_api_broadcasts(
+    session: AsyncSession = Depends(get_session),
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """API: последние рассылки и их прогресс (для автообновления страницы)"""
+    broadcasts = await session.scalars(select(Broadcast).order_by(Broadcast.id.desc()).limit(50))
+    now = datetime.now(timezone.utc)
+    return {"broadcasts": [broadcast_snapshot(broadcast, now) for broadcast in broadcasts.all()]}
+
+
+@app.post("/admin/web/broadcasts/create")
+async def admin_web_create_broadcast(
     request: Request,
     session: AsyncSession = Depends(get_session),
     admin_user: dict = Depends(_require_web_admin),
 ):
-    """Активация/деактивация промокода"""
+    """Создание рассылки; отправку выполняет фоновая задача broadcasts"""
     await _require_csrf(request)
-    promo = await session.scalar(select(PromoCode).where(PromoCode.id == promo_id))
-    if not promo:
-        return RedirectResponse(url="/admin/web/promo-codes?error=not_found", status_code=303)
+    form = await request.form()
+    text_message = (form.get("text") or "").strip()
+    segment = form.get("segment") or ""
+    parse_mode = form.get("parse_mode") or None
+    try:
+        server_id = int(form.get("server_id") or 0) or None
+    except (ValueError, TypeError):
+        return RedirectResponse(url="/admin/web/broadcasts?error=invalid_payload", status_code=303)
+    if (
+        segment not in SEGMENTS
+        or parse_mode not in BROADCAST_PARSE_MODES
+        or not text_message
+        or (segment == SEGMENT_SERVER and not server_id)
+    ):
+        return RedirectResponse(url="/admin/web/broadcasts?error=invalid_payload", status_code=303)
+    
+    broadcast = await create_broadcast(
+        session,
+        text_message,
+        segment,
+        server_id=server_id,
+        created_by_tg_id=admin_user.get("tg_id"),
+        parse_mode=parse_mode,
+    )
+    session.add(
+        AuditLog(
+            action=AuditLogAction.admin_action,
+            admin_tg_id=admin_user.get("tg_id"),
+            details=f"Создана рассылка #{broadcast.id} (сегмент {segment}, получателей ~{broadcast.total_count})",
+        )
+    )
+    await session.commit()
+    return RedirectResponse(url="/admin/web/broadcasts?success=created", status_code=303)
+
+
+@app.post("/admin/web/broadcasts/{broadcast_id}/{action}")
+async def admin_web_broadcast_action(
+    broadcast_id: int,
+    action: str,
+    request: Request,
+    session: AsyncSession = Depends(get_session),
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """Приостановить, продолжить или отменить рассылку"""
+    await _require_csrf(request)
+    status = BROADCAST_ACTIONS.get(action)
+    if status is None:
+        return JSONResponse({"success": False, "error": "unknown_action"}, status_code=400)
+    if not await set_broadcast_status(session, broadcast_id, status):
+        return JSONResponse({"success": False, "error": "invalid_state"}, status_code=409)
     
-    promo.is_active = not promo.is_active
     session.add(
         AuditLog(
             action=AuditLogAction.admin_action,
             admin_tg_id=admin_user.get("tg_id"),
-            details=f"Промокод {promo.code} {'активирован' if promo.is_active else 'деактивирован'}",
+            details=f"Рассылка #{broadcast_id}: {action}",
         )
     )
     await session.commit()
-    return RedirectResponse(url="/admin/web/promo-codes?success=toggled", status_code=303)
+    return JSONResponse({"success": True})
 
 
 @app.get("/admin/web/backups", response_class=HTMLResponse)
@@ -7763,8 +7680,8 @@ async def admin_web_create_backup(
     if not expected or not provided or provided != expected:
         return RedirectResponse(url="/admin/web/backups?error=csrf_forbidden", status_code=303)
     
-    # Создаем бэкап в фоне
-    asyncio.create_task(_create_database_backup(created_by_tg_id=admin_user.get("tg_id")))
+    # Создаем бэкап в фоне: отложенное действие выполнит узел с фоновыми задачами (core.worker)
+    enqueue_delayed_job(session, JOB_DATABASE_BACKUP, {"created_by_tg_id": admin_user.get("tg_id")})
     
     # Логируем действие
     session.add(
@@ -8068,9 +7985,94 @@ async def admin_web_restore_backup(
     return JSONResponse({"success": True, "message": "Восстановление запущено. Это может занять несколько минут."})
 
 
+async def _get_vpn_client_limits(session: AsyncSession) -> tuple[int, int]:
+    """Лимиты клиента 3x-UI из SystemSetting: (лимит IP, лимит трафика в GB)"""
+    limit_ip_setting = await session.scalar(select(SystemSetting).where(SystemSetting.key == "vpn_limit_ip"))
+    limit_traffic_setting = await session.scalar(select(SystemSetting).where(SystemSetting.key == "vpn_limit_traffic_gb"))
+    
+    limit_ip = 1  # По умолчанию 1 IP
+    if limit_ip_setting:
+        try:
+            limit_ip = int(limit_ip_setting.value)
+        except (ValueError, TypeError):
+            limit_ip = 1
+    
+    total_gb = 0  # По умолчанию без ограничений
+    if limit_traffic_setting:
+        try:
+            total_gb = int(float(limit_traffic_setting.value))
+        except (ValueError, TypeError):
+            total_gb = 0
+    
+    return limit_ip, total_gb
+
+
+async def _enqueue_clients_enabled(
+    session: AsyncSession,
+    clients: list[tuple[VpnCredential, int, Server]],
+    enable: bool,
+) -> None:
+    """
+    Включить или отключить клиентов 3x-UI через outbox (commit делает вызывающий код)
+
+    Строка ensure_client описывает клиента целиком (UUID, срок, enable), поэтому
+    изменение enable попадает в ту же транзакцию, что и бан, и повторяется outbox
+    до успеха, а не теряется при ошибке панели.
+
+    Args:
+        session: Сессия БД
+        clients: (credential, tg_id пользователя, сервер credential)
+        enable: True — включить, False — отключить
+    """
+    if not clients:
+        return
+    limit_ip, total_gb = await _get_vpn_client_limits(session)
+    for credential, tg_id, server in clients:
+        credential.panel_status = PANEL_STATUS_PENDING
+        await enqueue_panel_op(
+            session,
+            server_id=server.id,
+            operation=OP_ENSURE_CLIENT,
+            client_email=client_email_for(tg_id, server.id),
+            client_uuid=credential.user_uuid,
+            payload={
+                "expire_ms": int(credential.expires_at.timestamp() * 1000) if credential.expires_at else 0,
+                "limit_ip": limit_ip,
+                "total_gb": total_gb,
+                "flow": server.xray_flow or "",
+                "enable": enable,
+            },
+            credential_id=credential.id,
+        )
+
+
+def _build_server_vless_config(server: Server, user_uuid: str) -> str:
+    """VLESS конфиг клиента из параметров сервера (UUID клиента в 3x-UI)"""
+    return generate_vless_config(
+        user_uuid=user_uuid,
+        server_host=server.host,
+        server_port=server.xray_port or 443,
+        server_uuid=user_uuid,  # Используем UUID пользователя
+        server_flow=server.xray_flow,
+        server_network=server.xray_network or "tcp",
+        server_security=server.xray_security or "tls",
+        server_sni=server.xray_sni,
+        server_reality_public_key=server.xray_reality_public_key,
+        server_reality_short_id=server.xray_reality_short_id,
+        server_path=server.xray_path,
+        server_host_header=server.xray_host,
+        remark=f"{server.name}",
+    )
+
+
 async def _generate_vpn_config_for_user_server(user_id: int, server_id: int, session: AsyncSession, expires_at: datetime):
-    """Генерирует VPN конфиг для пользователя на указанном сервере"""
-    import json
+    """
+    Генерирует VPN конфиг для пользователя на указанном сервере
+    
+    Для серверов с API 3x-UI в панель не ходим: UUID генерируется здесь, конфиг строится
+    из параметров сервера, а создание клиента записывается в outbox в той же транзакции
+    (credential получает panel_status=pending до применения изменения обработчиком outbox).
+    """
     # Получаем конкретный сервер
     server = await session.scalar(
         select(Server)
@@ -8088,7 +8090,6 @@ async def _generate_vpn_config_for_user_server(user_id: int, server_id: int, ses
     if not user:
         return
     
-    # Создаем конфиг для сервера
     # Проверяем, нет ли уже активного конфига для этого сервера
     existing = await session.scalar(
         select(VpnCredential)
@@ -8097,225 +8098,13 @@ async def _generate_vpn_config_for_user_server(user_id: int, server_id: int, ses
         .where(VpnCredential.active == True)
     )
     
-    config_text = None
-    user_uuid = None
-    
-    # Если сервер использует API 3x-UI - создаем клиента автоматически
-    if server.x3ui_api_url and server.x3ui_username and server.x3ui_password:
-        from core.x3ui_api import X3UIAPI
-        from core.xray import generate_uuid
-        
-        config_text = None
-        user_uuid = None
-        x3ui = None
-        
-        try:
-            x3ui = X3UIAPI(
-                api_url=server.x3ui_api_url,
-                username=server.x3ui_username,
-                password=server.x3ui_password,
-            )
-            
-            # Определяем ID инбаунда (простой подход - требуем указания ID)
-            inbound_id = server.x3ui_inbound_id
-            
-            if not inbound_id:
-                # Если ID не указан, пробуем найти автоматически (fallback)
-                logger.warning(f"Inbound ID не указан для сервера {server.name}, пытаемся найти автоматически")
-                found_inbound = await x3ui.find_first_vless_inbound()
-                
-                if found_inbound:
-                    inbound_id = found_inbound.get("id")
-                    logger.info(f"Автоматически найден VLESS Inbound ID {inbound_id} для сервера {server.name}")
-                    # Сохраняем найденный ID в базу данных
-                    server.x3ui_inbound_id = inbound_id
-                    await session.commit()
-                else:
-                    # Логируем все доступные Inbounds для отладки
-                    all_inbounds = await x3ui.list_inbounds()
-                    if all_inbounds:
-                        inbound_list = []
-                        for inb in all_inbounds:
-                            inbound_list.append({
-                                "id": inb.get("id"),
-                                "port": inb.get("port"),
-                                "protocol": inb.get("protocol"),
-                                "remark": inb.get("remark", ""),
-                                "enable": inb.get("enable", False)
-                            })
-                        logger.error(f"Доступные Inbounds в 3x-UI для сервера {server.name}: {inbound_list}")
-                        inbound_info = ", ".join([f"ID:{inb['id']} ({inb['protocol']}, порт:{inb['port']})" for inb in inbound_list])
-                        raise ValueError(
-                            f"Inbound ID не указан для сервера {server.name} и не найден VLESS Inbound автоматически. "
-                            f"Доступные Inbounds: {inbound_info}. "
-                            f"Укажите правильный Inbound ID в настройках сервера."
-                        )
-                    else:
-                        logger.error(f"Не удалось получить список Inbounds из 3x-UI для сервера {server.name}")
-                        raise ValueError(
-                            f"Inbound ID не указан для сервера {server.name} и не удалось получить список Inbounds. "
-                            f"Проверьте настройки API 3x-UI (URL: {server.x3ui_api_url}, username: {server.x3ui_username})."
-                        )
-            
-            # Генерируем уникальный email для клиента с tg_id
-            client_email = f"tg_{user.tg_id}_server_{server.id}@fiorevpn"
-            
-            # ВАЖНО: Удаляем существующего клиента перед созданием нового (для regenerate и duplicate email)
-            # Игнорируем ошибки, так как клиент может не существовать (например, при первой генерации)
-            try:
-                deleted = await x3ui.delete_client(inbound_id, client_email)
-                if deleted:
-                    logger.info(f"Удален существующий клиент {client_email} из Inbound {inbound_id}")
-                else:
-                    logger.debug(f"Клиент {client_email} не найден в Inbound {inbound_id} (это нормально для новой генерации)")
-            except Exception as del_err:
-                # Не критичная ошибка - клиент может не существовать
-                logger.debug(f"Не удалось удалить клиента {client_email} (возможно, его нет): {del_err}")
-            
-            # Получаем настройки лимитов из SystemSetting
-            limit_ip_setting = await session.scalar(select(SystemSetting).where(SystemSetting.key == "vpn_limit_ip"))
-            limit_traffic_setting = await session.scalar(select(SystemSetting).where(SystemSetting.key == "vpn_limit_traffic_gb"))
-            
-            limit_ip = 1  # По умолчанию 1 IP
-            if limit_ip_setting:
-                try:
-                    limit_ip = int(limit_ip_setting.value)
-                except (ValueError, TypeError):
-                    limit_ip = 1
-            
-            total_gb = 0  # По умолчанию без ограничений
-            if limit_traffic_setting:
-                try:
-                    total_gb = int(float(limit_traffic_setting.value))
-                except (ValueError, TypeError):
-                    total_gb = 0
-            
-            # Создаем клиента в 3x-UI
-            expire_timestamp = int(expires_at.timestamp() * 1000) if expires_at else 0  # 3x-UI использует миллисекунды
-            logger.info(
-                f"Создание клиента через 3x-UI API для пользователя {user_id} (tg_id: {user.tg_id}) на сервере {server.name} (ID: {server.id}): "
-                f"API URL={server.x3ui_api_url}, Inbound ID={inbound_id}, email={client_email}"
-            )
-            
-            try:
-                client_data = await x3ui.add_client(
-                    inbound_id=inbound_id,
-                    email=client_email,
-                    uuid=None,  # Автоматическая генерация
-                    flow=server.xray_flow or "",
-                    expire=expire_timestamp,
-                    limit_ip=limit_ip,
-                    total_gb=total_gb,  # Лимит трафика из настроек (0 = без ограничений)
-                )
-            except ConnectionError as e:
-                # Специальная обработка ошибок подключения
-                error_msg = str(e)
-                if "localhost" in server.x3ui_api_url or "127.0.0.1" in server.x3ui_api_url:
-                    error_msg = f"Не удалось подключиться к 3x-UI через SSH-туннель. Проверьте, что SSH-туннель запущен и порт доступен. Ошибка: {e}"
-                logger.error(f"Ошибка подключения к 3x-UI для сервера {server.name}: {error_msg}")
-                raise ValueError(error_msg) from e
-            except Exception as e:
-                logger.error(f"Ошибка при создании клиента в 3x-UI для сервера {server.name}: {e}")
-                raise
-            
-            if client_data:
-                # Получаем UUID созданного клиента
-                user_uuid = client_data.get("id") or client_data.get("uuid")
-                
-                if not user_uuid:
-                    logger.warning(f"Не удалось получить UUID для клиента {client_email} из ответа API 3x-UI")
-                    raise ValueError(f"Не удалось получить UUID для клиента на сервере {server.name}")
-                
-                # Генерируем конфиг напрямую из параметров сервера (как в примере ChatGPT)
-                from core.xray import generate_vless_config
-                config_text = generate_vless_config(
-                    user_uuid=user_uuid,
-                    server_host=server.host,
-                    server_port=server.xray_port or 443,
-                    server_uuid=user_uuid,  # Используем UUID пользователя
-                    server_flow=server.xray_flow,
-                    server_network=server.xray_network or "tcp",
-                    server_security=server.xray_security or "tls",
-                    server_sni=server.xray_sni,
-                    server_reality_public_key=server.xray_reality_public_key,
-                    server_reality_short_id=server.xray_reality_short_id,
-                    server_path=server.xray_path,
-                    server_host_header=server.xray_host,
-                    remark=f"{server.name}",
-                )
-                
-                if not config_text:
-                    logger.warning(f"Не удалось сгенерировать конфиг для клиента {client_email} на сервере {server.name}")
-                    raise ValueError(f"Не удалось сгенерировать конфиг для клиента на сервере {server.name}")
-            else:
-                # Клиент не был создан (инбаунд не найден или другая ошибка)
-                logger.warning(f"Не удалось создать клиента через API 3x-UI для сервера {server.name} (ID: {server.id}, Inbound ID: {server.x3ui_inbound_id})")
-                # Если есть UUID, используем fallback
-                if server.xray_uuid:
-                    logger.info(f"Используем fallback на UUID для сервера {server.name} (клиент не создан)")
-                    raise ValueError("INBOUND_NOT_FOUND_FALLBACK_TO_UUID")
-                raise ValueError(f"Не удалось создать клиента на сервере {server.name}")
-        except ValueError as e:
-            error_msg = str(e)
-            # Если это специальный сигнал для fallback на UUID
-            if error_msg == "INBOUND_NOT_FOUND_FALLBACK_TO_UUID" and server.xray_uuid:
-                logger.info(f"Переходим на fallback с UUID для сервера {server.name}")
-                # Не устанавливаем config_text и user_uuid, чтобы код перешел к elif server.xray_uuid
-                config_text = None
-                user_uuid = None
-            elif "Inbound не найден" in error_msg and server.xray_uuid:
-                # Если Inbound не найден, но есть UUID, используем fallback
-                logger.info(f"Переходим на fallback с UUID для сервера {server.name} (Inbound не найден)")
-                config_text = None
-                user_uuid = None
-            else:
-                logger.warning(f"Ошибка при создании клиента через API 3x-UI для сервера {server.name}: {e}")
-                raise
-        except ConnectionError as e:
-            # Ошибка подключения (например, SSH-туннель не работает)
-            error_msg = str(e)
-            logger.error(f"Ошибка подключения к 3x-UI для сервера {server.name}: {error_msg}")
-            # Если есть UUID, используем fallback
-            if server.xray_uuid:
-                logger.info(f"Используем fallback на UUID для сервера {server.name} после ошибки подключения")
-                config_text = None
-                user_uuid = None
-            else:
-                # Пробрасываем ошибку с понятным сообщением
-                raise ValueError(f"Не удалось подключиться к 3x-UI для сервера {server.name}. {error_msg}")
-        except Exception as e:
-            import httpx
-            # Если это HTTP ошибка от 3x-UI API, пробрасываем её дальше для правильной обработки
-            if isinstance(e, (httpx.HTTPStatusError, httpx.RequestError)):
-                logger.warning(f"HTTP ошибка при создании клиента через API 3x-UI для сервера {server.name}: {e}")
-                raise
-            # Если есть UUID, пытаемся использовать fallback
-            if server.xray_uuid:
-                logger.info(f"Используем fallback на UUID для сервера {server.name} после ошибки API")
-                config_text = None
-                user_uuid = None
-            else:
-                logger.warning(f"Ошибка при создании клиента через API 3x-UI для сервера {server.name}: {e}")
-                raise
-        finally:
-            # Закрываем сессию 3x-UI API
-            if x3ui:
-                try:
-                    await x3ui.close()
-                except:
-                    pass
-        
-        # Если конфиг не был создан через API, но есть UUID, используем fallback
-        if not config_text or not user_uuid:
-            if server.xray_uuid:
-                logger.info(f"Используем fallback на UUID для сервера {server.name}")
-                # Переходим к генерации через UUID
-                pass
-            else:
-                raise ValueError(f"Не удалось сгенерировать конфиг для сервера {server.name}")
+    uses_x3ui = bool(server.x3ui_api_url and server.x3ui_username and server.x3ui_password)
     
-    # Если API 3x-UI не настроен или не удалось создать через API, используем старый способ с UUID
-    if (not config_text or not user_uuid) and server.xray_uuid:
+    if uses_x3ui:
+        user_uuid = generate_uuid()
+        config_text = _build_server_vless_config(server, user_uuid)
+    elif server.xray_uuid:
+        # API 3x-UI не настроен — старый способ с UUID сервера
         user_uuid = server.xray_uuid
         config_text = generate_vless_config(
             user_uuid=user_uuid,
@@ -8332,19 +8121,21 @@ async def _generate_vpn_config_for_user_server(user_id: int, server_id: int, ses
             server_host_header=server.xray_host,
             remark=f"{server.name}",
         )
-    elif not config_text or not user_uuid:
-        # Пропускаем серверы без настроек
+    else:
         raise ValueError(f"Сервер {server.name} не настроен (нет API 3x-UI и UUID)")
-        
+    
     if not config_text:
         raise ValueError(f"Не удалось сгенерировать конфиг для сервера {server.name}")
     
+    panel_status = PANEL_STATUS_PENDING if uses_x3ui else None
+    
     if existing:
         # Обновляем существующий конфиг
-        existing.expires_at = expires_at
-        existing.config_text = config_text
-        if user_uuid:
-            existing.user_uuid = user_uuid
+        credential = existing
+        credential.expires_at = expires_at
+        credential.config_text = config_text
+        credential.user_uuid = user_uuid
+        credential.panel_status = panel_status
     else:
         # Создаем новый конфиг
         credential = VpnCredential(
@@ -8354,9 +8145,32 @@ async def _generate_vpn_config_for_user_server(user_id: int, server_id: int, ses
             config_text=config_text,
             active=True,
             expires_at=expires_at,
+            panel_status=panel_status,
         )
         session.add(credential)
     
+    if uses_x3ui:
+        await session.flush()
+        limit_ip, total_gb = await _get_vpn_client_limits(session)
+        await enqueue_panel_op(
+            session,
+            server_id=server.id,
+            operation=OP_ENSURE_CLIENT,
+            client_email=client_email_for(user.tg_id, server.id),
+            client_uuid=user_uuid,
+            payload={
+                "expire_ms": int(expires_at.timestamp() * 1000) if expires_at else 0,  # 3x-UI использует миллисекунды
+                "limit_ip": limit_ip,
+                "total_gb": total_gb,
+                "flow": server.xray_flow or "",
+            },
+            credential_id=credential.id,
+        )
+        logger.info(
+            f"Создание клиента для пользователя {user_id} (tg_id: {user.tg_id}) на сервере {server.name} "
+            f"поставлено в outbox (UUID {user_uuid})"
+        )
+    
     await session.commit()
 
 
@@ -8377,17 +8191,13 @@ async def admin_web_servers(
     )
     servers = servers_result.all()
     
-    # Получаем последние статусы серверов
+    # Получаем последние статусы серверов (одним запросом)
+    latest_by_server = await latest_statuses(session, [server.id for server in servers])
     servers_with_status = []
     for server in servers:
-        last_status = await session.scalar(
-            select(ServerStatus)
-            .where(ServerStatus.server_id == server.id)
-            .order_by(ServerStatus.checked_at.desc())
-        )
         servers_with_status.append({
             "server": server,
-            "status": last_status,
+            "status": latest_by_server.get(server.id),
         })
     
     csrf_token = _get_csrf_token(request)
@@ -8414,14 +8224,11 @@ async def admin_api_servers(
     )
     servers = servers_result.all()
     
-    # Получаем последние статусы
+    # Получаем последние статусы (одним запросом)
+    latest_by_server = await latest_statuses(session, [server.id for server in servers])
     servers_list = []
     for server in servers:
-        last_status = await session.scalar(
-            select(ServerStatus)
-            .where(ServerStatus.server_id == server.id)
-            .order_by(ServerStatus.checked_at.desc())
-        )
+        last_status = latest_by_server.get(server.id)
         server_dict = {
             "id": server.id,
             "name": server.name,
@@ -8444,6 +8251,8 @@ async def admin_api_servers(
             "x3ui_username": server.x3ui_username,
             "x3ui_password": server.x3ui_password,
             "x3ui_inbound_id": server.x3ui_inbound_id,
+            # Состояние circuit breaker панели 3x-UI в этом процессе (closed / open / half_open)
+            "panel_circuit": x3ui_registry.breaker_state(server.id),
         }
         if last_status:
             # Время уже в UTC, на клиенте добавим +3 часа через JavaScript
@@ -8451,6 +8260,10 @@ async def admin_api_servers(
                 "is_online": last_status.is_online,
                 "response_time_ms": last_status.response_time_ms,
                 "connection_speed_mbps": float(last_status.connection_speed_mbps) if last_status.connection_speed_mbps else None,
+                "latency_p95_ms": float(last_status.latency_p95_ms) if last_status.latency_p95_ms is not None else None,
+                "jitter_ms": float(last_status.jitter_ms) if last_status.jitter_ms is not None else None,
+                "packet_loss_percent": float(last_status.packet_loss_percent) if last_status.packet_loss_percent is not None else None,
+                "panel_reachable": last_status.panel_reachable,
                 "checked_at": last_status.checked_at.isoformat() if last_status.checked_at else None,
             }
         servers_list.append(server_dict)
@@ -8472,17 +8285,10 @@ async def admin_api_get_server_inbounds(
     if not server.x3ui_api_url or not server.x3ui_username or not server.x3ui_password:
         raise HTTPException(status_code=400, detail="3x_ui_api_not_configured")
     
-    x3ui = None
     try:
-        from core.x3ui_api import X3UIAPI
-        x3ui = X3UIAPI(
-            api_url=server.x3ui_api_url,
-            username=server.x3ui_username,
-            password=server.x3ui_password,
-        )
-        
+        x3ui = await x3ui_registry.get(server)
         inbounds = await x3ui.list_inbounds()
-        if not inbounds:
+        if inbounds is None:
             return {"inbounds": [], "error": "Не удалось получить список Inbounds. Проверьте настройки API 3x-UI."}
         
         # Форматируем список Inbounds
@@ -8502,12 +8308,240 @@ async def admin_api_get_server_inbounds(
         import logging
         logging.error(f"Ошибка при получении списка Inbounds для сервера {server_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Ошибка при получении списка Inbounds: {str(e)}")
-    finally:
-        if x3ui:
-            try:
-                await x3ui.close()
-            except:
-                pass
+
+
+@app.post("/admin/web/api/servers/{server_id}/provision")
+async def admin_api_provision_server_clients(
+    server_id: int,
+    payload: ServerProvisionIn,
+    session: AsyncSession = Depends(get_session),
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """
+    API: Массово выдать VPN ключи пользователям на сервере
+    
+    Клиенты создаются в 3x-UI пачками (один addClient на chunk_size пользователей).
+    Если клиент с таким email уже есть в Inbound, используется его UUID.
+    Используется для массового онбординга, миграции между серверами и восстановления.
+    """
+    server = await session.get(Server, server_id)
+    if not server:
+        raise HTTPException(status_code=404, detail="server_not_found")
+    
+    if not server.x3ui_api_url or not server.x3ui_username or not server.x3ui_password:
+        raise HTTPException(status_code=400, detail="3x_ui_api_not_configured")
+    if not server.x3ui_inbound_id:
+        raise HTTPException(status_code=400, detail="inbound_id_not_configured")
+    
+    chunk_size = max(1, min(payload.chunk_size, 1000))
+    inbound_id = server.x3ui_inbound_id
+    
+    # Пользователи с активной подпиской: явно переданные или выбравшие этот сервер
+    users_stmt = (
+        select(User)
+        .where(User.has_active_subscription == True)
+        .where(User.subscription_ends_at.isnot(None))
+        .order_by(User.id)
+    )
+    if payload.tg_ids:
+        users_stmt = users_stmt.where(User.tg_id.in_(payload.tg_ids))
+    else:
+        users_stmt = users_stmt.where(User.selected_server_id == server.id)
+    users = (await session.scalars(users_stmt)).all()
+    
+    try:
+        x3ui = await x3ui_registry.get(server)
+        snapshot = await x3ui.get_snapshot(inbound_id, force_refresh=True)
+    except ConnectionError as e:
+        raise HTTPException(status_code=503, detail=f"3x_ui_unavailable: {e}")
+    if not snapshot:
+        raise HTTPException(status_code=503, detail="3x_ui_unavailable: inbound_not_found")
+    
+    limit_ip, total_gb = await _get_vpn_client_limits(session)
+    
+    provisioned = 0
+    already_present = 0
+    failed = 0
+    
+    for start in range(0, len(users), chunk_size):
+        chunk = users[start:start + chunk_size]
+        user_ids = [u.id for u in chunk]
+        
+        existing_creds = await session.scalars(
+            select(VpnCredential)
+            .where(VpnCredential.user_id.in_(user_ids))
+            .where(VpnCredential.server_id == server.id)
+            .where(VpnCredential.active == True)
+        )
+        creds_by_user = {cred.user_id: cred for cred in existing_creds.all()}
+        
+        uuid_by_user: dict[int, str] = {}
+        to_add = []
+        email_to_user: dict[str, User] = {}
+        for user in chunk:
+            client_email = f"tg_{user.tg_id}_server_{server.id}@fiorevpn"
+            present_uuid = snapshot.email_to_uuid.get(client_email)
+            if present_uuid:
+                uuid_by_user[user.id] = present_uuid
+                already_present += 1
+                continue
+            email_to_user[client_email] = user
+            to_add.append({
+                "email": client_email,
+                "uuid": generate_uuid(),
+                "flow": server.xray_flow or "",
+                "expire": int(user.subscription_ends_at.timestamp() * 1000),
+                "limit_ip": limit_ip,
+                "total_gb": total_gb,
+            })
+        
+        if to_add:
+            added = await x3ui.add_clients(inbound_id, to_add, chunk_size=chunk_size)
+            for client in added:
+                uuid_by_user[email_to_user[client["email"]].id] = client["uuid"]
+            provisioned += len(added)
+            failed += len(to_add) - len(added)
+        
+        for user in chunk:
+            user_uuid = uuid_by_user.get(user.id)
+            if not user_uuid:
+                continue
+            config_text = _build_server_vless_config(server, user_uuid)
+            cred = creds_by_user.get(user.id)
+            if cred:
+                cred.user_uuid = user_uuid
+                cred.config_text = config_text
+                cred.expires_at = user.subscription_ends_at
+            else:
+                session.add(
+                    VpnCredential(
+                        user_id=user.id,
+                        server_id=server.id,
+                        user_uuid=user_uuid,
+                        config_text=config_text,
+                        active=True,
+                        expires_at=user.subscription_ends_at,
+                    )
+                )
+        
+        await session.commit()
+    
+    session.add(
+        AuditLog(
+            action=AuditLogAction.admin_action,
+            admin_tg_id=admin_user.get("tg_id"),
+            details=(
+                f"Массовая выдача ключей на сервере {server.name} (ID: {server.id}): "
+                f"создано {provisioned}, уже были {already_present}, ошибок {failed}"
+            ),
+        )
+    )
+    await session.commit()
+    
+    return {
+        "server_id": server.id,
+        "users": len(users),
+        "provisioned": provisioned,
+        "already_present": already_present,
+        "failed": failed,
+    }
+
+
+@app.get("/admin/web/api/jobs")
+async def admin_api_jobs(
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """
+    API: Фоновые задачи на этом узле
+    
+    is_leader показывает, выполняется ли задача на узле, обработавшем запрос;
+    интервал задачи меняется настройкой job_interval_<name> (секунды).
+    """
+    return job_scheduler.snapshot()
+
+
+@app.post("/admin/web/api/servers/reconcile")
+async def admin_api_reconcile_servers(
+    payload: ServerReconcileIn,
+    session: AsyncSession = Depends(get_session),
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """
+    API: Сверить клиентов 3x-UI с VPN credentials на всех серверах
+    
+    С dry_run=true (по умолчанию) только возвращает отчет о расхождениях.
+    """
+    servers = (await session.scalars(
+        select(Server)
+        .where(Server.is_enabled == True)
+        .where(Server.x3ui_api_url.isnot(None))
+        .where(Server.x3ui_inbound_id.isnot(None))
+        .order_by(Server.id)
+    )).all()
+    
+    limit_ip, total_gb = await _get_vpn_client_limits(session)
+    chunk_size = max(1, min(payload.chunk_size, 1000))
+    diffs = await reconcile_servers(servers, limit_ip, total_gb, dry_run=payload.dry_run, chunk_size=chunk_size)
+    
+    if not payload.dry_run:
+        session.add(
+            AuditLog(
+                action=AuditLogAction.admin_action,
+                admin_tg_id=admin_user.get("tg_id"),
+                details="Сверка 3x-UI с БД на всех серверах: " + "; ".join(
+                    f"{diff.server_name}: +{len(diff.missing)} -{len(diff.orphaned)} "
+                    f"~{len(diff.updates())} ошибок {diff.failed}" + (f" ({diff.error})" if diff.error else "")
+                    for diff in diffs
+                ),
+            )
+        )
+        await session.commit()
+    
+    return {"dry_run": payload.dry_run, "servers": [diff.to_dict() for diff in diffs]}
+
+
+@app.post("/admin/web/api/servers/{server_id}/reconcile")
+async def admin_api_reconcile_server(
+    server_id: int,
+    payload: ServerReconcileIn,
+    session: AsyncSession = Depends(get_session),
+    admin_user: dict = Depends(_require_web_admin),
+):
+    """
+    API: Сверить клиентов 3x-UI сервера с VPN credentials
+    
+    С dry_run=true (по умолчанию) только возвращает отчет о расхождениях.
+    """
+    server = await session.get(Server, server_id)
+    if not server:
+        raise HTTPException(status_code=404, detail="server_not_found")
+    
+    if not server.x3ui_api_url or not server.x3ui_username or not server.x3ui_password:
+        raise HTTPException(status_code=400, detail="3x_ui_api_not_configured")
+    if not server.x3ui_inbound_id:
+        raise HTTPException(status_code=400, detail="inbound_id_not_configured")
+    
+    limit_ip, total_gb = await _get_vpn_client_limits(session)
+    chunk_size = max(1, min(payload.chunk_size, 1000))
+    diff = await reconcile_server(session, server, limit_ip, total_gb, dry_run=payload.dry_run, chunk_size=chunk_size)
+    if diff.error:
+        raise HTTPException(status_code=503, detail=f"3x_ui_unavailable: {diff.error}")
+    
+    if not payload.dry_run:
+        session.add(
+            AuditLog(
+                action=AuditLogAction.admin_action,
+                admin_tg_id=admin_user.get("tg_id"),
+                details=(
+                    f"Сверка 3x-UI с БД на сервере {server.name} (ID: {server.id}): "
+                    f"добавлено {len(diff.missing)}, удалено {len(diff.orphaned)}, "
+                    f"исправлено {len(diff.updates())}, ошибок {diff.failed}"
+                ),
+            )
+        )
+        await session.commit()
+    
+    return {"dry_run": payload.dry_run, **diff.to_dict()}
 
 
 @app.post("/admin/web/api/servers")
@@ -8618,6 +8652,7 @@ async def admin_api_update_server(
         server.x3ui_inbound_id = payload.x3ui_inbound_id
     
     await session.commit()
+    await x3ui_registry.invalidate(server_id)
     
     # Логируем обновление
     session.add(
@@ -8646,6 +8681,7 @@ async def admin_api_delete_server(
     server_name = server.name
     await session.delete(server)
     await session.commit()
+    await x3ui_registry.invalidate(server_id)
     
     # Логируем удаление
     session.add(
@@ -8675,17 +8711,13 @@ async def admin_api_check_server(
         logger.info(f"Ручная проверка сервера {server.name} (ID: {server_id})")
         
         # Проверяем состояние (используем тот же метод, что и автопроверка)
-        status_result = await _check_server_status(server)
+        result = await probe_server(server)
         
-        logger.info(f"Результат ручной проверки {server.name}: online={status_result['is_online']}, time={status_result.get('response_time_ms')}ms")
+        probe = result.availability
+        logger.info(f"Результат ручной проверки {server.name}: online={probe.is_online}, avg={probe.avg_ms}ms, loss={probe.loss_percent}%")
         
         # Сохраняем статус
-        status = ServerStatus(
-            server_id=server.id,
-            is_online=status_result["is_online"],
-            response_time_ms=status_result["response_time_ms"],
-            error_message=status_result["error_message"],
-        )
+        status = ServerStatus(**result.to_status_row())
         session.add(status)
         await session.commit()
         
@@ -8694,9 +8726,7 @@ async def admin_api_check_server(
             "server_id": server.id,
             "server_name": server.name,
             "status": {
-                "is_online": status_result["is_online"],
-                "response_time_ms": status_result["response_time_ms"],
-                "error_message": status_result["error_message"],
+                **result.to_dict(),
                 "checked_at": status.checked_at.isoformat() if status.checked_at else None,
             }
         }
@@ -8711,12 +8741,27 @@ async def admin_api_server_history(
     session: AsyncSession = Depends(get_session),
     admin_user: dict = Depends(_require_web_admin),
     limit: int = 100,
+    hours: float | None = Query(default=None, gt=0, le=24 * 400),
 ):
-    """API: Получить историю статусов сервера для графика"""
+    """
+    API: Получить историю статусов сервера для графика
+    
+    С hours возвращается период целиком в подходящем разрешении (сырые проверки,
+    часы или сутки, см. core.status_history), без него — последние limit проверок.
+    """
     server = await session.get(Server, server_id)
     if not server:
         raise HTTPException(status_code=404, detail="server_not_found")
     
+    if hours is not None:
+        resolution, history = await load_server_history(session, server.id, hours)
+        return {
+            "server_id": server.id,
+            "server_name": server.name,
+            "resolution": resolution,
+            "history": history,
+        }
+    
     # Получаем последние N записей статусов
     statuses_result = await session.scalars(
         select(ServerStatus)
@@ -8733,12 +8778,16 @@ async def admin_api_server_history(
             "checked_at": status.checked_at.isoformat() if status.checked_at else None,
             "is_online": status.is_online,
             "response_time_ms": status.response_time_ms,
+            "latency_p95_ms": float(status.latency_p95_ms) if status.latency_p95_ms is not None else None,
+            "jitter_ms": float(status.jitter_ms) if status.jitter_ms is not None else None,
+            "packet_loss_percent": float(status.packet_loss_percent) if status.packet_loss_percent is not None else None,
             "error_message": status.error_message,
         })
     
     return {
         "server_id": server.id,
         "server_name": server.name,
+        "resolution": "raw",
         "history": history,
     }
 
@@ -8758,14 +8807,11 @@ async def get_available_servers(
     )
     servers = servers_result.all()
     
-    # Получаем последние статусы
+    # Получаем последние статусы (одним запросом)
+    latest_by_server = await latest_statuses(session, [server.id for server in servers])
     servers_list = []
     for server in servers:
-        last_status = await session.scalar(
-            select(ServerStatus)
-            .where(ServerStatus.server_id == server.id)
-            .order_by(ServerStatus.checked_at.desc())
-        )
+        last_status = latest_by_server.get(server.id)
         server_dict = {
             "id": server.id,
             "name": server.name,
@@ -8814,52 +8860,17 @@ async def select_server_for_user(
     
     old_server_id = user.selected_server_id
     
-    # Если меняем сервер — удаляем клиента со старого сервера
-    # ВАЖНО: Это не должно блокировать смену сервера, поэтому все ошибки логируются, но не прерывают процесс
+    # Если меняем сервер — удаляем клиента со старого сервера через outbox (в той же транзакции)
     if old_server_id and old_server_id != server_id:
         old_server = await session.get(Server, old_server_id)
         if old_server and old_server.x3ui_api_url and old_server.x3ui_username and old_server.x3ui_password:
-            try:
-                from core.x3ui_api import X3UIAPI
-                import asyncio
-                
-                # Устанавливаем таймаут для удаления клиента со старого сервера (5 секунд)
-                async def delete_old_client():
-                    x3ui = None
-                    try:
-                        x3ui = X3UIAPI(
-                            api_url=old_server.x3ui_api_url,
-                            username=old_server.x3ui_username,
-                            password=old_server.x3ui_password,
-                        )
-                        client_email = f"tg_{user.tg_id}_server_{old_server.id}@fiorevpn"
-                        inbound_id = old_server.x3ui_inbound_id
-                        if inbound_id:
-                            # Пытаемся удалить с таймаутом
-                            deleted = await asyncio.wait_for(
-                                x3ui.delete_client(inbound_id, client_email),
-                                timeout=5.0
-                            )
-                            if deleted:
-                                logger.info(f"Удален клиент {client_email} со старого сервера {old_server.name}")
-                            else:
-                                logger.info(f"Клиент {client_email} не найден на старом сервере {old_server.name} (возможно, уже удален)")
-                    except asyncio.TimeoutError:
-                        logger.warning(f"Таймаут при удалении клиента со старого сервера {old_server.name}")
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить клиента со старого сервера {old_server.name}: {e}")
-                    finally:
-                        if x3ui:
-                            try:
-                                await x3ui.close()
-                            except:
-                                pass
-                
-                # Запускаем удаление в фоне, не блокируя смену сервера
-                asyncio.create_task(delete_old_client())
-                logger.info(f"Запущена фоновая задача удаления клиента со старого сервера {old_server.name}")
-            except Exception as e:
-                logger.warning(f"Ошибка при инициализации удаления клиента со старого сервера {old_server.name}: {e}")
+            await enqueue_panel_op(
+                session,
+                server_id=old_server.id,
+                operation=OP_REMOVE_CLIENT,
+                client_email=client_email_for(user.tg_id, old_server.id),
+            )
+            logger.info(f"Удаление клиента пользователя {user.tg_id} со старого сервера {old_server.name} поставлено в outbox")
         
         # Деактивируем старые VPN credentials для старого сервера
         old_credentials = await session.scalars(
@@ -8905,9 +8916,9 @@ async def get_user_vpn_key(
     server_name = server.name if server else None
     
     if credential and credential.config_text:
-        return {"key": credential.config_text, "server_name": server_name}
+        return {"key": credential.config_text, "server_name": server_name, "panel_status": credential.panel_status}
     
-    return {"key": None, "server_name": server_name}
+    return {"key": None, "server_name": server_name, "panel_status": None}
 
 
 @app.post("/users/{tg_id}/vpn-key/generate")
@@ -8959,40 +8970,24 @@ async def generate_user_vpn_key(
     if existing_active and existing_active.config_text and not regenerate:
         raise HTTPException(status_code=400, detail="user_already_has_key")
     
-    # Если запрошена регенерация, деактивируем старый ключ
+    # Если запрошена регенерация, деактивируем старый ключ (в той же транзакции, что и новый ключ)
     if existing_active and regenerate:
         existing_active.active = False
-        await session.commit()
+        await session.flush()
     
-    # Генерируем новый ключ
+    # Генерируем новый ключ: клиент в 3x-UI создается обработчиком outbox, запрос не ждет панель
     try:
-        import httpx
         await _generate_vpn_config_for_user_server(user.id, user.selected_server_id, session, user.subscription_ends_at)
     except ValueError as e:
+        await session.rollback()
         error_msg = str(e)
-        # 503 - 3x-UI недоступен
-        if "не удалось получить список Inbounds" in error_msg or "не удалось получить" in error_msg.lower() or "не удалось подключиться" in error_msg.lower():
-            raise HTTPException(status_code=503, detail=f"3x_ui_unavailable: {error_msg}")
         # 400 - ошибка конфигурации сервера
-        if "Inbound не найден" in error_msg or "не настроен" in error_msg:
+        if "не настроен" in error_msg or "не найден" in error_msg:
             raise HTTPException(status_code=400, detail=f"server_configuration_error: {error_msg}")
         # 500 - реальный баг
         import logging
         logging.error(f"Ошибка при генерации ключа для пользователя {user.tg_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"key_generation_failed: {error_msg}")
-    except httpx.HTTPStatusError as e:
-        # 503 - 3x-UI недоступен (HTTP ошибки от API)
-        if e.response.status_code in (404, 503, 502, 504):
-            raise HTTPException(status_code=503, detail=f"3x_ui_unavailable: HTTP {e.response.status_code}")
-        # 500 - другие HTTP ошибки
-        import logging
-        logging.error(f"HTTP ошибка при генерации ключа для пользователя {user.tg_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="key_generation_failed")
-    except httpx.RequestError as e:
-        # 503 - 3x-UI недоступен (сетевые ошибки)
-        import logging
-        logging.warning(f"Сетевая ошибка при подключении к 3x-UI для пользователя {user.tg_id}: {e}")
-        raise HTTPException(status_code=503, detail="3x_ui_unavailable: Не удалось подключиться к 3x-UI")
     except Exception as e:
         # 500 - только реальные баги
         import logging
@@ -9013,7 +9008,8 @@ async def generate_user_vpn_key(
         logging.error(f"Ключ не был создан для пользователя {user.tg_id}, хотя ошибок не было")
         raise HTTPException(status_code=500, detail="key_generation_failed")
     
-    return {"key": credential.config_text, "server_name": server.name}
+    # panel_status=pending: ключ начнет работать, когда клиент появится в 3x-UI (бот может опрашивать GET /vpn-key)
+    return {"key": credential.config_text, "server_name": server.name, "panel_status": credential.panel_status}
 
 
 @app.get("/users/{tg_id}/vpn-configs")
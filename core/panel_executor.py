@@ -0,0 +1,122 @@
+"""
+Общий исполнитель для работы с панелями 3x-UI и серверами
+
+Фоновые задачи обходят серверы параллельно (время обхода определяется самым
+медленным сервером, а не суммой всех), а отдельные вызовы панели ограничены:
+- глобальным лимитом одновременных вызовов на процесс;
+- лимитом одновременных вызовов на один сервер (чтобы не перегружать панель и SSH-туннель);
+- таймаутом на каждый вызов.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Iterable, TypeVar
+
+from core.db.models import Server
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class PanelExecutor:
+    """Ограничитель параллельности для вызовов панелей"""
+
+    def __init__(
+        self,
+        per_server_limit: int = 8,
+        global_limit: int = 64,
+        server_sweep_limit: int = 16,
+        call_timeout: float = 30.0,
+    ):
+        """
+        Args:
+            per_server_limit: Максимум одновременных вызовов к одному серверу
+            global_limit: Максимум одновременных вызовов ко всем серверам
+            server_sweep_limit: Сколько серверов обходить параллельно в for_each_server
+            call_timeout: Таймаут одного вызова по умолчанию (секунды)
+        """
+        self.per_server_limit = per_server_limit
+        self.call_timeout = call_timeout
+        self._global = asyncio.Semaphore(global_limit)
+        self._sweep = asyncio.Semaphore(server_sweep_limit)
+        self._per_server: dict[int, asyncio.Semaphore] = {}
+
+    def _server_semaphore(self, server_id: int) -> asyncio.Semaphore:
+        semaphore = self._per_server.get(server_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_server_limit)
+            self._per_server[server_id] = semaphore
+        return semaphore
+
+    async def run(
+        self,
+        server_id: int,
+        func: Callable[..., Awaitable[T]],
+        *args: Any,
+        timeout: float | None = None,
+    ) -> T:
+        """
+        Выполнить один вызов панели сервера с учетом лимитов и таймаута
+
+        Raises:
+            asyncio.TimeoutError: если вызов не уложился в таймаут
+        """
+        async with self._global:
+            async with self._server_semaphore(server_id):
+                return await asyncio.wait_for(func(*args), timeout or self.call_timeout)
+
+    async def gather(
+        self,
+        server_id: int,
+        func: Callable[..., Awaitable[T]],
+        items: Iterable[Any],
+        timeout: float | None = None,
+    ) -> list[T | BaseException]:
+        """
+        Выполнить func(item) для каждого элемента параллельно в пределах лимитов сервера
+
+        Исключения не прерывают остальные вызовы и возвращаются на месте результата.
+        """
+        return await asyncio.gather(
+            *(self.run(server_id, func, item, timeout=timeout) for item in items),
+            return_exceptions=True,
+        )
+
+    async def for_each_server(
+        self,
+        servers: Iterable[Server],
+        func: Callable[[Server], Awaitable[T]],
+        timeout: float | None = None,
+    ) -> dict[int, T | BaseException]:
+        """
+        Обработать серверы параллельно (не более server_sweep_limit одновременно)
+
+        Внутри func вызовы панели нужно выполнять через run()/gather(), а не через
+        for_each_server, чтобы лимиты не захватывались вложенно.
+
+        Returns:
+            server_id -> результат func или исключение (включая asyncio.TimeoutError)
+        """
+        servers = list(servers)
+
+        async def process(server: Server) -> T:
+            async with self._sweep:
+                if timeout:
+                    return await asyncio.wait_for(func(server), timeout)
+                return await func(server)
+
+        results = await asyncio.gather(*(process(server) for server in servers), return_exceptions=True)
+
+        outcome: dict[int, T | BaseException] = {}
+        for server, result in zip(servers, results):
+            if isinstance(result, asyncio.TimeoutError):
+                logger.warning(f"Обработка сервера {server.name} не уложилась в {timeout}с")
+            elif isinstance(result, BaseException):
+                logger.error(f"Ошибка при обработке сервера {server.name}: {result}")
+            outcome[server.id] = result
+        return outcome
+
+
+panel_executor = PanelExecutor()
@@ -0,0 +1,342 @@
+"""
+Transactional outbox для изменений клиентов в 3x-UI
+
+Обработчики запросов не ходят в панель: они записывают намерение (строку PanelOutbox)
+в той же транзакции, что и VpnCredential, и сразу отвечают. Фоновый обработчик
+применяет строки к панелям:
+- серверы обрабатываются параллельно, строки одного сервера — строго по порядку id;
+- для одной пары (сервер, email) актуальна только последняя строка: новая строка
+  помечает еще не выполненные предыдущие как superseded;
+- операции идемпотентны (ensure_client приводит клиента к нужному UUID и сроку),
+  поэтому повтор после сбоя или рестарта безопасен;
+- ошибки повторяются с экспоненциальной паузой, после OUTBOX_MAX_ATTEMPTS строка
+  получает статус failed (и credential — panel_status=failed);
+- строки, зависшие в processing (процесс упал), через OUTBOX_STALE_AFTER снова берутся в работу.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.db.models import PanelOutbox, Server, VpnCredential
+from core.panel_executor import panel_executor
+from core.x3ui_api import InboundSnapshot, X3UIAPI
+from core.x3ui_registry import x3ui_registry
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PENDING = "pending"
+OUTBOX_PROCESSING = "processing"
+OUTBOX_DONE = "done"
+OUTBOX_FAILED = "failed"
+OUTBOX_SUPERSEDED = "superseded"
+
+OP_ENSURE_CLIENT = "ensure_client"
+OP_REMOVE_CLIENT = "remove_client"
+
+PANEL_STATUS_PENDING = "pending"
+PANEL_STATUS_SYNCED = "synced"
+PANEL_STATUS_FAILED = "failed"
+
+OUTBOX_MAX_ATTEMPTS = 12
+OUTBOX_BASE_DELAY = 5.0
+OUTBOX_MAX_DELAY = 600.0
+OUTBOX_STALE_AFTER = timedelta(minutes=5)
+OUTBOX_BATCH_SIZE = 500
+
+# Результаты применения строки
+_DONE = "done"
+_RETRY = "retry"
+_RELEASE = "release"
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def client_email_for(tg_id: int, server_id: int) -> str:
+    """Email клиента в 3x-UI для пользователя на сервере"""
+    return f"tg_{tg_id}_server_{server_id}@fiorevpn"
+
+
+async def enqueue_panel_op(
+    session: AsyncSession,
+    server_id: int,
+    operation: str,
+    client_email: str,
+    client_uuid: str | None = None,
+    payload: dict[str, Any] | None = None,
+    credential_id: int | None = None,
+) -> PanelOutbox:
+    """
+    Добавить изменение панели в текущую транзакцию (commit делает вызывающий код)
+
+    Еще не выполненные строки для того же (сервер, email) помечаются superseded:
+    новая строка описывает итоговое состояние клиента целиком.
+
+    Args:
+        session: Сессия БД запроса
+        server_id: ID сервера
+        operation: OP_ENSURE_CLIENT или OP_REMOVE_CLIENT
+        client_email: Email клиента в 3x-UI
+        client_uuid: UUID клиента (для ensure_client)
+        payload: Параметры клиента: expire_ms, limit_ip, total_gb, flow, enable
+        credential_id: VpnCredential, которому нужно проставить panel_status
+    """
+    now = _utcnow()
+    await session.execute(
+        update(PanelOutbox)
+        .where(PanelOutbox.server_id == server_id)
+        .where(PanelOutbox.client_email == client_email)
+        .where(PanelOutbox.status == OUTBOX_PENDING)
+        .values(status=OUTBOX_SUPERSEDED, processed_at=now)
+    )
+    row = PanelOutbox(
+        server_id=server_id,
+        operation=operation,
+        client_email=client_email,
+        client_uuid=client_uuid,
+        payload=json.dumps(payload or {}),
+        credential_id=credential_id,
+        status=OUTBOX_PENDING,
+        next_attempt_at=now,
+    )
+    session.add(row)
+    return row
+
+
+def _retry_delay(attempts: int) -> float:
+    delay = min(OUTBOX_BASE_DELAY * (2 ** max(attempts - 1, 0)), OUTBOX_MAX_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def _claim_rows(session: AsyncSession, batch_size: int) -> list[PanelOutbox]:
+    """Забрать пачку готовых к выполнению строк (на Postgres — FOR UPDATE SKIP LOCKED)"""
+    now = _utcnow()
+    stmt = (
+        select(PanelOutbox)
+        .where(or_(
+            and_(PanelOutbox.status == OUTBOX_PENDING, PanelOutbox.next_attempt_at <= now),
+            and_(PanelOutbox.status == OUTBOX_PROCESSING, PanelOutbox.locked_at < now - OUTBOX_STALE_AFTER),
+        ))
+        .order_by(PanelOutbox.id)
+        .limit(batch_size)
+    )
+    if session.bind.dialect.name == "postgresql":
+        stmt = stmt.with_for_update(skip_locked=True)
+
+    rows = list((await session.scalars(stmt)).all())
+    for row in rows:
+        row.status = OUTBOX_PROCESSING
+        row.locked_at = now
+    await session.commit()
+    return rows
+
+
+async def _resolve_inbound_id(server: Server, x3ui: X3UIAPI) -> int | None:
+    if server.x3ui_inbound_id:
+        return server.x3ui_inbound_id
+    found = await x3ui.find_first_vless_inbound()
+    if found:
+        logger.info(f"Автоматически найден VLESS Inbound ID {found.get('id')} для сервера {server.name}")
+        return found.get("id")
+    return None
+
+
+async def _apply_row(x3ui: X3UIAPI, snapshot: InboundSnapshot, row: PanelOutbox) -> None:
+    """
+    Применить одну строку к Inbound
+
+    Raises:
+        RuntimeError: если панель отклонила изменение
+    """
+    inbound_id = snapshot.id
+    existing = snapshot.get_by_email(row.client_email)
+
+    if row.operation == OP_REMOVE_CLIENT:
+        if existing is None:
+            return
+        if not await x3ui.delete_client(inbound_id, row.client_email):
+            raise RuntimeError("delClient отклонен панелью")
+        return
+
+    if row.operation != OP_ENSURE_CLIENT:
+        raise RuntimeError(f"Неизвестная операция {row.operation}")
+
+    payload = json.loads(row.payload or "{}")
+    expire = int(payload.get("expire_ms") or 0)
+    enable = bool(payload.get("enable", True))
+
+    if existing is not None and existing.get("id") == row.client_uuid:
+        # Клиент уже создан (например, повтор после сбоя): приводим срок и enable
+        if int(existing.get("expiryTime") or 0) != expire or bool(existing.get("enable", True)) != enable:
+            if not await x3ui.update_client(inbound_id, row.client_uuid, enable=enable, expire=expire):
+                raise RuntimeError("updateClient отклонен панелью")
+        return
+
+    if existing is not None:
+        # Под этим email старый ключ (смена ключа): удаляем, чтобы освободить email
+        if not await x3ui.delete_client(inbound_id, row.client_email):
+            raise RuntimeError("delClient старого клиента отклонен панелью")
+
+    added = await x3ui.add_clients(inbound_id, [{
+        "email": row.client_email,
+        "uuid": row.client_uuid,
+        "flow": payload.get("flow") or "",
+        "expire": expire,
+        "limit_ip": payload.get("limit_ip", 0),
+        "total_gb": payload.get("total_gb", 0),
+        "enable": enable,
+    }])
+    if not added:
+        raise RuntimeError("addClient отклонен панелью")
+
+
+async def _process_server(server: Server, rows: list[PanelOutbox]) -> tuple[dict[int, tuple[str, str | None]], int | None]:
+    """
+    Применить строки одного сервера по порядку
+
+    Returns:
+        (id строки -> (результат, ошибка), найденный автоматически Inbound ID)
+    """
+    outcome: dict[int, tuple[str, str | None]] = {}
+    discovered_inbound_id = None
+
+    try:
+        x3ui = await x3ui_registry.get(server)
+        inbound_id = await panel_executor.run(server.id, _resolve_inbound_id, server, x3ui)
+        if not inbound_id:
+            raise RuntimeError(f"Inbound ID не указан для сервера {server.name} и VLESS Inbound не найден")
+        if inbound_id != server.x3ui_inbound_id:
+            discovered_inbound_id = inbound_id
+        snapshot = await panel_executor.run(server.id, x3ui.get_snapshot, inbound_id, True)
+        if snapshot is None:
+            raise RuntimeError(f"Inbound {inbound_id} не найден")
+    except Exception as e:
+        # Панель недоступна: вся пачка ждет следующей попытки
+        error = str(e) or type(e).__name__
+        return {row.id: (_RETRY, error) for row in rows}, None
+
+    for index, row in enumerate(rows):
+        try:
+            await panel_executor.run(server.id, _apply_row, x3ui, snapshot, row)
+            outcome[row.id] = (_DONE, None)
+        except ConnectionError as e:
+            # Сервер перестал отвечать: остальные строки не трогаем, чтобы не ломать порядок
+            outcome[row.id] = (_RETRY, str(e) or type(e).__name__)
+            for rest in rows[index + 1:]:
+                outcome[rest.id] = (_RELEASE, None)
+            break
+        except Exception as e:
+            outcome[row.id] = (_RETRY, str(e) or type(e).__name__)
+
+    return outcome, discovered_inbound_id
+
+
+async def process_panel_outbox(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """
+    Выполнить одну пачку строк outbox
+
+    Returns:
+        Сколько строк было взято в работу
+    """
+    from core.db.session import SessionLocal
+
+    async with SessionLocal() as session:
+        rows = await _claim_rows(session, batch_size)
+        if not rows:
+            return 0
+
+        # Для одной пары (сервер, email) выполняем только последнюю строку
+        latest: dict[tuple[int, str], PanelOutbox] = {}
+        for row in rows:
+            latest[(row.server_id, row.client_email)] = row
+        superseded = [row for row in rows if latest[(row.server_id, row.client_email)] is not row]
+
+        by_server: dict[int, list[PanelOutbox]] = {}
+        for row in rows:
+            if latest[(row.server_id, row.client_email)] is row:
+                by_server.setdefault(row.server_id, []).append(row)
+
+        servers = (await session.scalars(select(Server).where(Server.id.in_(by_server.keys())))).all()
+        servers_by_id = {server.id: server for server in servers}
+
+    async def run_server(server: Server):
+        return await _process_server(server, by_server[server.id])
+
+    results = await panel_executor.for_each_server(servers, run_server)
+
+    now = _utcnow()
+    done = 0
+    async with SessionLocal() as session:
+        for row in superseded:
+            await session.execute(
+                update(PanelOutbox).where(PanelOutbox.id == row.id).values(status=OUTBOX_SUPERSEDED, processed_at=now)
+            )
+
+        for server_id, server_rows in by_server.items():
+            server = servers_by_id.get(server_id)
+            result = results.get(server_id) if server else None
+            if server is None:
+                outcome = {row.id: (_RETRY, "server_not_found") for row in server_rows}
+            elif isinstance(result, BaseException) or result is None:
+                outcome = {row.id: (_RETRY, str(result) or "server_processing_failed") for row in server_rows}
+            else:
+                outcome, discovered_inbound_id = result
+                if discovered_inbound_id:
+                    await session.execute(
+                        update(Server).where(Server.id == server_id).values(x3ui_inbound_id=discovered_inbound_id)
+                    )
+
+            for row in server_rows:
+                status, error = outcome.get(row.id, (_RELEASE, None))
+                await _record_result(session, row, status, error, now)
+                done += status == _DONE
+
+        await session.commit()
+
+    logger.info(f"Outbox 3x-UI: взято {len(rows)}, выполнено {done}, заменено {len(superseded)}")
+    return len(rows)
+
+
+async def _record_result(session: AsyncSession, row: PanelOutbox, status: str, error: str | None, now: datetime) -> None:
+    values: dict[str, Any] = {"locked_at": None}
+    credential_status = None
+
+    if status == _DONE:
+        values.update(status=OUTBOX_DONE, processed_at=now, last_error=None)
+        credential_status = PANEL_STATUS_SYNCED
+    elif status == _RELEASE:
+        values.update(status=OUTBOX_PENDING)
+    else:
+        attempts = row.attempts + 1
+        values.update(attempts=attempts, last_error=(error or "")[:1000])
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            values.update(status=OUTBOX_FAILED, processed_at=now)
+            credential_status = PANEL_STATUS_FAILED
+            logger.error(f"Outbox 3x-UI: строка #{row.id} ({row.operation} {row.client_email}) не выполнена: {error}")
+        else:
+            values.update(status=OUTBOX_PENDING, next_attempt_at=now + timedelta(seconds=_retry_delay(attempts)))
+            logger.warning(f"Outbox 3x-UI: строка #{row.id} ({row.operation} {row.client_email}), попытка {attempts}: {error}")
+
+    # Обновляем только строки, которые все еще числятся в работе
+    await session.execute(
+        update(PanelOutbox)
+        .where(PanelOutbox.id == row.id)
+        .where(PanelOutbox.status == OUTBOX_PROCESSING)
+        .values(**values)
+    )
+
+    if credential_status and row.credential_id and row.operation == OP_ENSURE_CLIENT:
+        await session.execute(
+            update(VpnCredential)
+            .where(VpnCredential.id == row.credential_id)
+            .where(VpnCredential.user_uuid == row.client_uuid)
+            .values(panel_status=credential_status)
+        )
@@ -0,0 +1,279 @@
+"""
+Сверка VPN credentials в БД с клиентами в Inbound 3x-UI
+
+Для каждого сервера берется один снимок Inbound и одна выборка из БД, по ним
+строится разница:
+- missing: активный credential есть, клиента в панели нет (или под его email другой UUID);
+- orphaned: наш клиент (tg_<id>_server_<id>@fiorevpn) в панели есть, активного credential нет;
+- wrong_enable: клиент включен у забаненного пользователя или выключен у незабаненного;
+- wrong_expiry: срок клиента в панели не совпадает с VpnCredential.expires_at.
+
+Credentials с panel_status=pending пропускаются: их применит outbox.
+
+Применяется только эта разница: delClient на каждого лишнего клиента, addClient
+на пачку новых клиентов и updateClient на каждого клиента с изменениями. Inbound
+целиком не отправляется, поэтому сверка не удаляет клиентов, которых outbox или
+выдача ключей добавили параллельно.
+Клиенты с чужими email (созданные в панели вручную) не трогаются.
+"""
+from __future__ import annotations
+
+import logging
+import re
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.db.models import Server, User, UserBan, VpnCredential
+from core.panel_executor import panel_executor
+from core.x3ui_api import InboundSnapshot, X3UIAPI
+from core.x3ui_registry import x3ui_registry
+
+logger = logging.getLogger(__name__)
+
+CLIENT_EMAIL_RE = re.compile(r"^tg_(\d+)_server_(\d+)@fiorevpn$")
+
+# Расхождение срока меньше минуты не считается ошибкой (округления, часовые пояса БД)
+EXPIRY_TOLERANCE_MS = 60_000
+
+# Сколько элементов каждого вида показывать в отчете
+REPORT_SAMPLE_SIZE = 50
+
+
+def _expiry_ms(expires_at: datetime | None) -> int:
+    # 3x-UI хранит срок в миллисекундах, 0 — без ограничения
+    return int(expires_at.timestamp() * 1000) if expires_at else 0
+
+
+class ServerDiff:
+    """Разница между БД и Inbound одного сервера"""
+
+    def __init__(self, server: Server):
+        self.server_id = server.id
+        self.server_name = server.name
+        self.inbound_id = server.x3ui_inbound_id
+        self.missing: list[dict[str, Any]] = []
+        self.orphaned: list[dict[str, Any]] = []
+        self.wrong_enable: dict[str, bool] = {}
+        self.wrong_expiry: dict[str, int] = {}
+        self.error: str | None = None
+        self.applied = False
+        self.failed = 0
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.missing or self.orphaned or self.wrong_enable or self.wrong_expiry)
+
+    def updates(self) -> dict[str, dict[str, Any]]:
+        """Изменения существующих клиентов в формате update_clients"""
+        changes: dict[str, dict[str, Any]] = {}
+        for client_uuid, enable in self.wrong_enable.items():
+            changes.setdefault(client_uuid, {})["enable"] = enable
+        for client_uuid, expiry in self.wrong_expiry.items():
+            changes.setdefault(client_uuid, {})["expiryTime"] = expiry
+        return changes
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "server_id": self.server_id,
+            "server_name": self.server_name,
+            "inbound_id": self.inbound_id,
+            "error": self.error,
+            "applied": self.applied,
+            "failed": self.failed,
+            "counts": {
+                "missing": len(self.missing),
+                "orphaned": len(self.orphaned),
+                "wrong_enable": len(self.wrong_enable),
+                "wrong_expiry": len(self.wrong_expiry),
+            },
+            "missing": [client["email"] for client in self.missing[:REPORT_SAMPLE_SIZE]],
+            "orphaned": [client["email"] for client in self.orphaned[:REPORT_SAMPLE_SIZE]],
+            "wrong_enable": list(self.wrong_enable)[:REPORT_SAMPLE_SIZE],
+            "wrong_expiry": list(self.wrong_expiry)[:REPORT_SAMPLE_SIZE],
+        }
+
+
+async def compute_server_diff(
+    session: AsyncSession,
+    server: Server,
+    snapshot: InboundSnapshot,
+    limit_ip: int,
+    total_gb: int,
+) -> ServerDiff:
+    """
+    Построить разницу между активными credentials сервера и снимком его Inbound
+
+    Args:
+        session: Сессия БД
+        server: Сервер
+        snapshot: Свежий снимок Inbound сервера
+        limit_ip: Лимит IP для недостающих клиентов
+        total_gb: Лимит трафика для недостающих клиентов
+    """
+    diff = ServerDiff(server)
+
+    rows = await session.execute(
+        select(VpnCredential, User.tg_id)
+        .join(User, User.id == VpnCredential.user_id)
+        .where(VpnCredential.server_id == server.id)
+        .where(VpnCredential.active == True)
+        .where(VpnCredential.user_uuid.isnot(None))
+        .order_by(VpnCredential.created_at.desc())
+    )
+    banned_user_ids = set(
+        (await session.scalars(select(UserBan.user_id).where(UserBan.is_active == True))).all()
+    )
+
+    # Ожидаемое состояние панели: email -> самый новый активный credential
+    desired: dict[str, VpnCredential] = {}
+    for cred, tg_id in rows.all():
+        desired.setdefault(f"tg_{tg_id}_server_{server.id}@fiorevpn", cred)
+
+    for email, cred in desired.items():
+        if cred.panel_status == "pending":
+            # Клиента еще создает обработчик outbox (core.panel_outbox)
+            continue
+        want_enable = cred.user_id not in banned_user_ids
+        want_expiry = _expiry_ms(cred.expires_at)
+        client = snapshot.get_by_email(email)
+
+        if client is None or client.get("id") != cred.user_uuid:
+            if client is not None:
+                # Под email остался клиент со старым UUID: удаляем его, чтобы освободить email
+                diff.orphaned.append({"uuid": client.get("id"), "email": email})
+            diff.missing.append({
+                "email": email,
+                "uuid": cred.user_uuid,
+                "flow": server.xray_flow or "",
+                "expire": want_expiry,
+                "limit_ip": limit_ip,
+                "total_gb": total_gb,
+                "enable": want_enable,
+            })
+            continue
+
+        if bool(client.get("enable", True)) != want_enable:
+            diff.wrong_enable[cred.user_uuid] = want_enable
+        if abs(int(client.get("expiryTime") or 0) - want_expiry) > EXPIRY_TOLERANCE_MS:
+            diff.wrong_expiry[cred.user_uuid] = want_expiry
+
+    for client in snapshot.clients:
+        email = str(client.get("email") or "")
+        match = CLIENT_EMAIL_RE.match(email)
+        if not match or int(match.group(2)) != server.id or not client.get("id"):
+            continue
+        if email not in desired:
+            diff.orphaned.append({"uuid": client["id"], "email": email})
+
+    return diff
+
+
+async def apply_server_diff(x3ui: X3UIAPI, diff: ServerDiff, chunk_size: int = 200) -> None:
+    """
+    Применить разницу к панели пачками
+
+    Сначала удаляются лишние клиенты (освобождаются email), затем добавляются
+    недостающие, затем исправляются enable и срок. Удаление и изменения идут
+    поклиентскими запросами (remove_clients / update_clients), поэтому у них тот же
+    увеличенный таймаут, что и у добавления.
+    """
+    inbound_id = diff.inbound_id
+
+    if diff.orphaned:
+        orphan_uuids = {client["uuid"] for client in diff.orphaned}
+        if not await panel_executor.run(
+            diff.server_id, x3ui.remove_clients, inbound_id, orphan_uuids, timeout=300
+        ):
+            diff.failed += len(orphan_uuids)
+
+    if diff.missing:
+        added = await panel_executor.run(
+            diff.server_id, x3ui.add_clients, inbound_id, diff.missing, chunk_size, timeout=300
+        )
+        diff.failed += len(diff.missing) - len(added)
+
+    changes = diff.updates()
+    if changes:
+        if not await panel_executor.run(diff.server_id, x3ui.update_clients, inbound_id, changes, timeout=300):
+            diff.failed += len(changes)
+
+    diff.applied = True
+
+
+async def reconcile_server(
+    session: AsyncSession,
+    server: Server,
+    limit_ip: int,
+    total_gb: int,
+    dry_run: bool = True,
+    chunk_size: int = 200,
+) -> ServerDiff:
+    """
+    Сверить один сервер и (если не dry_run) применить разницу
+
+    Ошибки подключения к панели не пробрасываются, а попадают в ServerDiff.error.
+    """
+    diff = ServerDiff(server)
+    if not server.x3ui_api_url or not server.x3ui_username or not server.x3ui_password:
+        diff.error = "3x_ui_api_not_configured"
+        return diff
+    if not server.x3ui_inbound_id:
+        diff.error = "inbound_id_not_configured"
+        return diff
+
+    try:
+        x3ui = await x3ui_registry.get(server)
+        snapshot = await panel_executor.run(
+            server.id, x3ui.get_snapshot, server.x3ui_inbound_id, True
+        )
+        if not snapshot:
+            diff.error = "inbound_not_found"
+            return diff
+
+        diff = await compute_server_diff(session, server, snapshot, limit_ip, total_gb)
+        if not dry_run and not diff.is_empty:
+            await apply_server_diff(x3ui, diff, chunk_size=chunk_size)
+    except Exception as e:
+        logger.error(f"Ошибка сверки сервера {server.name}: {e}")
+        diff.error = str(e) or type(e).__name__
+        return diff
+
+    counts = diff.to_dict()["counts"]
+    logger.info(
+        f"Сверка {server.name}{' (dry-run)' if dry_run else ''}: "
+        f"нет в панели {counts['missing']}, лишних {counts['orphaned']}, "
+        f"enable {counts['wrong_enable']}, срок {counts['wrong_expiry']}, ошибок {diff.failed}"
+    )
+    return diff
+
+
+async def reconcile_servers(
+    servers: list[Server],
+    limit_ip: int,
+    total_gb: int,
+    dry_run: bool = True,
+    chunk_size: int = 200,
+) -> list[ServerDiff]:
+    """Сверить несколько серверов параллельно, каждый в собственной сессии БД"""
+    from core.db.session import SessionLocal
+
+    async def reconcile_one(server: Server) -> ServerDiff:
+        async with SessionLocal() as server_session:
+            return await reconcile_server(
+                server_session, server, limit_ip, total_gb, dry_run=dry_run, chunk_size=chunk_size
+            )
+
+    results = await panel_executor.for_each_server(servers, reconcile_one)
+
+    diffs = []
+    for server in servers:
+        result = results.get(server.id)
+        if isinstance(result, BaseException):
+            diff = ServerDiff(server)
+            diff.error = str(result) or type(result).__name__
+            result = diff
+        diffs.append(result)
+    return diffs
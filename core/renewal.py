@@ -0,0 +1,267 @@
+"""
+Автопродление истекших подписок с баланса
+
+Тарифы загружаются один раз за запуск, пользователи обрабатываются пачками,
+каждая пачка — одна транзакция. Продление пачки идемпотентно:
+- подписка продлевается условным UPDATE (только если она все еще активна и
+  истекла), поэтому повторный или параллельный запуск ее не продлит второй раз;
+- баланс списывается условным UPDATE ... WHERE balance >= цена, без чтения и
+  записи значения из Python;
+- оба UPDATE выполняются в savepoint пользователя: если средств не хватило,
+  продление подписки откатывается.
+Падение посреди запуска откатывает только незавершенную пачку; уже продленные
+подписки больше не истекли и в следующий запуск не попадут.
+
+Неудачное продление закрывает доступ так же, как обычное истечение (core.expiry),
+но только после условного UPDATE users ... WHERE has_active_subscription = true
+RETURNING: периодический запуск и запуск по дедлайну не закроют доступ и не
+уведомят пользователя дважды.
+"""
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta
+from typing import Sequence
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.db.models import (
+    AuditLog,
+    AuditLogAction,
+    BalanceTransaction,
+    Subscription,
+    SubscriptionPlan,
+    SubscriptionStatus,
+    User,
+)
+from core.expiry import expire_users, notify_subscription_deadline
+
+logger = logging.getLogger(__name__)
+
+RENEWED = "renewed"
+NO_FUNDS = "no_funds"
+NO_SUBSCRIPTION = "no_subscription"
+# Подписку уже продлили (покупка или параллельный запуск): ничего не делаем
+SKIPPED = "skipped"
+
+
+class RenewalOutcome:
+    """Результат автопродления одного пользователя"""
+
+    def __init__(self, user: User, status: str):
+        self.user_id = user.id
+        self.tg_id = user.tg_id
+        self.subscription_ends_at = user.subscription_ends_at
+        self.balance = user.balance
+        self.status = status
+        self.plan: SubscriptionPlan | None = None
+        self.original_plan: SubscriptionPlan | None = None
+        self.new_ends_at: datetime | None = None
+
+    @property
+    def plan_changed(self) -> bool:
+        return bool(self.plan and self.original_plan and self.plan.id != self.original_plan.id)
+
+
+async def load_active_plans(session: AsyncSession) -> list[SubscriptionPlan]:
+    """Активные тарифы от дешевого к дорогому"""
+    plans = await session.scalars(
+        select(SubscriptionPlan)
+        .where(SubscriptionPlan.is_active == True)
+        .order_by(SubscriptionPlan.price_cents.asc())
+    )
+    return list(plans.all())
+
+
+def choose_plan(
+    plans: Sequence[SubscriptionPlan],
+    subscription: Subscription,
+    balance: int,
+) -> tuple[SubscriptionPlan | None, SubscriptionPlan | None]:
+    """
+    Тариф для продления
+
+    Тариф подписки ищется по названию (для обратной совместимости), затем по цене.
+    Если на него не хватает средств — самый дешевый тариф, на который хватает.
+
+    Returns:
+        (тариф для продления или None, исходный тариф подписки или None)
+    """
+    original = next((plan for plan in plans if subscription.plan_name and plan.name == subscription.plan_name), None)
+    if original is None and subscription.price_cents:
+        original = next((plan for plan in plans if plan.price_cents == subscription.price_cents), None)
+
+    if original is not None and balance >= original.price_cents:
+        return original, original
+    return next((plan for plan in plans if balance >= plan.price_cents), None), original
+
+
+async def _latest_active_subscriptions(session: AsyncSession, user_ids: Sequence[int]) -> dict[int, Subscription]:
+    subscriptions = await session.scalars(
+        select(Subscription)
+        .where(Subscription.user_id.in_(user_ids))
+        .where(Subscription.status == SubscriptionStatus.active)
+        .order_by(Subscription.user_id, Subscription.ends_at.desc().nullslast())
+    )
+    latest: dict[int, Subscription] = {}
+    for subscription in subscriptions.all():
+        latest.setdefault(subscription.user_id, subscription)
+    return latest
+
+
+async def _renew_user(
+    session: AsyncSession,
+    user: User,
+    subscription: Subscription,
+    plans: Sequence[SubscriptionPlan],
+    now: datetime,
+) -> RenewalOutcome:
+    plan, original = choose_plan(plans, subscription, user.balance)
+    if plan is None:
+        outcome = RenewalOutcome(user, NO_FUNDS)
+        outcome.original_plan = original
+        return outcome
+
+    new_ends_at = now + timedelta(days=plan.days)
+    savepoint = await session.begin_nested()
+    claimed = await session.scalar(
+        update(Subscription)
+        .where(Subscription.id == subscription.id)
+        .where(Subscription.status == SubscriptionStatus.active)
+        .where(Subscription.ends_at <= now)
+        .values(ends_at=new_ends_at, price_cents=plan.price_cents, plan_name=plan.name)
+        .returning(Subscription.id)
+        # Загруженные объекты не синхронизируем: результат берется из RETURNING
+        .execution_options(synchronize_session=False)
+    )
+    if claimed is None:
+        await savepoint.rollback()
+        return RenewalOutcome(user, SKIPPED)
+
+    balance = await session.scalar(
+        update(User)
+        .where(User.id == user.id)
+        .where(User.balance >= plan.price_cents)
+        .values(balance=User.balance - plan.price_cents, subscription_ends_at=new_ends_at)
+        .returning(User.balance)
+        .execution_options(synchronize_session=False)
+    )
+    if balance is None:
+        # Баланс изменился после выборки пачки
+        await savepoint.rollback()
+        await session.refresh(user, ["balance"])
+        outcome = RenewalOutcome(user, NO_FUNDS)
+        outcome.original_plan = original
+        return outcome
+    await savepoint.commit()
+
+    outcome = RenewalOutcome(user, RENEWED)
+    outcome.plan = plan
+    outcome.original_plan = original
+    outcome.new_ends_at = new_ends_at
+    outcome.balance = balance
+    return outcome
+
+
+async def renew_chunk(
+    session: AsyncSession,
+    users: Sequence[User],
+    plans: Sequence[SubscriptionPlan],
+    now: datetime,
+) -> list[RenewalOutcome]:
+    """
+    Продлить подписки пачки пользователей (commit делает вызывающий код)
+
+    Для продленных пачкой пишутся BalanceTransaction и AuditLog, новые сроки
+    передаются планировщику дедлайнов; остальным закрывается доступ. Пользователи,
+    которым доступ уже закрыл параллельный запуск, получают статус SKIPPED.
+
+    Args:
+        session: Сессия БД (одна транзакция на пачку)
+        users: Пользователи с автопродлением и истекшей подпиской
+        plans: Активные тарифы (load_active_plans)
+        now: Время запуска (UTC)
+    """
+    if not users:
+        return []
+
+    subscriptions = await _latest_active_subscriptions(session, [user.id for user in users])
+    outcomes = []
+    for user in users:
+        subscription = subscriptions.get(user.id)
+        if subscription is None:
+            outcomes.append(RenewalOutcome(user, NO_SUBSCRIPTION))
+            continue
+        outcomes.append(await _renew_user(session, user, subscription, plans, now))
+
+    renewed = [outcome for outcome in outcomes if outcome.status == RENEWED]
+    if renewed:
+        await session.execute(insert(BalanceTransaction), [
+            {
+                "user_id": outcome.user_id,
+                "amount": -outcome.plan.price_cents,
+                "reason": f"Автопродление подписки '{outcome.plan.name}' на {outcome.plan.days} дней",
+                "created_at": now,
+            }
+            for outcome in renewed
+        ])
+        await session.execute(insert(AuditLog), [
+            {
+                "action": AuditLogAction.subscription_activated,
+                "user_tg_id": outcome.tg_id,
+                "details": _audit_details(outcome),
+                "created_at": now,
+            }
+            for outcome in renewed
+        ])
+        for outcome in renewed:
+            await notify_subscription_deadline(session, outcome.user_id, outcome.new_ends_at)
+
+    failed = [outcome for outcome in outcomes if outcome.status in (NO_FUNDS, NO_SUBSCRIPTION)]
+    claimed = await _claim_expired(session, [outcome.user_id for outcome in failed], now)
+    for outcome in failed:
+        if outcome.user_id not in claimed:
+            # Доступ уже закрыл параллельный запуск (периодический или по дедлайну): он и уведомил
+            outcome.status = SKIPPED
+    await expire_users(session, sorted(claimed), now)
+    return outcomes
+
+
+async def _claim_expired(session: AsyncSession, user_ids: Sequence[int], now: datetime) -> set[int]:
+    """
+    Условно снять отметку активной подписки с неудачно продленных пользователей
+
+    Возвращает только тех, у кого отметку снял этот запуск: параллельный запуск
+    ждет блокировку строки и после ее освобождения условие уже не выполняется.
+    """
+    if not user_ids:
+        return set()
+    claimed = await session.scalars(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .where(User.has_active_subscription == True)
+        .where(User.subscription_ends_at <= now)
+        .values(has_active_subscription=False)
+        .returning(User.id)
+        .execution_options(synchronize_session=False)
+    )
+    return set(claimed.all())
+
+
+def _audit_details(outcome: RenewalOutcome) -> str:
+    message = f"Автопродление подписки '{outcome.plan.name}' на {outcome.plan.days} дней"
+    if outcome.plan_changed:
+        message += f" (переключено с '{outcome.original_plan.name}' из-за недостатка средств)"
+    return (
+        f"{message}. Действует до: {outcome.new_ends_at.strftime('%d.%m.%Y %H:%M')} (UTC). "
+        f"Баланс: {outcome.balance / 100:.2f} RUB"
+    )
+
+
+def count_outcomes(outcomes: Sequence[RenewalOutcome]) -> dict[str, int]:
+    """Число пользователей по итогам автопродления"""
+    counts = {RENEWED: 0, NO_FUNDS: 0, NO_SUBSCRIPTION: 0, SKIPPED: 0}
+    for outcome in outcomes:
+        counts[outcome.status] += 1
+    return counts
@@ -0,0 +1,271 @@
+"""
+Планировщик фоновых задач с выбором лидера
+
+Каждая задача регистрируется под именем и выполняется только на одном узле:
+перед запуском узел берет Postgres advisory lock с ключом от имени задачи
+(pg_try_advisory_lock на отдельном соединении планировщика). Блокировка держится,
+пока жив процесс: если узел-лидер падает или теряет соединение с БД, Postgres
+снимает ее, и задачу в течение LEADER_RETRY_INTERVAL подхватывает другой узел.
+
+Интервал задачи можно переопределить без перезапуска настройкой
+job_interval_<name> (секунды) в system_settings. Ко всем паузам добавляется
+jitter, чтобы узлы и задачи не просыпались одновременно.
+
+На SQLite (локальный запуск) блокировок нет, и все задачи выполняются в процессе.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import socket
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from core.db import session as db_session
+from core.db.models import SystemSetting
+
+logger = logging.getLogger(__name__)
+
+# Как часто узел без блокировки пробует стать лидером задачи (секунды)
+LEADER_RETRY_INTERVAL = 30.0
+DEFAULT_JITTER = 0.1
+INTERVAL_SETTING_PREFIX = "job_interval_"
+MIN_INTERVAL = 1.0
+
+JobFunc = Callable[[], Awaitable[Any]]
+
+
+def job_lock_key(name: str) -> int:
+    """Ключ advisory lock (signed bigint) для имени задачи"""
+    digest = hashlib.sha256(f"fiorevpn:job:{name}".encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def _jittered(delay: float, jitter: float) -> float:
+    if delay <= 0 or jitter <= 0:
+        return max(delay, 0.0)
+    return max(delay * random.uniform(1 - jitter, 1 + jitter), 0.0)
+
+
+class Job:
+    """Зарегистрированная задача и статистика ее запусков на этом узле"""
+
+    def __init__(
+        self,
+        name: str,
+        func: JobFunc,
+        interval: float,
+        initial_delay: float = 0.0,
+        jitter: float = DEFAULT_JITTER,
+        fixed_rate: bool = False,
+    ):
+        """
+        Args:
+            name: Уникальное имя (ключ блокировки и настройки job_interval_<name>)
+            func: Один запуск задачи. Если вернул truthy — следующий запуск сразу (есть еще работа)
+            interval: Пауза между запусками (секунды)
+            initial_delay: Пауза перед первым запуском после старта узла
+            jitter: Доля случайного отклонения пауз
+            fixed_rate: Отсчитывать интервал от начала запуска, а не от конца
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.jitter = jitter
+        self.fixed_rate = fixed_rate
+        self.lock_key = job_lock_key(name)
+
+        self.is_leader = False
+        self.is_running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_started_at: datetime | None = None
+        self.last_duration: float | None = None
+        self.last_error: str | None = None
+        self.effective_interval = interval
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "interval_seconds": self.effective_interval,
+            "is_leader": self.is_leader,
+            "is_running": self.is_running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_started_at": self.last_started_at.isoformat() if self.last_started_at else None,
+            "last_duration_seconds": round(self.last_duration, 3) if self.last_duration is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+class JobScheduler:
+    """Фоновые задачи процесса с блокировками лидера в Postgres"""
+
+    def __init__(self, node_id: str | None = None):
+        self.node_id = node_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._jobs: dict[str, Job] = {}
+        self._tasks: list[asyncio.Task] = []
+        # Одно соединение на узел держит блокировки всех задач, где узел лидер
+        self._conn: AsyncConnection | None = None
+        self._conn_lock = asyncio.Lock()
+        self._held: set[str] = set()
+
+    def add_job(
+        self,
+        name: str,
+        func: JobFunc,
+        interval: float,
+        initial_delay: float = 0.0,
+        jitter: float = DEFAULT_JITTER,
+        fixed_rate: bool = False,
+    ) -> Job:
+        """Зарегистрировать задачу (до start)"""
+        if name in self._jobs:
+            raise ValueError(f"Задача {name} уже зарегистрирована")
+        job = Job(name, func, interval, initial_delay=initial_delay, jitter=jitter, fixed_rate=fixed_rate)
+        self._jobs[name] = job
+        return job
+
+    @property
+    def jobs(self) -> list[Job]:
+        return list(self._jobs.values())
+
+    def start(self) -> None:
+        for job in self._jobs.values():
+            self._tasks.append(asyncio.create_task(self._run_job(job), name=f"job:{job.name}"))
+        logger.info(f"Планировщик {self.node_id}: запущено задач {len(self._tasks)}")
+
+    async def stop(self) -> None:
+        """Остановить задачи и отпустить блокировки"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        async with self._conn_lock:
+            await self._drop_connection()
+
+    def snapshot(self) -> dict[str, Any]:
+        """Состояние задач для админки"""
+        return {"node_id": self.node_id, "jobs": [job.snapshot() for job in self._jobs.values()]}
+
+    @staticmethod
+    def _uses_locks() -> bool:
+        return db_session.engine.dialect.name == "postgresql"
+
+    async def _drop_connection(self) -> None:
+        for job in self._jobs.values():
+            job.is_leader = False
+        self._held.clear()
+        if self._conn is not None:
+            # invalidate, а не close: соединение не должно вернуться в пул с блокировками узла.
+            # Закрытие соединения на стороне Postgres снимает все его advisory locks
+            try:
+                await self._conn.invalidate()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _ensure_connection(self) -> AsyncConnection:
+        if self._conn is None or self._conn.closed:
+            self._held.clear()
+            conn = await db_session.engine.connect()
+            # Autocommit: соединение не висит в открытой транзакции между проверками
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            self._conn = conn
+        return self._conn
+
+    async def _acquire(self, job: Job) -> bool:
+        """Стать (или остаться) лидером задачи"""
+        if not self._uses_locks():
+            job.is_leader = True
+            return True
+
+        async with self._conn_lock:
+            try:
+                conn = await self._ensure_connection()
+                if job.name in self._held:
+                    # Блокировка живет, пока живо соединение: проверяем его
+                    await conn.execute(text("SELECT 1"))
+                    return True
+                acquired = (
+                    await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": job.lock_key})
+                ).scalar()
+            except Exception as e:
+                logger.warning(f"Планировщик: соединение для блокировок потеряно ({e}), лидерство сброшено")
+                await self._drop_connection()
+                return False
+
+            if acquired:
+                self._held.add(job.name)
+                job.is_leader = True
+                logger.info(f"Планировщик {self.node_id}: задача {job.name} выполняется на этом узле")
+            return bool(acquired)
+
+    async def _interval(self, job: Job) -> float:
+        """Интервал задачи с учетом настройки job_interval_<name>"""
+        interval = job.interval
+        try:
+            async with db_session.SessionLocal() as session:
+                setting = await session.scalar(
+                    select(SystemSetting).where(SystemSetting.key == f"{INTERVAL_SETTING_PREFIX}{job.name}")
+                )
+            if setting and setting.value:
+                interval = max(float(setting.value), MIN_INTERVAL)
+        except ValueError:
+            logger.warning(f"Некорректная настройка {INTERVAL_SETTING_PREFIX}{job.name}, используем {job.interval}с")
+        except Exception as e:
+            logger.debug(f"Не удалось прочитать интервал задачи {job.name}: {e}")
+        job.effective_interval = interval
+        return interval
+
+    async def _execute(self, job: Job) -> bool:
+        """Один запуск задачи; True — есть еще работа"""
+        job.is_running = True
+        job.last_started_at = datetime.now(timezone.utc)
+        started = time.monotonic()
+        try:
+            return bool(await job.func())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.failures += 1
+            job.last_error = (str(e) or type(e).__name__)[:500]
+            logger.error(f"Ошибка в задаче {job.name}: {e}", exc_info=True)
+            return False
+        finally:
+            job.runs += 1
+            job.last_duration = time.monotonic() - started
+            job.is_running = False
+
+    async def _run_job(self, job: Job) -> None:
+        try:
+            await asyncio.sleep(_jittered(job.initial_delay, job.jitter))
+            while True:
+                if not await self._acquire(job):
+                    await asyncio.sleep(_jittered(LEADER_RETRY_INTERVAL, 0.5))
+                    continue
+
+                started = time.monotonic()
+                if await self._execute(job):
+                    continue
+
+                delay = await self._interval(job)
+                if job.fixed_rate:
+                    elapsed = time.monotonic() - started
+                    if elapsed > delay:
+                        logger.warning(f"Задача {job.name} заняла {elapsed:.2f}с (больше интервала {delay:.0f}с)")
+                    delay = max(delay - elapsed, 0.0)
+                await asyncio.sleep(_jittered(delay, job.jitter))
+        except asyncio.CancelledError:
+            pass
+
+
+job_scheduler = JobScheduler()
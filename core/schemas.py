@@ -156,6 +156,18 @@ class ServerUpdateIn(BaseModel):
     x3ui_inbound_id: int | None = None
 
 
+class ServerProvisionIn(BaseModel):
+    """Массовая выдача ключей на сервере"""
+    tg_ids: list[int] | None = None  # Если не указано — все пользователи с активной подпиской, выбравшие сервер
+    chunk_size: int = 200  # Сколько клиентов создавать в 3x-UI одним запросом
+
+
+class ServerReconcileIn(BaseModel):
+    """Сверка клиентов 3x-UI с БД"""
+    dry_run: bool = True  # Только отчет, без изменений в панели
+    chunk_size: int = 200  # Сколько клиентов создавать в 3x-UI одним запросом
+
+
 class ServerOut(BaseModel):
     """Информация о сервере"""
     id: int
@@ -0,0 +1,258 @@
+"""
+История состояния серверов: агрегаты и хранение
+
+Сырые проверки (server_status, раз в минуту) сворачиваются в почасовые агрегаты,
+почасовые — в суточные (server_status_rollups). Агрегаты считаются в БД одним
+INSERT ... SELECT ... GROUP BY с upsert по (server_id, resolution, bucket_start);
+пересчитывается только последний (возможно, неполный) интервал и все после него.
+Устаревшие записи каждого уровня удаляются одним DELETE по времени.
+
+История для графиков берется из уровня, подходящего к запрошенному периоду:
+до 48 часов — сырые проверки, до 31 дня — часы, дальше — сутки.
+"""
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy import case, delete, func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.db.models import ServerStatus, ServerStatusRollup
+
+logger = logging.getLogger(__name__)
+
+RESOLUTION_RAW = "raw"
+RESOLUTION_HOUR = "hour"
+RESOLUTION_DAY = "day"
+
+RAW_RETENTION = timedelta(days=2)
+HOURLY_RETENTION = timedelta(days=35)
+DAILY_RETENTION = timedelta(days=400)
+
+# До какого периода графика используется каждый уровень
+HISTORY_RAW_MAX_RANGE = timedelta(hours=48)
+HISTORY_HOURLY_MAX_RANGE = timedelta(days=31)
+
+
+def _truncate(session: AsyncSession, unit: str, column: Any) -> Any:
+    """Начало часа/суток для времени column (в UTC)"""
+    # Единица и зона — литералы, а не параметры: иначе Postgres не сопоставит выражение в SELECT и GROUP BY
+    if session.bind.dialect.name == "postgresql":
+        return func.date_trunc(literal_column(f"'{unit}'"), column, literal_column("'UTC'"))
+    # SQLite (локальные тесты): время хранится строкой в UTC
+    fmt = "%Y-%m-%d %H:00:00" if unit == RESOLUTION_HOUR else "%Y-%m-%d 00:00:00"
+    return func.strftime(literal_column(f"'{fmt}'"), column)
+
+
+def _upsert_rollups(session: AsyncSession, source: Any) -> Any:
+    """INSERT ... SELECT в server_status_rollups с заменой уже посчитанных интервалов"""
+    insert = pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+    columns = [
+        "server_id", "resolution", "bucket_start", "samples", "online_samples",
+        "latency_min_ms", "latency_avg_ms", "latency_max_ms",
+    ]
+    stmt = insert(ServerStatusRollup).from_select(columns, source)
+    return stmt.on_conflict_do_update(
+        index_elements=["server_id", "resolution", "bucket_start"],
+        set_={column: stmt.excluded[column] for column in columns[3:]},
+    )
+
+
+async def _last_bucket(session: AsyncSession, resolution: str) -> Any:
+    return await session.scalar(
+        select(func.max(ServerStatusRollup.bucket_start)).where(ServerStatusRollup.resolution == resolution)
+    )
+
+
+async def rollup_hours(session: AsyncSession) -> None:
+    """Пересчитать почасовые агрегаты начиная с последнего посчитанного часа"""
+    since = await _last_bucket(session, RESOLUTION_HOUR)
+    bucket = _truncate(session, RESOLUTION_HOUR, ServerStatus.checked_at)
+    online = ServerStatus.is_online == True
+    # Записи до появления серий проб содержат только response_time_ms
+    latency_min = func.coalesce(ServerStatus.latency_min_ms, ServerStatus.response_time_ms)
+    latency_avg = func.coalesce(ServerStatus.latency_avg_ms, ServerStatus.response_time_ms)
+    latency_max = func.coalesce(ServerStatus.latency_p95_ms, ServerStatus.response_time_ms)
+
+    source = (
+        select(
+            ServerStatus.server_id,
+            literal_column(f"'{RESOLUTION_HOUR}'"),
+            bucket,
+            func.count(),
+            func.sum(case((online, 1), else_=0)),
+            func.min(case((online, latency_min))),
+            func.avg(case((online, latency_avg))),
+            func.max(case((online, latency_max))),
+        )
+        .group_by(ServerStatus.server_id, bucket)
+    )
+    # WHERE нужен всегда: без него SQLite не разбирает INSERT ... SELECT ... ON CONFLICT
+    source = source.where(ServerStatus.checked_at >= since) if since is not None else source.where(ServerStatus.id > 0)
+    await session.execute(_upsert_rollups(session, source))
+
+
+async def rollup_days(session: AsyncSession) -> None:
+    """Пересчитать суточные агрегаты из почасовых начиная с последних посчитанных суток"""
+    since = await _last_bucket(session, RESOLUTION_DAY)
+    hourly = ServerStatusRollup
+    bucket = _truncate(session, RESOLUTION_DAY, hourly.bucket_start)
+    online_samples = func.sum(hourly.online_samples)
+
+    source = (
+        select(
+            hourly.server_id,
+            literal_column(f"'{RESOLUTION_DAY}'"),
+            bucket,
+            func.sum(hourly.samples),
+            online_samples,
+            func.min(hourly.latency_min_ms),
+            # Среднее, взвешенное по числу успешных проверок в часе
+            func.sum(hourly.latency_avg_ms * hourly.online_samples) / func.nullif(online_samples, 0),
+            func.max(hourly.latency_max_ms),
+        )
+        .where(hourly.resolution == RESOLUTION_HOUR)
+        .group_by(hourly.server_id, bucket)
+    )
+    if since is not None:
+        source = source.where(hourly.bucket_start >= since)
+    await session.execute(_upsert_rollups(session, source))
+
+
+async def apply_retention(session: AsyncSession, now: datetime | None = None) -> None:
+    """Удалить устаревшие сырые проверки и агрегаты (по одному DELETE на уровень)"""
+    now = now or datetime.now(timezone.utc)
+    await session.execute(delete(ServerStatus).where(ServerStatus.checked_at < now - RAW_RETENTION))
+    for resolution, retention in ((RESOLUTION_HOUR, HOURLY_RETENTION), (RESOLUTION_DAY, DAILY_RETENTION)):
+        await session.execute(
+            delete(ServerStatusRollup)
+            .where(ServerStatusRollup.resolution == resolution)
+            .where(ServerStatusRollup.bucket_start < now - retention)
+        )
+
+
+async def maintain_status_history() -> None:
+    """Свернуть новые проверки в агрегаты и удалить устаревшие данные"""
+    from core.db.session import SessionLocal
+
+    async with SessionLocal() as session:
+        try:
+            await rollup_hours(session)
+            await rollup_days(session)
+            await apply_retention(session)
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+
+async def latest_statuses(session: AsyncSession, server_ids: list[int] | None = None) -> dict[int, ServerStatus]:
+    """
+    Последняя проверка каждого сервера одним запросом
+
+    На Postgres — DISTINCT ON по индексу (server_id, checked_at), на других СУБД — row_number().
+
+    Args:
+        session: Сессия БД
+        server_ids: Ограничить выборку этими серверами (None — все)
+
+    Returns:
+        {server_id: ServerStatus}; серверов без проверок в словаре нет
+    """
+    if server_ids is not None and not server_ids:
+        return {}
+
+    if session.bind.dialect.name == "postgresql":
+        stmt = (
+            select(ServerStatus)
+            .distinct(ServerStatus.server_id)
+            .order_by(ServerStatus.server_id, ServerStatus.checked_at.desc())
+        )
+        if server_ids is not None:
+            stmt = stmt.where(ServerStatus.server_id.in_(server_ids))
+    else:
+        ranked = select(
+            ServerStatus.id,
+            func.row_number().over(
+                partition_by=ServerStatus.server_id, order_by=ServerStatus.checked_at.desc()
+            ).label("position"),
+        )
+        if server_ids is not None:
+            ranked = ranked.where(ServerStatus.server_id.in_(server_ids))
+        ranked = ranked.subquery()
+        stmt = select(ServerStatus).join(ranked, ranked.c.id == ServerStatus.id).where(ranked.c.position == 1)
+
+    statuses = await session.scalars(stmt)
+    return {status.server_id: status for status in statuses.all()}
+
+
+def resolution_for_range(range_hours: float) -> str:
+    """Уровень истории для периода графика"""
+    period = timedelta(hours=range_hours)
+    if period <= HISTORY_RAW_MAX_RANGE:
+        return RESOLUTION_RAW
+    if period <= HISTORY_HOURLY_MAX_RANGE:
+        return RESOLUTION_HOUR
+    return RESOLUTION_DAY
+
+
+def _optional_float(value: Any) -> float | None:
+    return float(value) if value is not None else None
+
+
+async def load_server_history(session: AsyncSession, server_id: int, range_hours: float) -> tuple[str, list[dict[str, Any]]]:
+    """
+    Точки графика сервера за последние range_hours часов (от старых к новым)
+
+    Returns:
+        (уровень истории, точки)
+    """
+    resolution = resolution_for_range(range_hours)
+    since = datetime.now(timezone.utc) - timedelta(hours=range_hours)
+
+    if resolution == RESOLUTION_RAW:
+        statuses = await session.scalars(
+            select(ServerStatus)
+            .where(ServerStatus.server_id == server_id)
+            .where(ServerStatus.checked_at >= since)
+            .order_by(ServerStatus.checked_at)
+        )
+        return resolution, [
+            {
+                "checked_at": status.checked_at.isoformat() if status.checked_at else None,
+                "is_online": status.is_online,
+                "response_time_ms": status.response_time_ms,
+                "latency_p95_ms": _optional_float(status.latency_p95_ms),
+                "jitter_ms": _optional_float(status.jitter_ms),
+                "packet_loss_percent": _optional_float(status.packet_loss_percent),
+                "uptime_percent": 100.0 if status.is_online else 0.0,
+                "error_message": status.error_message,
+            }
+            for status in statuses.all()
+        ]
+
+    rollups = await session.scalars(
+        select(ServerStatusRollup)
+        .where(ServerStatusRollup.server_id == server_id)
+        .where(ServerStatusRollup.resolution == resolution)
+        .where(ServerStatusRollup.bucket_start >= since)
+        .order_by(ServerStatusRollup.bucket_start)
+    )
+    points = []
+    for rollup in rollups.all():
+        latency_avg = _optional_float(rollup.latency_avg_ms)
+        points.append({
+            "checked_at": rollup.bucket_start.isoformat() if rollup.bucket_start else None,
+            "is_online": rollup.online_samples > 0,
+            "response_time_ms": int(round(latency_avg)) if latency_avg is not None else None,
+            "latency_min_ms": _optional_float(rollup.latency_min_ms),
+            "latency_avg_ms": latency_avg,
+            "latency_max_ms": _optional_float(rollup.latency_max_ms),
+            "uptime_percent": round(100.0 * rollup.online_samples / rollup.samples, 2) if rollup.samples else None,
+            "samples": rollup.samples,
+        })
+    return resolution, points
@@ -0,0 +1,330 @@
+"""
+Исходящие сообщения Telegram Bot API из core
+
+Один процесс-wide диспетчер вместо httpx.AsyncClient и asyncio.create_task на
+каждое уведомление:
+- общий httpx.AsyncClient с пулом соединений к api.telegram.org;
+- token bucket на бота (доля процесса в лимите Telegram около 30 сообщений в
+  секунду, см. ниже) и пауза между сообщениями в один чат (TELEGRAM_CHAT_INTERVAL);
+- повтор при 429 (через retry_after из ответа, пауза на весь бот) и при 5xx/сетевых
+  ошибках — с экспоненциальной паузой, до TELEGRAM_MAX_ATTEMPTS попыток;
+- ограниченная очередь: enqueue ждет свободного места (backpressure), а не теряет
+  сообщения пачки уведомлений.
+
+Лимит Telegram общий для бота, а token bucket живет в памяти процесса. Поэтому
+каждый процесс core получает свою долю бюджета через TELEGRAM_RATE_LIMIT (сообщений
+в секунду, по умолчанию 25 — весь бюджет для запуска одним процессом). Когда
+фоновые задачи выполняет python -m core.worker, бюджет делится между сервисами
+(в docker-compose: core — 5, worker — 20), и сумма долей всех процессов, отправляющих
+от имени одного бота, не должна превышать 25. Остаток до ~30 — запас для ответов
+самого бота (aiogram).
+
+Ошибки 400/403 (пользователь заблокировал бота, неверный chat_id) не повторяются.
+Воркеры очереди запускаются при первом enqueue; close() дожидается отправки
+оставшихся сообщений (не дольше TELEGRAM_DRAIN_TIMEOUT).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Any
+
+import httpx
+
+from core.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+# Бюджет на бота по умолчанию (все процессы вместе); доля процесса — TELEGRAM_RATE_LIMIT
+TELEGRAM_BOT_RATE = 25.0
+TELEGRAM_CHAT_INTERVAL = 1.0  # не чаще одного сообщения в секунду в один чат
+TELEGRAM_MAX_ATTEMPTS = 5
+TELEGRAM_BASE_DELAY = 1.0
+TELEGRAM_MAX_DELAY = 60.0
+TELEGRAM_QUEUE_SIZE = 10000
+TELEGRAM_WORKERS = 8
+TELEGRAM_DRAIN_TIMEOUT = 10.0
+TELEGRAM_REQUEST_TIMEOUT = 10.0
+
+
+class TokenBucket:
+    """Ограничение частоты: rate токенов в секунду, не больше burst подряд"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def block(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (429 от Telegram)"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramSendError(Exception):
+    """Telegram отклонил сообщение (после всех повторов или без повтора)"""
+
+    def __init__(self, message: str, status_code: int | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Message:
+    __slots__ = ("bot_token", "chat_id", "payload")
+
+    def __init__(self, bot_token: str, chat_id: int, payload: dict[str, Any]):
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.payload = payload
+
+
+class TelegramDispatcher:
+    """Process-wide отправка сообщений ботов с ограничением частоты и повторами"""
+
+    def __init__(self, rate: float | None = None):
+        """
+        Args:
+            rate: Доля процесса в лимите бота (сообщений в секунду); по умолчанию TELEGRAM_RATE_LIMIT
+        """
+        self._rate = rate
+        self._client: httpx.AsyncClient | None = None
+        self._queue: asyncio.Queue[_Message] | None = None
+        self._workers: list[asyncio.Task] = []
+        # Состояние на токен бота: лимиты Telegram считаются для каждого бота отдельно
+        self._buckets: dict[str, TokenBucket] = {}
+        self._chat_next: dict[tuple[str, int], float] = {}
+        self._chat_locks: dict[tuple[str, int], asyncio.Lock] = {}
+        self.sent = 0
+        self.failed = 0
+
+    @staticmethod
+    def default_bot_token() -> str:
+        return os.getenv("BOT_TOKEN", "")
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=TELEGRAM_API_URL,
+                timeout=TELEGRAM_REQUEST_TIMEOUT,
+                limits=httpx.Limits(max_connections=TELEGRAM_WORKERS * 2, max_keepalive_connections=TELEGRAM_WORKERS),
+            )
+        return self._client
+
+    @property
+    def rate(self) -> float:
+        """Сообщений в секунду на бота для этого процесса"""
+        if self._rate is None:
+            # Доля одного процесса не может превышать весь бюджет бота
+            self._rate = min(max(float(get_settings().telegram_rate_limit), 0.1), TELEGRAM_BOT_RATE)
+        return self._rate
+
+    def _bucket(self, bot_token: str) -> TokenBucket:
+        bucket = self._buckets.get(bot_token)
+        if bucket is None:
+            # Burst не больше секундной доли: процессы не должны одновременно выдать по полному бюджету
+            bucket = TokenBucket(self.rate, max(1, int(self.rate)))
+            self._buckets[bot_token] = bucket
+        return bucket
+
+    async def _wait_chat_slot(self, key: tuple[str, int]) -> None:
+        lock = self._chat_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            delay = self._chat_next.get(key, 0.0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._chat_next[key] = time.monotonic() + TELEGRAM_CHAT_INTERVAL
+        if len(self._chat_next) > TELEGRAM_QUEUE_SIZE:
+            self._prune_chats()
+
+    def _prune_chats(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, ready_at in self._chat_next.items() if ready_at <= now]:
+            self._chat_next.pop(key, None)
+            lock = self._chat_locks.get(key)
+            if lock is not None and not lock.locked():
+                self._chat_locks.pop(key, None)
+
+    async def _deliver(self, message: _Message) -> dict[str, Any]:
+        """Отправить сообщение с соблюдением лимитов и повторами"""
+        bucket = self._bucket(message.bot_token)
+        await self._wait_chat_slot((message.bot_token, message.chat_id))
+
+        for attempt in range(1, TELEGRAM_MAX_ATTEMPTS + 1):
+            await bucket.acquire()
+            retry_after: float | None = None
+            try:
+                response = await self._get_client().post(
+                    f"/bot{message.bot_token}/sendMessage", json=message.payload
+                )
+            except httpx.HTTPError as e:
+                error = TelegramSendError(f"{type(e).__name__}: {e}")
+            else:
+                try:
+                    data = response.json()
+                except ValueError:
+                    data = {}
+                if response.status_code == 200 and data.get("ok"):
+                    return data.get("result") or {}
+                description = data.get("description") or response.text[:200]
+                error = TelegramSendError(description, response.status_code)
+                if response.status_code == 429:
+                    retry_after = float((data.get("parameters") or {}).get("retry_after") or TELEGRAM_BASE_DELAY)
+                    # Flood control действует на весь бот: останавливаем все его отправки
+                    bucket.block(retry_after)
+                elif response.status_code < 500:
+                    raise error
+
+            if attempt == TELEGRAM_MAX_ATTEMPTS:
+                raise error
+            delay = retry_after if retry_after is not None else min(
+                TELEGRAM_BASE_DELAY * 2 ** (attempt - 1), TELEGRAM_MAX_DELAY
+            ) * random.uniform(0.8, 1.2)
+            logger.info(f"Telegram: повтор отправки в чат {message.chat_id} через {delay:.1f}с ({error})")
+            await asyncio.sleep(delay)
+        raise TelegramSendError("unreachable")
+
+    @staticmethod
+    def _build(
+        bot_token: str | None,
+        chat_id: int,
+        text: str,
+        parse_mode: str | None,
+        reply_markup: dict[str, Any] | None,
+    ) -> _Message | None:
+        bot_token = bot_token or TelegramDispatcher.default_bot_token()
+        if not bot_token:
+            logger.warning(f"Не удалось отправить сообщение в чат {chat_id}: bot_token не настроен")
+            return None
+        payload: dict[str, Any] = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        return _Message(bot_token, chat_id, payload)
+
+    async def send_message(
+        self,
+        chat_id: int,
+        text: str,
+        bot_token: str | None = None,
+        parse_mode: str | None = "HTML",
+        reply_markup: dict[str, Any] | None = None,
+    ) -> dict[str, Any]:
+        """
+        Отправить сообщение и дождаться результата (когда вызывающему нужен ответ Telegram)
+
+        Args:
+            chat_id: Чат получателя (tg_id)
+            text: Текст сообщения
+            bot_token: Токен бота (по умолчанию BOT_TOKEN)
+            parse_mode: Режим разметки или None
+            reply_markup: Клавиатура (JSON Bot API)
+
+        Returns:
+            Отправленное сообщение (result из ответа Telegram)
+
+        Raises:
+            TelegramSendError: если сообщение не отправлено
+        """
+        message = self._build(bot_token, chat_id, text, parse_mode, reply_markup)
+        if message is None:
+            raise TelegramSendError("bot_token_missing")
+        try:
+            result = await self._deliver(message)
+        except TelegramSendError:
+            self.failed += 1
+            raise
+        self.sent += 1
+        return result
+
+    async def enqueue(
+        self,
+        chat_id: int,
+        text: str,
+        bot_token: str | None = None,
+        parse_mode: str | None = "HTML",
+        reply_markup: dict[str, Any] | None = None,
+    ) -> bool:
+        """
+        Поставить сообщение в очередь отправки (уведомления, результат не нужен)
+
+        Если очередь заполнена, ждет свободного места.
+
+        Returns:
+            False, если сообщение нельзя отправить (не настроен токен бота)
+        """
+        message = self._build(bot_token, chat_id, text, parse_mode, reply_markup)
+        if message is None:
+            return False
+        self._ensure_workers()
+        await self._queue.put(message)
+        return True
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=TELEGRAM_QUEUE_SIZE)
+        self._workers = [task for task in self._workers if not task.done()]
+        for index in range(len(self._workers), TELEGRAM_WORKERS):
+            self._workers.append(asyncio.create_task(self._worker(), name=f"telegram-dispatcher:{index}"))
+
+    async def _worker(self) -> None:
+        while True:
+            message = await self._queue.get()
+            try:
+                await self._deliver(message)
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Не удалось отправить сообщение в чат {message.chat_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def snapshot(self) -> dict[str, Any]:
+        """Состояние очереди для админки"""
+        return {
+            "rate_per_second": self.rate,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
+
+    async def close(self) -> None:
+        """Дождаться отправки очереди (не дольше TELEGRAM_DRAIN_TIMEOUT) и закрыть клиент"""
+        if self._queue is not None and self._workers:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=TELEGRAM_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Telegram: не отправлено сообщений при остановке: {self._queue.qsize()}")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        self._queue = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+telegram_dispatcher = TelegramDispatcher()
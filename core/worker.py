@@ -0,0 +1,74 @@
+"""
+Отдельный процесс фоновых задач: python -m core.worker
+
+Выполняет планировщик (core.scheduler) с теми же задачами, что регистрирует
+core.main.register_background_jobs, и использует те же модели и фабрику сессий.
+API при этом запускается с BACKGROUND_JOBS_ENABLED=false. Запускайте один воркер
+на бота: каждая задача и так выполняется только на узле, взявшем ее advisory lock,
+а доля лимита Telegram (TELEGRAM_RATE_LIMIT, в docker-compose — 20 сообщений в
+секунду) задается на процесс. Второй реплике воркера (как и лишним репликам API)
+нужно уменьшить TELEGRAM_RATE_LIMIT так, чтобы сумма по всем процессам осталась
+не больше 25 (core.telegram_dispatcher), иначе Telegram ответит 429.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import signal
+
+from core.db import session as db_session
+from core.expiry import expiry_scheduler
+from core.main import prepare_database, register_background_jobs
+from core.scheduler import job_scheduler
+from core.telegram_dispatcher import telegram_dispatcher
+from core.x3ui_registry import x3ui_registry
+
+logger = logging.getLogger(__name__)
+
+# Схему при старте может одновременно применять процесс API: повторяем при ошибке
+PREPARE_ATTEMPTS = 5
+PREPARE_RETRY_DELAY = 5.0
+
+
+async def _prepare_database() -> None:
+    for attempt in range(1, PREPARE_ATTEMPTS + 1):
+        try:
+            await prepare_database()
+            return
+        except Exception as e:
+            if attempt == PREPARE_ATTEMPTS:
+                raise
+            logger.warning(f"Воркер: подготовка БД не удалась ({e}), повтор через {PREPARE_RETRY_DELAY:.0f}с")
+            await asyncio.sleep(PREPARE_RETRY_DELAY)
+
+
+async def run_worker() -> None:
+    """Запустить фоновые задачи и работать до SIGTERM/SIGINT"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await _prepare_database()
+    register_background_jobs(job_scheduler)
+    job_scheduler.start()
+    logger.info(f"Воркер {job_scheduler.node_id} запущен")
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Воркер останавливается...")
+        await job_scheduler.stop()
+        await expiry_scheduler.close()
+        await telegram_dispatcher.close()
+        await x3ui_registry.close_all()
+        await db_session.engine.dispose()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s [%(name)s] %(message)s")
+    asyncio.run(run_worker())
+
+
+if __name__ == "__main__":
+    main()
@@ -8,20 +8,123 @@
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
-from typing import Any
+import time
+from typing import Any, Awaitable, Callable, Iterable, TypeVar
 from urllib.parse import quote
 
 import httpx
 
+from core.circuit_breaker import CircuitBreaker
+
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# Таймауты запросов к панели: недоступный узел не должен держать вызов дольше connect-таймаута
+PANEL_TIMEOUT = httpx.Timeout(15.0, connect=5.0)
+
+
+class PanelUnavailableError(ConnectionError):
+    """Панель 3x-UI недоступна (цепь circuit breaker открыта), вызов не выполнялся"""
+
+
+class SnapshotLoadError(ConnectionError):
+    """Не удалось загрузить свежий список Inbounds (при force_refresh кэш не используется)"""
+
+
+class InboundSnapshot:
+    """
+    Разобранный снимок Inbound с индексами клиентов
+    
+    JSON settings разбирается один раз при загрузке снимка, дальше поиск клиента
+    по email или UUID выполняется за O(1). Словари клиентов общие для индексов
+    и списка clients, поэтому изменение клиента сразу видно во всех представлениях.
+    """
+    
+    def __init__(self, inbound: dict[str, Any]):
+        self.inbound = inbound
+        self.id: int | None = inbound.get("id")
+        
+        settings = inbound.get("settings") or "{}"
+        self.settings: dict[str, Any] = json.loads(settings) if isinstance(settings, str) else dict(settings)
+        self.clients: list[dict[str, Any]] = self.settings.setdefault("clients", []) or []
+        
+        self.by_uuid: dict[str, dict[str, Any]] = {}
+        self.email_to_uuid: dict[str, str] = {}
+        for client in self.clients:
+            self._index(client)
+        
+        self._stream_settings: dict[str, Any] | None = None
+    
+    def _index(self, client: dict[str, Any]) -> None:
+        client_uuid = client.get("id")
+        if not client_uuid:
+            return
+        self.by_uuid[client_uuid] = client
+        if client.get("email"):
+            self.email_to_uuid[client["email"]] = client_uuid
+    
+    def get_by_uuid(self, client_uuid: str) -> dict[str, Any] | None:
+        return self.by_uuid.get(client_uuid)
+    
+    def get_by_email(self, email: str) -> dict[str, Any] | None:
+        client_uuid = self.email_to_uuid.get(email)
+        return self.by_uuid.get(client_uuid) if client_uuid else None
+    
+    def add(self, client: dict[str, Any]) -> None:
+        """Добавить клиента в снимок (после успешного addClient)"""
+        self.clients.append(client)
+        self._index(client)
+    
+    def remove(self, client_uuid: str) -> None:
+        """Убрать клиента из снимка (после успешного delClient)"""
+        client = self.by_uuid.pop(client_uuid, None)
+        if client is None:
+            return
+        if self.email_to_uuid.get(client.get("email")) == client_uuid:
+            del self.email_to_uuid[client["email"]]
+        self.clients[:] = [c for c in self.clients if c is not client]
+    
+    def update(self, client_uuid: str, changes: dict[str, Any]) -> None:
+        """Применить изменения к клиенту в снимке (после успешного updateClient)"""
+        client = self.by_uuid.get(client_uuid)
+        if client is None:
+            return
+        old_email = client.get("email")
+        client.update(changes)
+        if client.get("email") != old_email:
+            if self.email_to_uuid.get(old_email) == client_uuid:
+                del self.email_to_uuid[old_email]
+            self._index(client)
+    
+    @property
+    def stream_settings(self) -> dict[str, Any]:
+        if self._stream_settings is None:
+            raw = self.inbound.get("streamSettings") or "{}"
+            self._stream_settings = json.loads(raw) if isinstance(raw, str) else dict(raw)
+        return self._stream_settings
+
 
 class X3UIAPI:
     """Клиент для работы с API 3x-UI через сессию"""
     
-    def __init__(self, api_url: str, username: str, password: str):
+    # Сколько секунд снимок Inbounds считается актуальным
+    SNAPSHOT_TTL = 15.0
+    # Сколько запросов updateClient/delClient пакетной операции выполнять одновременно
+    BULK_CONCURRENCY = 8
+    
+    def __init__(
+        self,
+        api_url: str,
+        username: str,
+        password: str,
+        snapshot_ttl: float | None = None,
+        breaker: CircuitBreaker | None = None,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
         """
         Инициализация клиента API 3x-UI
         
@@ -29,6 +132,9 @@ class X3UIAPI:
             api_url: URL API 3x-UI (например: http://ip:2053/panel/api или http://ip:2053/{WEBBASEPATH}/panel/api)
             username: Имя пользователя для авторизации
             password: Пароль для авторизации
+            snapshot_ttl: Время жизни снимка Inbounds в секундах (по умолчанию SNAPSHOT_TTL)
+            breaker: Circuit breaker узла; если цепь открыта, вызовы сразу завершаются PanelUnavailableError
+            transport: Транспорт httpx вместо сетевого (например, httpx.ASGITransport для core.x3ui_sim)
         """
         # Автоматически заменяем localhost на host.docker.internal для доступа к SSH-туннелю на хосте
         # SSH-туннель должен быть запущен на хосте и слушать на 0.0.0.0:38868
@@ -59,9 +165,32 @@ class X3UIAPI:
         # Сессия будет создана при login()
         self._session: httpx.AsyncClient | None = None
         self._logged_in = False
+        # Экземпляр может использоваться конкурентно (см. core.x3ui_registry),
+        # поэтому логин выполняется под блокировкой, а поколение сессии
+        # позволяет не логиниться повторно, если сессию уже обновил другой вызов
+        self._login_lock = asyncio.Lock()
+        self._login_generation = 0
+        
+        # Снимки Inbounds: одна загрузка inbounds/list обслуживает пачку операций
+        self.snapshot_ttl = self.SNAPSHOT_TTL if snapshot_ttl is None else snapshot_ttl
+        self._snapshots: dict[int, InboundSnapshot] = {}
+        self._snapshots_loaded_at = 0.0
+        self._snapshot_lock = asyncio.Lock()
+        
+        self._breaker = breaker
+        self._transport = transport
     
-    async def _ensure_session(self):
-        """Убедиться, что сессия создана и авторизована"""
+    async def _ensure_session(self, through_breaker: bool = True):
+        """
+        Убедиться, что сессия создана и авторизована
+        
+        Args:
+            through_breaker: Выполнять логин через circuit breaker узла (False — вызов
+                уже внутри _request, который сам учитывает результат в breaker)
+        
+        Raises:
+            PanelUnavailableError: если нужен логин, а цепь открыта (панель не запрашивается)
+        """
         if self._session is None:
             # Для host.docker.internal (SSH-туннель) отключаем проверку SSL
             # Для внешних HTTPS URL также отключаем, если установлен флаг
@@ -71,10 +200,95 @@ class X3UIAPI:
                 self.api_url.startswith("http://localhost") or
                 getattr(self, '_disable_ssl_verify', False)
             )
-            self._session = httpx.AsyncClient(timeout=15.0, follow_redirects=True, verify=verify_ssl)
+            self._session = httpx.AsyncClient(
+                timeout=PANEL_TIMEOUT, follow_redirects=True, verify=verify_ssl, transport=self._transport
+            )
         
         if not self._logged_in:
-            await self.login()
+            async with self._login_lock:
+                if not self._logged_in:
+                    if through_breaker and self._breaker is not None:
+                        await self._through_breaker(self.login)
+                    else:
+                        await self.login()
+    
+    @staticmethod
+    def _is_session_expired(response: httpx.Response) -> bool:
+        """
+        Проверить, что панель отклонила запрос из-за истекшей сессии
+        
+        3x-UI отвечает 401 на ajax-запросы без сессии, новые версии отдают 404
+        на /panel/api, а старые делают редирект на страницу логина (HTML вместо JSON).
+        """
+        if response.status_code in (401, 403, 404):
+            return True
+        if response.status_code == 200:
+            content_type = response.headers.get("content-type", "")
+            return "json" not in content_type and response.text.lstrip().startswith("<")
+        return False
+    
+    async def _request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """
+        Выполнить запрос к API через circuit breaker узла
+        
+        Raises:
+            PanelUnavailableError: если цепь открыта и пробный вызов еще не разрешен
+        """
+        if self._breaker is None:
+            return await self._send(method, url, **kwargs)
+        return await self._through_breaker(lambda: self._send(method, url, **kwargs))
+    
+    async def _through_breaker(self, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполнить обращение к панели (запрос API или логин) под контролем circuit breaker
+        
+        Ошибки сети и ответы 5xx (в том числе при логине) считаются отказом узла.
+        
+        Raises:
+            PanelUnavailableError: если цепь открыта и пробный вызов еще не разрешен
+        """
+        allowed, probe = self._breaker.allow()
+        if not allowed:
+            raise PanelUnavailableError(
+                f"Панель 3x-UI {self.base_url} недоступна, повтор через {self._breaker.retry_in():.0f}с "
+                f"(последняя ошибка: {self._breaker.last_error})"
+            )
+        
+        try:
+            result = await call()
+            if isinstance(result, httpx.Response) and result.status_code >= 500:
+                self._breaker.record_failure(f"HTTP {result.status_code}")
+            else:
+                self._breaker.record_success()
+            return result
+        except (httpx.TransportError, ConnectionError) as e:
+            self._breaker.record_failure(e)
+            raise
+        finally:
+            if probe:
+                # Пробный вызов отменен или упал с неожиданной ошибкой — цепь остается открытой
+                self._breaker.release_probe()
+    
+    async def _send(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """
+        Выполнить запрос к API в рамках текущей сессии
+        
+        Если сессия истекла, выполняется повторная авторизация и запрос повторяется один раз.
+        """
+        await self._ensure_session(through_breaker=False)
+        generation = self._login_generation
+        response = await self._session.request(method, url, **kwargs)
+        
+        if self._is_session_expired(response):
+            logger.info(f"Сессия 3x-UI истекла (HTTP {response.status_code}), повторная авторизация: {self.api_url}")
+            async with self._login_lock:
+                # Другой вызов мог уже обновить сессию, пока мы ждали блокировку
+                if self._login_generation == generation:
+                    self._logged_in = False
+                    await self.login()
+            response = await self._session.request(method, url, **kwargs)
+        
+        return response
     
     async def close(self):
         """Закрыть сессию"""
@@ -90,6 +304,9 @@ class X3UIAPI:
         
         Returns:
             True если авторизация успешна, False иначе
+        
+        Raises:
+            ConnectionError: панель недоступна или ответила 5xx
         """
         if self._session is None:
             # Для host.docker.internal (SSH-туннель) отключаем проверку SSL
@@ -100,7 +317,9 @@ class X3UIAPI:
                 self.base_url.startswith("http://localhost") or
                 getattr(self, '_disable_ssl_verify', False)
             )
-            self._session = httpx.AsyncClient(timeout=15.0, follow_redirects=True, verify=verify_ssl)
+            self._session = httpx.AsyncClient(
+                timeout=PANEL_TIMEOUT, follow_redirects=True, verify=verify_ssl, transport=self._transport
+            )
         
         login_endpoint = f"{self.base_url}/login"
         logger.info(f"Авторизация в 3x-UI: {login_endpoint} (base_url: {self.base_url}, api_url: {self.api_url})")
@@ -126,6 +345,7 @@ class X3UIAPI:
                     data = response.json()
                     if data.get("success"):
                         self._logged_in = True
+                        self._login_generation += 1
                         logger.info(f"Успешная авторизация в 3x-UI (API URL: {self.api_url})")
                         return True
                     else:
@@ -135,9 +355,13 @@ class X3UIAPI:
                     # Если ответ не JSON, проверяем cookies
                     if self._session.cookies:
                         self._logged_in = True
+                        self._login_generation += 1
                         logger.info(f"Успешная авторизация в 3x-UI через cookies (API URL: {self.api_url})")
                         return True
             
+            if response.status_code >= 500:
+                # Панель не работает (а не отклонила логин): это отказ узла для circuit breaker
+                raise ConnectionError(f"Панель 3x-UI ответила HTTP {response.status_code} на {login_endpoint}")
             logger.warning(f"Ошибка авторизации в 3x-UI: HTTP {response.status_code}")
             return False
         except httpx.ConnectError as e:
@@ -148,52 +372,111 @@ class X3UIAPI:
             logger.error(f"Ошибка авторизации в 3x-UI (API URL: {self.api_url}): {e}")
             raise
     
-    async def list_inbounds(self) -> list[dict[str, Any]]:
+    async def list_inbounds(self) -> list[dict[str, Any]] | None:
         """
         Получить список всех Inbounds
         
         Returns:
-            Список Inbounds или пустой список при ошибке
+            Список Inbounds (пустой, если на панели их нет) или None при ошибке запроса
+        
+        Raises:
+            PanelUnavailableError: если нужен логин, а цепь circuit breaker открыта
         """
         await self._ensure_session()
         
         try:
-            response = await self._session.get(f"{self.api_url}/inbounds/list")
+            response = await self._request("GET", f"{self.api_url}/inbounds/list")
             
             if response.status_code == 200:
                 data = response.json()
                 if data.get("success") and "obj" in data:
-                    return data["obj"]
+                    return data["obj"] or []
             
             logger.warning(f"Не удалось получить список Inbounds: HTTP {response.status_code}")
-            return []
+            return None
         except Exception as e:
             logger.error(f"Ошибка при получении списка Inbounds из 3x-UI: {e}")
-            return []
+            return None
+    
+    def _snapshots_fresh(self) -> bool:
+        return bool(self._snapshots) and time.monotonic() - self._snapshots_loaded_at < self.snapshot_ttl
+    
+    async def get_snapshots(self, force_refresh: bool = False) -> dict[int, InboundSnapshot]:
+        """
+        Получить снимки всех Inbounds (из кэша, если он не старше snapshot_ttl)
+        
+        Конкурентные вызовы ждут одну загрузку, а не скачивают список параллельно.
+        При ошибке загрузки возвращается последний известный снимок (или пустой словарь),
+        кроме force_refresh: такой вызов нужен именно свежим данным, и устаревший кэш
+        вместо них не отдается.
+        
+        Raises:
+            SnapshotLoadError: если при force_refresh список загрузить не удалось
+            PanelUnavailableError: если цепь circuit breaker открыта
+        """
+        if not force_refresh and self._snapshots_fresh():
+            return self._snapshots
+        
+        async with self._snapshot_lock:
+            if not force_refresh and self._snapshots_fresh():
+                return self._snapshots
+            
+            loaded_at = time.monotonic()
+            inbounds = await self.list_inbounds()
+            if inbounds is None:
+                if force_refresh:
+                    raise SnapshotLoadError(f"Не удалось загрузить список Inbounds с панели {self.base_url}")
+                return self._snapshots
+            
+            snapshots: dict[int, InboundSnapshot] = {}
+            for inbound in inbounds:
+                try:
+                    snapshot = InboundSnapshot(inbound)
+                except (ValueError, TypeError) as e:
+                    logger.error(f"Ошибка парсинга settings для Inbound {inbound.get('id')}: {e}")
+                    continue
+                if snapshot.id is not None:
+                    snapshots[snapshot.id] = snapshot
+            
+            self._snapshots = snapshots
+            self._snapshots_loaded_at = loaded_at
+            return snapshots
+    
+    async def get_snapshot(self, inbound_id: int, force_refresh: bool = False) -> InboundSnapshot | None:
+        """
+        Получить снимок Inbound по ID
+        
+        Raises:
+            SnapshotLoadError: если при force_refresh список загрузить не удалось
+        """
+        snapshots = await self.get_snapshots(force_refresh=force_refresh)
+        return snapshots.get(inbound_id)
+    
+    def invalidate_snapshots(self) -> None:
+        """Сбросить кэш снимков (следующий запрос заново скачает inbounds/list)"""
+        self._snapshots_loaded_at = 0.0
     
     async def find_inbound_by_port_and_protocol(self, port: int, protocol: str = "vless") -> dict[str, Any] | None:
         """Найти Inbound по порту и протоколу"""
-        inbounds = await self.list_inbounds()
-        for inbound in inbounds:
+        snapshots = await self.get_snapshots()
+        for snapshot in snapshots.values():
+            inbound = snapshot.inbound
             if inbound.get("port") == port and inbound.get("protocol", "").lower() == protocol.lower():
                 return inbound
         return None
     
     async def find_first_vless_inbound(self) -> dict[str, Any] | None:
         """Найти первый доступный VLESS Inbound"""
-        inbounds = await self.list_inbounds()
-        for inbound in inbounds:
-            if inbound.get("protocol", "").lower() == "vless":
-                return inbound
+        snapshots = await self.get_snapshots()
+        for snapshot in snapshots.values():
+            if snapshot.inbound.get("protocol", "").lower() == "vless":
+                return snapshot.inbound
         return None
     
     async def get_inbound(self, inbound_id: int) -> dict[str, Any] | None:
         """Получить информацию о Inbound по ID"""
-        inbounds = await self.list_inbounds()
-        for inbound in inbounds:
-            if inbound.get("id") == inbound_id:
-                return inbound
-        return None
+        snapshot = await self.get_snapshot(inbound_id)
+        return snapshot.inbound if snapshot else None
     
     async def add_client(
         self,
@@ -234,17 +517,16 @@ class X3UIAPI:
         endpoint = f"{self.api_url}/inbounds/addClient"
         
         # Формат settings согласно документации
-        settings = {
-            "clients": [{
-                "id": uuid,
-                "email": email,
-                "limitIp": limit_ip,
-                "totalGB": total_gb,
-                "expiryTime": expire,
-                "enable": True,
-                "flow": flow if flow else ""
-            }]
+        client = {
+            "id": uuid,
+            "email": email,
+            "limitIp": limit_ip,
+            "totalGB": total_gb,
+            "expiryTime": expire,
+            "enable": True,
+            "flow": flow if flow else ""
         }
+        settings = {"clients": [client]}
         
         form_data = {
             "id": str(inbound_id),
@@ -254,7 +536,7 @@ class X3UIAPI:
         logger.info(f"Добавление клиента в 3x-UI: endpoint={endpoint}, inbound_id={inbound_id}, email={email}, uuid={uuid}")
         
         try:
-            response = await self._session.post(endpoint, data=form_data)
+            response = await self._request("POST", endpoint, data=form_data)
             
             logger.debug(f"Ответ от addClient: статус {response.status_code}, тело: {response.text[:500]}")
             
@@ -262,6 +544,9 @@ class X3UIAPI:
                 result = response.json()
                 if result.get("success"):
                     logger.info(f"Клиент {email} успешно добавлен в Inbound {inbound_id} с UUID {uuid}")
+                    snapshot = self._snapshots.get(inbound_id)
+                    if snapshot:
+                        snapshot.add(client)
                     return {
                         "id": uuid,
                         "uuid": uuid,
@@ -270,6 +555,8 @@ class X3UIAPI:
                 else:
                     error_msg = result.get('msg', 'Unknown error')
                     logger.warning(f"API вернул success=false: {error_msg}")
+                    # Например, дубликат email: снимок мог устареть
+                    self.invalidate_snapshots()
                     raise ValueError(f"3x-UI API error: {error_msg}")
             else:
                 logger.error(f"HTTP {response.status_code} от {endpoint}: {response.text[:500]}")
@@ -288,13 +575,85 @@ class X3UIAPI:
         
         return None
     
+    async def add_clients(
+        self,
+        inbound_id: int,
+        clients: list[dict[str, Any]],
+        chunk_size: int = 200,
+    ) -> list[dict[str, Any]]:
+        """
+        Добавить много клиентов в Inbound пачками
+        
+        3x-UI принимает в addClient любой список clients, поэтому вместо запроса
+        на каждого клиента отправляется один запрос на chunk_size клиентов.
+        Ошибка в одной пачке не прерывает обработку остальных.
+        
+        Args:
+            inbound_id: ID Inbound в 3x-UI
+            clients: Список словарей с ключами email (обязательно), uuid, flow,
+                expire, limit_ip, total_gb — в том же смысле, что и у add_client,
+                и enable (по умолчанию True)
+            chunk_size: Сколько клиентов отправлять в одном запросе
+        
+        Returns:
+            Список успешно добавленных клиентов ({"id", "uuid", "email"})
+        """
+        from core.xray import generate_uuid
+        
+        await self._ensure_session()
+        
+        endpoint = f"{self.api_url}/inbounds/addClient"
+        added: list[dict[str, Any]] = []
+        
+        for start in range(0, len(clients), chunk_size):
+            chunk = []
+            for item in clients[start:start + chunk_size]:
+                chunk.append({
+                    "id": item.get("uuid") or generate_uuid(),
+                    "email": item["email"],
+                    "limitIp": item.get("limit_ip", 0),
+                    "totalGB": item.get("total_gb", 0),
+                    "expiryTime": item.get("expire", 0),
+                    "enable": item.get("enable", True),
+                    "flow": item.get("flow") or "",
+                })
+            
+            form_data = {
+                "id": str(inbound_id),
+                "settings": json.dumps({"clients": chunk})
+            }
+            
+            logger.info(f"Пакетное добавление {len(chunk)} клиентов в Inbound {inbound_id}: {endpoint}")
+            
+            try:
+                response = await self._request("POST", endpoint, data=form_data)
+                
+                if response.status_code == 200:
+                    result = response.json()
+                    if result.get("success"):
+                        snapshot = self._snapshots.get(inbound_id)
+                        for client in chunk:
+                            if snapshot:
+                                snapshot.add(client)
+                            added.append({"id": client["id"], "uuid": client["id"], "email": client["email"]})
+                        continue
+                    logger.warning(f"Пакет клиентов не добавлен в Inbound {inbound_id}: {result.get('msg', 'Unknown error')}")
+                else:
+                    logger.error(f"HTTP {response.status_code} при пакетном добавлении клиентов: {response.text[:500]}")
+            except Exception as e:
+                logger.error(f"Ошибка при пакетном добавлении клиентов (API URL: {self.api_url}, Inbound ID: {inbound_id}): {e}")
+            
+            self.invalidate_snapshots()
+        
+        return added
+    
     async def delete_client(self, inbound_id: int, email: str) -> bool:
         """
         Удалить клиента из Inbound
         
         3x-UI API требует UUID клиента для удаления, поэтому:
-        1. Получаем inbound со списком клиентов
-        2. Находим клиента по email
+        1. Берем снимок inbound (из кэша, если он свежий)
+        2. Находим UUID клиента по email через индекс
         3. Удаляем по UUID
         
         Args:
@@ -308,21 +667,11 @@ class X3UIAPI:
         
         # Сначала находим UUID клиента по email
         client_uuid = None
+        snapshot = None
         try:
-            inbound = await self.get_inbound(inbound_id)
-            if inbound:
-                settings_str = inbound.get("settings", "{}")
-                if isinstance(settings_str, str):
-                    import json
-                    settings = json.loads(settings_str)
-                else:
-                    settings = settings_str
-                
-                clients = settings.get("clients", [])
-                for client in clients:
-                    if client.get("email") == email:
-                        client_uuid = client.get("id")
-                        break
+            snapshot = await self.get_snapshot(inbound_id)
+            if snapshot:
+                client_uuid = snapshot.email_to_uuid.get(email)
         except Exception as e:
             logger.warning(f"Ошибка при поиске UUID клиента {email}: {e}")
         
@@ -335,21 +684,24 @@ class X3UIAPI:
         logger.info(f"Удаление клиента {email} (UUID: {client_uuid}): {endpoint}")
         
         try:
-            response = await self._session.post(endpoint)
+            response = await self._request("POST", endpoint)
             
             if response.status_code == 200:
                 result = response.json()
                 if result.get("success"):
                     logger.info(f"Клиент {email} (UUID: {client_uuid}) удален из Inbound {inbound_id}")
+                    snapshot.remove(client_uuid)
                     return True
                 else:
                     logger.warning(f"Не удалось удалить клиента: {result.get('msg', 'Unknown error')}")
             else:
                 logger.warning(f"HTTP {response.status_code} при удалении клиента: {response.text}")
             
+            self.invalidate_snapshots()
             return False
         except Exception as e:
             logger.error(f"Ошибка при удалении клиента из 3x-UI: {e}")
+            self.invalidate_snapshots()
             return False
     
     async def update_client(
@@ -379,63 +731,222 @@ class X3UIAPI:
         """
         await self._ensure_session()
         
-        # Сначала получаем текущие данные клиента
-        inbound = await self.get_inbound(inbound_id)
-        if not inbound:
+        # Сначала получаем текущие данные клиента из снимка
+        snapshot = await self.get_snapshot(inbound_id)
+        if not snapshot:
             logger.warning(f"Inbound {inbound_id} не найден")
             return False
         
-        # Парсим settings
-        try:
-            settings = json.loads(inbound.get("settings", "{}"))
-            clients = settings.get("clients", [])
-        except:
-            logger.error(f"Ошибка парсинга settings для Inbound {inbound_id}")
-            return False
-        
-        # Ищем клиента по UUID
-        client_found = False
-        for client in clients:
-            if client.get("id") == client_uuid:
-                client_found = True
-                if email is not None:
-                    client["email"] = email
-                if enable is not None:
-                    client["enable"] = enable
-                if expire is not None:
-                    client["expiryTime"] = expire
-                if limit_ip is not None:
-                    client["limitIp"] = limit_ip
-                if total_gb is not None:
-                    client["totalGB"] = total_gb
-                break
-        
-        if not client_found:
+        client = snapshot.get_by_uuid(client_uuid)
+        if client is None:
             logger.warning(f"Клиент с UUID {client_uuid} не найден в Inbound {inbound_id}")
             return False
         
-        # Отправляем обновление через updateClient
+        changes: dict[str, Any] = {}
+        if email is not None:
+            changes["email"] = email
+        if enable is not None:
+            changes["enable"] = enable
+        if expire is not None:
+            changes["expiryTime"] = expire
+        if limit_ip is not None:
+            changes["limitIp"] = limit_ip
+        if total_gb is not None:
+            changes["totalGB"] = total_gb
+        
+        # Отправляем обновление через updateClient.
+        # 3x-UI берет первого клиента из списка, поэтому передаем только обновляемого
         endpoint = f"{self.api_url}/inbounds/updateClient/{client_uuid}"
         
         form_data = {
             "id": str(inbound_id),
-            "settings": json.dumps({"clients": clients})
+            "settings": json.dumps({"clients": [{**client, **changes}]})
         }
         
         try:
-            response = await self._session.post(endpoint, data=form_data)
+            response = await self._request("POST", endpoint, data=form_data)
             
             if response.status_code == 200:
                 result = response.json()
                 if result.get("success"):
                     logger.info(f"Клиент {client_uuid} обновлен в Inbound {inbound_id}")
+                    snapshot.update(client_uuid, changes)
                     return True
             
+            self.invalidate_snapshots()
             return False
         except Exception as e:
             logger.error(f"Ошибка при обновлении клиента в 3x-UI: {e}")
+            self.invalidate_snapshots()
+            return False
+    
+    async def update_clients(self, inbound_id: int, changes: dict[str, dict[str, Any]]) -> bool:
+        """
+        Изменить сразу много клиентов одного Inbound
+        
+        Каждый клиент меняется своим updateClient/{uuid} (не больше BULK_CONCURRENCY
+        запросов одновременно). Inbound целиком не отправляется: core API и воркер
+        пишут в один Inbound параллельно, и список клиентов из снимка удалил бы
+        клиентов, добавленных другим процессом между загрузкой снимка и отправкой.
+        Снимок загружается принудительно: updateClient заменяет клиента целиком,
+        поэтому остальные поля клиента берутся из свежего списка.
+        
+        Args:
+            inbound_id: ID Inbound
+            changes: UUID клиента -> поля клиента в формате 3x-UI (enable, expiryTime, ...)
+        
+        Returns:
+            True если изменены все найденные клиенты (или изменять нечего); False, если
+            хотя бы один запрос не удался или свежий снимок загрузить не удалось
+        """
+        if not changes:
+            return True
+        
+        snapshot = await self._fresh_snapshot(inbound_id)
+        if not snapshot:
+            return False
+        
+        applied = {client_uuid: change for client_uuid, change in changes.items() if client_uuid in snapshot.by_uuid}
+        missing = len(changes) - len(applied)
+        if missing:
+            logger.warning(f"{missing} клиентов не найдены в Inbound {inbound_id}, пропускаем их")
+        if not applied:
+            return True
+        
+        logger.info(f"Пакетное обновление {len(applied)} клиентов в Inbound {inbound_id}")
+        
+        async def update_one(client_uuid: str, change: dict[str, Any]) -> bool:
+            client = {**snapshot.by_uuid[client_uuid], **change}
+            if not await self._post_client(f"inbounds/updateClient/{client_uuid}", inbound_id, client):
+                return False
+            snapshot.update(client_uuid, change)
+            return True
+        
+        updated = await self._gather_bounded(update_one(client_uuid, change) for client_uuid, change in applied.items())
+        return self._bulk_result(inbound_id, "Обновлено", updated, len(applied))
+    
+    async def remove_clients(self, inbound_id: int, client_uuids: set[str] | list[str]) -> bool:
+        """
+        Удалить много клиентов одного Inbound
+        
+        Каждый клиент удаляется своим delClient (не больше BULK_CONCURRENCY запросов
+        одновременно), по той же причине, что и в update_clients: отправка Inbound
+        целиком удалила бы клиентов, добавленных другим процессом.
+        
+        Args:
+            inbound_id: ID Inbound
+            client_uuids: UUID удаляемых клиентов
+        
+        Returns:
+            True если удалены все найденные клиенты (или удалять нечего); False, если
+            хотя бы один запрос не удался или свежий снимок загрузить не удалось
+        """
+        client_uuids = set(client_uuids)
+        if not client_uuids:
+            return True
+        
+        snapshot = await self._fresh_snapshot(inbound_id)
+        if not snapshot:
+            return False
+        
+        removed = client_uuids & snapshot.by_uuid.keys()
+        if not removed:
+            return True
+        
+        logger.info(f"Пакетное удаление {len(removed)} клиентов из Inbound {inbound_id}")
+        
+        async def remove_one(client_uuid: str) -> bool:
+            if not await self._post_client(f"inbounds/{inbound_id}/delClient/{client_uuid}", inbound_id):
+                return False
+            snapshot.remove(client_uuid)
+            return True
+        
+        deleted = await self._gather_bounded(remove_one(client_uuid) for client_uuid in removed)
+        return self._bulk_result(inbound_id, "Удалено", deleted, len(removed))
+    
+    async def _fresh_snapshot(self, inbound_id: int) -> InboundSnapshot | None:
+        """
+        Свежий снимок Inbound для пакетного изменения клиентов или None
+        
+        Без свежего списка клиентов пачка не выполняется (вызывающий код повторит ее):
+        по снимку из кэша нельзя найти клиентов, добавленных после его загрузки,
+        а updateClient вернул бы старые значения полей клиента.
+        """
+        try:
+            snapshot = await self.get_snapshot(inbound_id, force_refresh=True)
+        except ConnectionError as e:
+            logger.warning(f"Не удалось получить свежий снимок Inbound {inbound_id}, пачка отложена: {e}")
+            return None
+        if not snapshot:
+            logger.warning(f"Inbound {inbound_id} не найден")
+        return snapshot
+    
+    async def _gather_bounded(self, calls: Iterable[Awaitable[bool]]) -> list[bool]:
+        """Выполнить вызовы панели параллельно, не больше BULK_CONCURRENCY одновременно"""
+        semaphore = asyncio.Semaphore(self.BULK_CONCURRENCY)
+        
+        async def run(call: Awaitable[bool]) -> bool:
+            async with semaphore:
+                return await call
+        
+        return list(await asyncio.gather(*(run(call) for call in calls)))
+    
+    def _bulk_result(self, inbound_id: int, action: str, results: list[bool], total: int) -> bool:
+        done = sum(results)
+        if done < total:
+            logger.warning(f"{action} {done} из {total} клиентов в Inbound {inbound_id}")
+            # Снимок мог разойтись с панелью: следующая операция загрузит его заново
+            self.invalidate_snapshots()
+            return False
+        logger.info(f"{action} {total} клиентов в Inbound {inbound_id}")
+        return True
+    
+    async def _post_client(self, path: str, inbound_id: int, client: dict[str, Any] | None = None) -> bool:
+        """
+        POST на эндпоинт одного клиента (updateClient или delClient)
+        
+        Args:
+            path: Путь относительно api_url
+            inbound_id: ID Inbound
+            client: Новые данные клиента для updateClient (None — запрос без тела)
+        
+        Returns:
+            True если панель ответила success
+        """
+        kwargs: dict[str, Any] = {}
+        if client is not None:
+            # 3x-UI берет первого клиента из списка
+            kwargs["data"] = {"id": str(inbound_id), "settings": json.dumps({"clients": [client]})}
+        
+        try:
+            response = await self._request("POST", f"{self.api_url}/{path}", **kwargs)
+            
+            if response.status_code == 200:
+                result = response.json()
+                if result.get("success"):
+                    return True
+                logger.warning(f"3x-UI отклонил {path}: {result.get('msg', 'Unknown error')}")
+            else:
+                logger.warning(f"HTTP {response.status_code} от {path}: {response.text[:500]}")
+            return False
+        except Exception as e:
+            logger.error(f"Ошибка запроса {path} к 3x-UI: {e}")
             return False
     
+    async def set_clients_enabled(self, inbound_id: int, client_uuids: set[str] | list[str], enable: bool) -> bool:
+        """
+        Включить или отключить много клиентов (см. update_clients)
+        
+        Args:
+            inbound_id: ID Inbound
+            client_uuids: UUID клиентов
+            enable: True — включить, False — отключить
+        
+        Returns:
+            True если успешно
+        """
+        return await self.update_clients(inbound_id, {client_uuid: {"enable": enable} for client_uuid in client_uuids})
+    
     async def get_client_config(self, inbound_id: int, email: str) -> dict[str, Any] | None:
         """
         Получить конфиг клиента из Inbound
@@ -447,31 +958,29 @@ class X3UIAPI:
         Returns:
             Данные клиента или None
         """
-        inbound = await self.get_inbound(inbound_id)
-        if not inbound:
+        snapshot = await self.get_snapshot(inbound_id)
+        if not snapshot:
             return None
         
         try:
-            settings = json.loads(inbound.get("settings", "{}"))
-            clients = settings.get("clients", [])
-            
-            for client in clients:
-                if client.get("email") == email:
-                    # Добавляем данные из inbound для генерации конфига
-                    stream_settings = json.loads(inbound.get("streamSettings", "{}"))
-                    return {
-                        "uuid": client.get("id"),
-                        "email": client.get("email"),
-                        "flow": client.get("flow", ""),
-                        "port": inbound.get("port"),
-                        "protocol": inbound.get("protocol"),
-                        "network": stream_settings.get("network", "tcp"),
-                        "security": stream_settings.get("security", "none"),
-                        "reality_settings": stream_settings.get("realitySettings", {}),
-                        "tls_settings": stream_settings.get("tlsSettings", {}),
-                        "ws_settings": stream_settings.get("wsSettings", {}),
-                        "grpc_settings": stream_settings.get("grpcSettings", {}),
-                    }
+            client = snapshot.get_by_email(email)
+            if client:
+                # Добавляем данные из inbound для генерации конфига
+                inbound = snapshot.inbound
+                stream_settings = snapshot.stream_settings
+                return {
+                    "uuid": client.get("id"),
+                    "email": client.get("email"),
+                    "flow": client.get("flow", ""),
+                    "port": inbound.get("port"),
+                    "protocol": inbound.get("protocol"),
+                    "network": stream_settings.get("network", "tcp"),
+                    "security": stream_settings.get("security", "none"),
+                    "reality_settings": stream_settings.get("realitySettings", {}),
+                    "tls_settings": stream_settings.get("tlsSettings", {}),
+                    "ws_settings": stream_settings.get("wsSettings", {}),
+                    "grpc_settings": stream_settings.get("grpcSettings", {}),
+                }
             
             return None
         except Exception as e:
@@ -494,7 +1003,7 @@ class X3UIAPI:
         endpoint = f"{self.api_url}/inbounds/getClientTraffics/{encoded_email}"
         
         try:
-            response = await self._session.get(endpoint)
+            response = await self._request("GET", endpoint)
             
             if response.status_code == 200:
                 result = response.json()
@@ -522,7 +1031,7 @@ class X3UIAPI:
         endpoint = f"{self.api_url}/inbounds/clientIps/{encoded_email}"
         
         try:
-            response = await self._session.post(endpoint)
+            response = await self._request("POST", endpoint)
             
             if response.status_code == 200:
                 result = response.json()
@@ -557,7 +1066,7 @@ class X3UIAPI:
         endpoint = f"{self.api_url}/inbounds/clearClientIps/{encoded_email}"
         
         try:
-            response = await self._session.post(endpoint)
+            response = await self._request("POST", endpoint)
             
             if response.status_code == 200:
                 result = response.json()
@@ -568,6 +1077,21 @@ class X3UIAPI:
             logger.error(f"Ошибка при очистке IP клиента: {e}")
             return False
     
+    async def ping(self) -> bool:
+        """
+        Проверить, что API панели отвечает (легкий запрос списка онлайн клиентов)
+        
+        Raises:
+            PanelUnavailableError, httpx.TransportError: если панель недоступна
+        """
+        response = await self._request("POST", f"{self.api_url}/inbounds/onlines")
+        if response.status_code != 200:
+            return False
+        try:
+            return bool(response.json().get("success"))
+        except ValueError:
+            return False
+    
     async def get_online_clients(self) -> list[dict[str, Any]]:
         """
         Получить список онлайн клиентов
@@ -580,7 +1104,7 @@ class X3UIAPI:
         endpoint = f"{self.api_url}/inbounds/onlines"
         
         try:
-            response = await self._session.post(endpoint)
+            response = await self._request("POST", endpoint)
             
             if response.status_code == 200:
                 result = response.json()
@@ -0,0 +1,120 @@
+"""
+Реестр постоянных сессий 3x-UI
+
+Держит по одному авторизованному X3UIAPI (и его httpx.AsyncClient с cookies) на сервер,
+чтобы не выполнять POST /login на каждый вызов панели. Истекшая сессия обновляется
+внутри X3UIAPI автоматически, а при изменении настроек сервера клиент пересоздается.
+
+Для каждого сервера здесь же хранится circuit breaker: он переживает пересоздание
+клиента, так что недоступная панель не начинает каждый раз с полного сетевого таймаута.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any
+
+from core.circuit_breaker import CircuitBreaker
+from core.db.models import Server
+from core.x3ui_api import X3UIAPI
+
+logger = logging.getLogger(__name__)
+
+
+class X3UIRegistry:
+    """Process-wide реестр клиентов 3x-UI, ключ — Server.id"""
+
+    def __init__(self):
+        # server_id -> (отпечаток настроек подключения, клиент)
+        self._clients: dict[int, tuple[tuple[str, str, str], X3UIAPI]] = {}
+        self._breakers: dict[int, CircuitBreaker] = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _fingerprint(server: Server) -> tuple[str, str, str]:
+        return (server.x3ui_api_url or "", server.x3ui_username or "", server.x3ui_password or "")
+
+    async def get(self, server: Server) -> X3UIAPI:
+        """
+        Получить общий клиент 3x-UI для сервера
+
+        Клиент не нужно закрывать после использования — им владеет реестр.
+        Если настройки подключения в строке сервера изменились (в том числе
+        в другом процессе), старый клиент закрывается и создается новый.
+
+        Raises:
+            ValueError: если у сервера не настроен API 3x-UI
+        """
+        if not server.x3ui_api_url or not server.x3ui_username or not server.x3ui_password:
+            raise ValueError(f"API 3x-UI не настроен для сервера {server.name}")
+
+        fingerprint = self._fingerprint(server)
+        stale: X3UIAPI | None = None
+
+        async with self._lock:
+            entry = self._clients.get(server.id)
+            if entry and entry[0] == fingerprint:
+                return entry[1]
+            if entry:
+                stale = entry[1]
+                # Новые настройки могли починить подключение — начинаем с закрытой цепи
+                self._breakers.pop(server.id, None)
+                logger.info(f"Настройки 3x-UI для сервера {server.name} изменились, пересоздаем сессию")
+
+            client = X3UIAPI(
+                api_url=server.x3ui_api_url,
+                username=server.x3ui_username,
+                password=server.x3ui_password,
+                breaker=self._get_breaker(server),
+            )
+            self._clients[server.id] = (fingerprint, client)
+
+        if stale:
+            await self._close_quietly(stale)
+        return client
+
+    def _get_breaker(self, server: Server) -> CircuitBreaker:
+        breaker = self._breakers.get(server.id)
+        if breaker is None:
+            breaker = CircuitBreaker(name=f"3x-UI {server.name}")
+            self._breakers[server.id] = breaker
+        return breaker
+
+    def breaker_state(self, server_id: int) -> dict[str, Any]:
+        """
+        Состояние circuit breaker сервера для админки
+
+        Сервер, к панели которого еще не обращались, считается доступным.
+        """
+        breaker = self._breakers.get(server_id)
+        if breaker is None:
+            return {"state": CircuitBreaker.CLOSED, "consecutive_failures": 0, "cooldown_seconds": 0.0,
+                    "retry_in_seconds": 0.0, "last_error": None}
+        return breaker.snapshot()
+
+    async def invalidate(self, server_id: int) -> None:
+        """Сбросить сессию и circuit breaker сервера (после редактирования или удаления сервера)"""
+        async with self._lock:
+            entry = self._clients.pop(server_id, None)
+            self._breakers.pop(server_id, None)
+        if entry:
+            await self._close_quietly(entry[1])
+            logger.info(f"Сессия 3x-UI для сервера {server_id} сброшена")
+
+    async def close_all(self) -> None:
+        """Закрыть все сессии (при остановке приложения)"""
+        async with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for _, client in entries:
+            await self._close_quietly(client)
+
+    @staticmethod
+    async def _close_quietly(client: X3UIAPI) -> None:
+        try:
+            await client.close()
+        except Exception as e:
+            logger.debug(f"Ошибка при закрытии сессии 3x-UI: {e}")
+
+
+x3ui_registry = X3UIRegistry()
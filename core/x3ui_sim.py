@@ -0,0 +1,524 @@
+"""
+Локальный симулятор панели 3x-UI для нагрузочных и интеграционных проверок
+
+ASGI-приложение реализует те эндпоинты, которыми пользуется core.x3ui_api.X3UIAPI:
+/login, inbounds/list, addClient, updateClient, update/{id}, delClient, clientIps,
+clearClientIps, onlines и getClientTraffics. Состояние хранится в памяти и ведет себя
+как настоящая панель: сессия через cookie, дубликаты email отклоняются, без сессии
+API отвечает 404. Задержка, доля ошибок и размер Inbound настраиваются.
+
+Использование в коде (без сети, через httpx.ASGITransport):
+
+    async with simulated_panel(clients=50_000, latency_ms=20) as sim:
+        x3ui = sim.client()
+        await x3ui.get_snapshots()
+
+Отдельным процессом (URL панели для сервера: http://<ip>:2053/panel/api;
+localhost X3UIAPI подменяет на host.docker.internal, поэтому указывайте IP):
+
+    python -m core.x3ui_sim serve --port 2053 --clients 50000
+    python -m core.x3ui_sim bench --clients 50000 --latency-ms 20
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import secrets
+import time
+import uuid as uuid_lib
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from core.x3ui_api import X3UIAPI
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "3x-ui"
+
+
+class SimConfig:
+    """Параметры поведения симулятора"""
+
+    def __init__(
+        self,
+        username: str = "admin",
+        password: str = "admin",
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        session_ttl: float | None = None,
+        seed: int | None = None,
+    ):
+        """
+        Args:
+            username: Логин панели
+            password: Пароль панели
+            latency_ms: Базовая задержка ответа API (миллисекунды)
+            jitter_ms: Случайная добавка к задержке (0..jitter_ms)
+            error_rate: Доля запросов API, на которые панель отвечает HTTP 500 (0..1)
+            session_ttl: Через сколько секунд сессия истекает (None — не истекает)
+            seed: Seed генератора случайных чисел для воспроизводимых прогонов
+        """
+        self.username = username
+        self.password = password
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.random = random.Random(seed)
+
+
+class SimInbound:
+    """Inbound в памяти с индексами клиентов"""
+
+    def __init__(self, inbound_id: int, port: int, protocol: str = "vless", remark: str = ""):
+        self.id = inbound_id
+        self.port = port
+        self.protocol = protocol
+        self.remark = remark or f"sim-{inbound_id}"
+        self.enable = True
+        self.settings: dict[str, Any] = {"clients": [], "decryption": "none", "fallbacks": []}
+        self.stream_settings: dict[str, Any] = {
+            "network": "tcp",
+            "security": "reality",
+            "realitySettings": {"serverNames": ["example.com"], "shortIds": ["abcd"]},
+        }
+        self.by_uuid: dict[str, dict[str, Any]] = {}
+        self.by_email: dict[str, dict[str, Any]] = {}
+        # Сериализованный settings кэшируется до следующего изменения:
+        # симулятор не должен быть узким местом при 50k клиентов
+        self._settings_json: str | None = None
+
+    @property
+    def clients(self) -> list[dict[str, Any]]:
+        return self.settings["clients"]
+
+    def add(self, client: dict[str, Any]) -> None:
+        self.clients.append(client)
+        self.by_uuid[client["id"]] = client
+        self.by_email[client["email"]] = client
+        self._settings_json = None
+
+    def remove(self, client_uuid: str) -> dict[str, Any] | None:
+        client = self.by_uuid.pop(client_uuid, None)
+        if client is None:
+            return None
+        self.by_email.pop(client.get("email"), None)
+        self.settings["clients"] = [c for c in self.clients if c is not client]
+        self._settings_json = None
+        return client
+
+    def replace_settings(self, settings: dict[str, Any]) -> None:
+        settings.setdefault("clients", [])
+        self.settings = settings
+        self.by_uuid = {c["id"]: c for c in self.clients if c.get("id")}
+        self.by_email = {c["email"]: c for c in self.clients if c.get("email")}
+        self._settings_json = None
+
+    def touch(self) -> None:
+        self._settings_json = None
+
+    def to_dict(self) -> dict[str, Any]:
+        if self._settings_json is None:
+            self._settings_json = json.dumps(self.settings)
+        return {
+            "id": self.id,
+            "up": 0,
+            "down": 0,
+            "total": 0,
+            "remark": self.remark,
+            "enable": self.enable,
+            "expiryTime": 0,
+            "port": self.port,
+            "protocol": self.protocol,
+            "settings": self._settings_json,
+            "streamSettings": json.dumps(self.stream_settings),
+            "tag": f"inbound-{self.port}",
+            "sniffing": "{}",
+            "clientStats": [],
+        }
+
+
+class PanelState:
+    """Состояние панели: Inbounds, онлайн клиенты, IP и трафик"""
+
+    def __init__(self):
+        self.inbounds: dict[int, SimInbound] = {}
+        self.online: set[str] = set()
+        self.client_ips: dict[str, list[str]] = {}
+        self.traffic: dict[str, dict[str, int]] = {}
+        self.sessions: dict[str, float] = {}
+        # Счетчики запросов по эндпоинтам (для отчетов бенчмарка)
+        self.requests: dict[str, int] = {}
+
+    def find_email(self, email: str) -> tuple[SimInbound, dict[str, Any]] | None:
+        for inbound in self.inbounds.values():
+            client = inbound.by_email.get(email)
+            if client is not None:
+                return inbound, client
+        return None
+
+    def seed(
+        self,
+        clients: int,
+        inbound_id: int = 1,
+        port: int = 443,
+        online_ratio: float = 0.1,
+        max_ips: int = 3,
+        server_id: int = 1,
+        rng: random.Random | None = None,
+    ) -> SimInbound:
+        """
+        Создать Inbound и заполнить его клиентами
+
+        Email клиентов совпадают с форматом core: tg_<n>_server_<server_id>@fiorevpn.
+        Доля online_ratio клиентов считается онлайн с 1..max_ips IP адресами.
+        """
+        rng = rng or random.Random()
+        inbound = self.inbounds.get(inbound_id) or SimInbound(inbound_id, port)
+        self.inbounds[inbound_id] = inbound
+
+        expiry = int((time.time() + 30 * 86400) * 1000)
+        for n in range(1, clients + 1):
+            email = f"tg_{n}_server_{server_id}@fiorevpn"
+            if email in inbound.by_email:
+                continue
+            inbound.add({
+                "id": str(uuid_lib.UUID(int=rng.getrandbits(128), version=4)),
+                "email": email,
+                "limitIp": 1,
+                "totalGB": 0,
+                "expiryTime": expiry,
+                "enable": True,
+                "flow": "xtls-rprx-vision",
+                "tgId": "",
+                "subId": secrets.token_hex(8),
+            })
+            if rng.random() < online_ratio:
+                self.online.add(email)
+                self.client_ips[email] = [
+                    f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+                    for _ in range(rng.randint(1, max_ips))
+                ]
+        return inbound
+
+
+def create_panel_app(state: PanelState | None = None, config: SimConfig | None = None) -> FastAPI:
+    """Создать ASGI-приложение симулятора"""
+    state = state or PanelState()
+    config = config or SimConfig()
+    app = FastAPI(title="3x-UI simulator")
+    app.state.panel = state
+    app.state.config = config
+
+    def ok(obj: Any = None, msg: str = "") -> JSONResponse:
+        return JSONResponse({"success": True, "msg": msg, "obj": obj})
+
+    def fail(msg: str) -> JSONResponse:
+        return JSONResponse({"success": False, "msg": msg, "obj": None})
+
+    @app.middleware("http")
+    async def simulate_panel(request: Request, call_next):
+        path = request.url.path
+        if path.startswith("/panel/api/"):
+            name = next((part for part in path.split("/")[4:] if part and not part.isdigit()), path)
+            state.requests[name] = state.requests.get(name, 0) + 1
+
+            token = request.cookies.get(SESSION_COOKIE)
+            expires_at = state.sessions.get(token) if token else None
+            if expires_at is None or expires_at < time.monotonic():
+                # Как новые версии 3x-UI: без сессии API недоступен
+                state.sessions.pop(token, None)
+                return JSONResponse({"success": False, "msg": "not found"}, status_code=404)
+
+            delay = config.latency_ms + (config.random.uniform(0, config.jitter_ms) if config.jitter_ms else 0.0)
+            if delay > 0:
+                await asyncio.sleep(delay / 1000)
+            if config.error_rate and config.random.random() < config.error_rate:
+                return JSONResponse({"success": False, "msg": "simulated failure"}, status_code=500)
+        return await call_next(request)
+
+    @app.post("/login")
+    async def login(request: Request):
+        form = await request.form()
+        if form.get("username") != config.username or form.get("password") != config.password:
+            return fail("Неверное имя пользователя или пароль")
+        token = secrets.token_hex(16)
+        ttl = config.session_ttl if config.session_ttl is not None else 10 * 365 * 86400
+        state.sessions[token] = time.monotonic() + ttl
+        response = ok(msg="Вход выполнен успешно")
+        response.set_cookie(SESSION_COOKIE, token, httponly=True)
+        return response
+
+    @app.get("/panel/api/inbounds/list")
+    async def inbounds_list():
+        return ok([inbound.to_dict() for inbound in state.inbounds.values()])
+
+    @app.post("/panel/api/inbounds/addClient")
+    async def add_client(request: Request):
+        form = await request.form()
+        inbound = state.inbounds.get(int(form.get("id") or 0))
+        if inbound is None:
+            return fail("Inbound not found")
+        new_clients = json.loads(form.get("settings") or "{}").get("clients", [])
+        for client in new_clients:
+            if client.get("email") in inbound.by_email or state.find_email(client.get("email", "")):
+                return fail(f"Duplicate email: {client.get('email')}")
+        for client in new_clients:
+            inbound.add(client)
+        return ok(msg="Клиент(ы) добавлены")
+
+    @app.post("/panel/api/inbounds/updateClient/{client_uuid}")
+    async def update_client(client_uuid: str, request: Request):
+        form = await request.form()
+        inbound = state.inbounds.get(int(form.get("id") or 0))
+        if inbound is None or client_uuid not in inbound.by_uuid:
+            return fail("Client not found")
+        new_clients = json.loads(form.get("settings") or "{}").get("clients", [])
+        if not new_clients:
+            return fail("Empty clients")
+        # 3x-UI берет первого клиента из списка
+        client = inbound.by_uuid[client_uuid]
+        old_email = client.get("email")
+        client.clear()
+        client.update(new_clients[0])
+        if client.get("email") != old_email:
+            inbound.by_email.pop(old_email, None)
+            inbound.by_email[client["email"]] = client
+        if client.get("id") != client_uuid:
+            inbound.by_uuid.pop(client_uuid, None)
+            inbound.by_uuid[client["id"]] = client
+        inbound.touch()
+        return ok(msg="Клиент обновлен")
+
+    @app.post("/panel/api/inbounds/update/{inbound_id}")
+    async def update_inbound(inbound_id: int, request: Request):
+        inbound = state.inbounds.get(inbound_id)
+        if inbound is None:
+            return fail("Inbound not found")
+        payload = await request.json()
+        settings = payload.get("settings")
+        if isinstance(settings, str):
+            settings = json.loads(settings)
+        if settings is not None:
+            inbound.replace_settings(settings)
+        if "enable" in payload:
+            inbound.enable = bool(payload["enable"])
+        return ok(msg="Inbound обновлен")
+
+    @app.post("/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}")
+    async def del_client(inbound_id: int, client_uuid: str):
+        inbound = state.inbounds.get(inbound_id)
+        if inbound is None:
+            return fail("Inbound not found")
+        client = inbound.remove(client_uuid)
+        if client is None:
+            return fail("Client not found")
+        state.online.discard(client.get("email"))
+        return ok(msg="Клиент удален")
+
+    @app.post("/panel/api/inbounds/clientIps/{email}")
+    async def client_ips(email: str):
+        ips = state.client_ips.get(email)
+        return ok(",".join(ips) if ips else "No IP Record")
+
+    @app.post("/panel/api/inbounds/clearClientIps/{email}")
+    async def clear_client_ips(email: str):
+        state.client_ips.pop(email, None)
+        return ok(msg="IP очищены")
+
+    @app.post("/panel/api/inbounds/onlines")
+    async def onlines():
+        return ok(sorted(state.online))
+
+    @app.get("/panel/api/inbounds/getClientTraffics/{email}")
+    async def client_traffics(email: str):
+        found = state.find_email(email)
+        if found is None:
+            return ok(None)
+        inbound, client = found
+        usage = state.traffic.get(email, {"up": 0, "down": 0})
+        return ok({
+            "id": 0,
+            "inboundId": inbound.id,
+            "enable": client.get("enable", True),
+            "email": email,
+            "up": usage["up"],
+            "down": usage["down"],
+            "expiryTime": client.get("expiryTime", 0),
+            "total": client.get("totalGB", 0),
+        })
+
+    return app
+
+
+class SimulatedPanel:
+    """Запущенный в процессе симулятор: состояние и фабрика клиентов X3UIAPI"""
+
+    API_URL = "http://x3ui-sim/panel/api"
+
+    def __init__(self, state: PanelState, config: SimConfig):
+        self.state = state
+        self.config = config
+        self.app = create_panel_app(state, config)
+        self._clients: list[X3UIAPI] = []
+
+    def client(self, **kwargs: Any) -> X3UIAPI:
+        """Новый X3UIAPI, подключенный к симулятору через ASGI-транспорт"""
+        x3ui = X3UIAPI(
+            api_url=self.API_URL,
+            username=self.config.username,
+            password=self.config.password,
+            transport=httpx.ASGITransport(app=self.app),
+            **kwargs,
+        )
+        self._clients.append(x3ui)
+        return x3ui
+
+    async def close(self) -> None:
+        for x3ui in self._clients:
+            await x3ui.close()
+        self._clients.clear()
+
+
+@asynccontextmanager
+async def simulated_panel(
+    clients: int = 0,
+    inbound_id: int = 1,
+    online_ratio: float = 0.1,
+    server_id: int = 1,
+    **config: Any,
+) -> AsyncIterator[SimulatedPanel]:
+    """
+    Поднять симулятор панели в текущем процессе
+
+    Args:
+        clients: Сколько клиентов создать в Inbound inbound_id
+        inbound_id: ID создаваемого Inbound
+        online_ratio: Доля клиентов онлайн
+        server_id: ID сервера в email клиентов
+        **config: Параметры SimConfig (latency_ms, error_rate, session_ttl, ...)
+    """
+    sim_config = SimConfig(**config)
+    state = PanelState()
+    state.seed(clients, inbound_id=inbound_id, online_ratio=online_ratio, server_id=server_id, rng=sim_config.random)
+    panel = SimulatedPanel(state, sim_config)
+    try:
+        yield panel
+    finally:
+        await panel.close()
+
+
+async def run_benchmark(
+    clients: int,
+    batch: int = 1000,
+    online_ratio: float = 0.1,
+    **config: Any,
+) -> list[tuple[str, float, str]]:
+    """
+    Прогнать основные пути работы с панелью на симуляторе
+
+    Returns:
+        Список (сценарий, секунды, комментарий)
+    """
+    from core.panel_executor import panel_executor
+
+    results: list[tuple[str, float, str]] = []
+
+    async with simulated_panel(clients=clients, online_ratio=online_ratio, **config) as sim:
+        x3ui = sim.client()
+
+        started = time.perf_counter()
+        await x3ui.login()
+        results.append(("login", time.perf_counter() - started, ""))
+
+        started = time.perf_counter()
+        snapshot = await x3ui.get_snapshot(1, force_refresh=True)
+        results.append(("inbounds/list + разбор снимка", time.perf_counter() - started, f"{len(snapshot.clients)} клиентов"))
+
+        started = time.perf_counter()
+        for n in range(1, batch + 1):
+            snapshot.get_by_email(f"tg_{n}_server_1@fiorevpn")
+        results.append((f"{batch} поисков клиента по email", time.perf_counter() - started, "из снимка"))
+
+        new_clients = [
+            {"email": f"tg_{clients + n}_server_1@fiorevpn", "expire": 0, "limit_ip": 1}
+            for n in range(1, batch + 1)
+        ]
+        started = time.perf_counter()
+        added = await x3ui.add_clients(1, new_clients, chunk_size=200)
+        results.append((f"add_clients x{batch}", time.perf_counter() - started, f"добавлено {len(added)}"))
+
+        uuids = [client["uuid"] for client in added]
+        started = time.perf_counter()
+        disabled = await x3ui.set_clients_enabled(1, uuids, False)
+        results.append((f"set_clients_enabled x{len(uuids)}", time.perf_counter() - started, f"успех={disabled}"))
+
+        started = time.perf_counter()
+        online = await x3ui.get_online_clients()
+        ip_results = await panel_executor.gather(1, x3ui.get_client_ips, online)
+        errors = sum(1 for result in ip_results if isinstance(result, BaseException))
+        results.append(("IP sweep (onlines + clientIps)", time.perf_counter() - started, f"{len(online)} онлайн, ошибок {errors}"))
+
+        started = time.perf_counter()
+        removed = await x3ui.remove_clients(1, uuids)
+        results.append((f"remove_clients x{len(uuids)}", time.perf_counter() - started, f"успех={removed}"))
+
+        calls = ", ".join(f"{name}={count}" for name, count in sorted(sim.state.requests.items()))
+        results.append(("запросов к панели", 0.0, calls))
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Симулятор панели 3x-UI")
+    parser.add_argument("mode", choices=["serve", "bench"])
+    parser.add_argument("--clients", type=int, default=50_000)
+    parser.add_argument("--online-ratio", type=float, default=0.1)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--session-ttl", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=1000, help="Размер пачки в режиме bench")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    config = {
+        "username": args.username,
+        "password": args.password,
+        "latency_ms": args.latency_ms,
+        "jitter_ms": args.jitter_ms,
+        "error_rate": args.error_rate,
+        "session_ttl": args.session_ttl,
+        "seed": args.seed,
+    }
+
+    if args.mode == "serve":
+        import uvicorn
+
+        sim_config = SimConfig(**config)
+        state = PanelState()
+        state.seed(args.clients, online_ratio=args.online_ratio, rng=sim_config.random)
+        print(f"Симулятор 3x-UI: http://{args.host}:{args.port}/panel/api, Inbound ID 1, клиентов {args.clients}")
+        uvicorn.run(create_panel_app(state, sim_config), host=args.host, port=args.port, log_level="warning")
+        return
+
+    results = asyncio.run(run_benchmark(args.clients, batch=args.batch, online_ratio=args.online_ratio, **config))
+    for name, seconds, comment in results:
+        print(f"{name:<40} {seconds:>8.3f}s  {comment}")
+
+
+if __name__ == "__main__":
+    main()